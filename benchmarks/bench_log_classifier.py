@@ -0,0 +1,112 @@
+"""LogLineClassifierと従来の4正規表現ループの比較ベンチマーク
+
+使い方: python3 benchmarks/bench_log_classifier.py [--lines 200000] [--match-ratio 0.02] [--log path/to/latest.log]
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+import ruamel.yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from log_parser import LogLineClassifier  # noqa: E402
+
+# 従来のon_modifiedが見ていた4種類
+BENCH_KINDS = ('chat', 'lag', 'join', 'leave')
+
+# ATM10などのModサーバーでよく見る、どのパターンにも該当しない行
+NOISE_LINES = [
+    "[12:00:01] [Worker-Main-3/INFO] [ModernFix/]: Loaded 2314 recipes in 0.53s",
+    "[12:00:01] [Server thread/INFO] [minecraft/MinecraftServer]: Saving chunks for level 'ServerLevel[world]'/minecraft:overworld",
+    "[12:00:02] [Server thread/WARN] [mekanism/]: Multiblock structure at [123, 64, -55] is invalid",
+    "[12:00:02] [modloading-worker-0/INFO] [net.neoforged.fml.loading.moddiscovery/]: Found mod file ae2-19.0.12.jar",
+    "[12:00:03] [Server thread/INFO] [ftbquests/]: Loaded 1203 quests",
+    "[12:00:03] [C2ME Worker #2/DEBUG] [c2me/]: Chunk loading took 12ms",
+]
+EVENT_LINES = [
+    "[12:00:04] [Server thread/INFO] [minecraft/MinecraftServer]: <Steve> konnichiwa",
+    "[12:00:04] [Server thread/INFO] [minecraft/MinecraftServer]: Alex joined the game",
+    "[12:00:05] [Server thread/INFO] [minecraft/MinecraftServer]: Alex left the game",
+    "[12:00:05] [Server thread/WARN] [minecraft/MinecraftServer]: Can't keep up! Is the server overloaded? Running 2513ms or 50 ticks behind",
+]
+
+
+def load_patterns():
+    yaml = ruamel.yaml.YAML()
+    with open(os.path.join(ROOT, 'default_settings.yml'), 'r', encoding='utf-8') as f:
+        config = yaml.load(f)
+    return {kind: config['settings']['regex_patterns'][kind] for kind in BENCH_KINDS}
+
+
+def generate_lines(count, match_ratio, seed=0):
+    rng = random.Random(seed)
+    return [rng.choice(EVENT_LINES) if rng.random() < match_ratio else rng.choice(NOISE_LINES)
+            for _ in range(count)]
+
+
+def classify_four_regex(patterns, lines):
+    """従来のon_modifiedと同じく、毎行4つの正規表現をすべて実行する"""
+    chat, lag, join, leave = (re.compile(patterns[kind]) for kind in BENCH_KINDS)
+    results = []
+    for line in lines:
+        chat_match = chat.search(line)
+        lag_match = lag.search(line)
+        join_match = join.search(line)
+        leave_match = leave.search(line)
+        if chat_match: results.append(('chat', chat_match.groups()))
+        elif lag_match: results.append(('lag', lag_match.groups()))
+        elif join_match: results.append(('join', join_match.groups()))
+        elif leave_match: results.append(('leave', leave_match.groups()))
+        else: results.append(None)
+    return results
+
+
+def classify_single_pass(patterns, lines):
+    classifier = LogLineClassifier(patterns)
+    return [classifier.classify(line) for line in lines]
+
+
+def best_of(func, patterns, lines, repeat):
+    best, result = float('inf'), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(patterns, lines)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--lines', type=int, default=200_000)
+    parser.add_argument('--match-ratio', type=float, default=0.02, help="chat/join/leave/lagに該当する行の割合")
+    parser.add_argument('--log', help="合成ログの代わりに実際のlatest.logを使う")
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    patterns = load_patterns()
+    if args.log:
+        with open(args.log, 'r', encoding='utf-8', errors='ignore') as f:
+            lines = f.readlines()
+    else:
+        lines = generate_lines(args.lines, args.match_ratio)
+
+    old_time, old_result = best_of(classify_four_regex, patterns, lines, args.repeat)
+    new_time, new_result = best_of(classify_single_pass, patterns, lines, args.repeat)
+    if old_result != new_result:
+        mismatches = sum(1 for a, b in zip(old_result, new_result) if a != b)
+        print(f"WARNING: results differ on {mismatches} lines")
+
+    matched = sum(1 for r in new_result if r)
+    print(f"lines: {len(lines)} (matched: {matched})")
+    print(f"four-regex loop : {old_time * 1000:8.1f} ms  ({len(lines) / old_time:,.0f} lines/s)")
+    print(f"single-pass     : {new_time * 1000:8.1f} ms  ({len(lines) / new_time:,.0f} lines/s)")
+    print(f"speedup         : {old_time / new_time:.2f}x")
+
+
+if __name__ == '__main__':
+    main()
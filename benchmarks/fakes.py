@@ -0,0 +1,229 @@
+"""負荷試験用の偽物: Source RCONサーバー、Discordのチャンネル・ギルド・コマンドコンテキスト
+
+本物のMinecraftサーバーやBotトークンがなくても、main.pyの処理を端から端まで動かせるようにする。
+"""
+import asyncio
+import collections
+import os
+import struct
+import sys
+import time
+
+import discord
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from rcon_pool import (  # noqa: E402
+    SERVERDATA_AUTH, SERVERDATA_AUTH_RESPONSE, SERVERDATA_EXECCOMMAND, SERVERDATA_RESPONSE_VALUE,
+    encode_packet,
+)
+
+# Minecraftは4096バイトを超える応答を複数パケットに分けて返す
+RESPONSE_CHUNK_BYTES = 4096
+# MinecraftのRconClientが1パケットとして1回で読む最大バイト数
+RECEIVE_BUFFER_BYTES = 1460
+
+
+class FakeRconServer:
+    """Source RCONを話すローカルサーバー。whitelist/list/say/tellrawに、Minecraftと同じ文面で答える
+
+    delay秒待ってから応答し、1接続のコマンドは受信順に1つずつ処理する(サーバーのメインスレッドと同じ)。
+    4096バイトを超える応答(数百人のwhitelist list等)は、本物と同じく複数パケットに分けて返す。
+    受信も本物のRconClientと同じく1回のread(最大1460バイト)を1パケットとし、長さが合わなければ
+    (2つのパケットがまとめて届いた場合など)接続を閉じる。閉じた回数はrejectedに数える。
+    """
+
+    def __init__(self, password='bench', delay=0.0, whitelist=(), online=()):
+        self.password = password
+        self.delay = float(delay)
+        self.whitelist = {name.lower(): name for name in whitelist}
+        self.online = list(online)
+        self.commands = collections.Counter()
+        self.exec_count = 0
+        self.connections = 0
+        self.rejected = 0
+        self.host = '127.0.0.1'
+        self.port = None
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, self.host, 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    def respond(self, command):
+        """コマンド1つへの応答本文"""
+        verb, _, argument = command.partition(' ')
+        if verb == 'whitelist':
+            action, _, name = argument.partition(' ')
+            if action == 'list':
+                if not self.whitelist:
+                    return "There are no whitelisted players"
+                return f"There are {len(self.whitelist)} whitelisted player(s): {', '.join(self.whitelist.values())}"
+            if action == 'add':
+                if name.lower() in self.whitelist:
+                    return "Player is already whitelisted"
+                self.whitelist[name.lower()] = name
+                return f"Added {name} to the whitelist"
+            if action == 'remove':
+                if self.whitelist.pop(name.lower(), None) is None:
+                    return "Player is not whitelisted"
+                return f"Removed {name} from the whitelist"
+        if verb == 'list':
+            return f"There are {len(self.online)} of a max of 100 players online: {', '.join(self.online)}"
+        if verb in ('say', 'tellraw'):
+            return ""
+        return f"Unknown or incomplete command, see below for error: {command}"
+
+    async def _serve(self, reader, writer):
+        self.connections += 1
+        authed = False
+        try:
+            while True:
+                data = await reader.read(RECEIVE_BUFFER_BYTES)
+                if not data:
+                    break
+                if len(data) < 14 or struct.unpack('<i', data[:4])[0] != len(data) - 4:
+                    # 本物はパケットの途中や2つ分をまとめて読むと、応答せずに接続を閉じる
+                    self.rejected += 1
+                    break
+                request_id, packet_type = struct.unpack('<ii', data[4:12])
+                body = data[12:-2].decode('utf-8')
+                if not authed:
+                    if packet_type != SERVERDATA_AUTH:
+                        break
+                    authed = body == self.password
+                    writer.write(encode_packet(-1 if not authed else request_id, SERVERDATA_AUTH_RESPONSE, ''))
+                    await writer.drain()
+                    if not authed:
+                        break
+                    continue
+                if packet_type == SERVERDATA_EXECCOMMAND:
+                    self.exec_count += 1
+                    self.commands[body.partition(' ')[0]] += 1
+                    if self.delay:
+                        await asyncio.sleep(self.delay)
+                    payload = self.respond(body).encode('utf-8')
+                    chunks = [payload[i:i + RESPONSE_CHUNK_BYTES] for i in range(0, len(payload), RESPONSE_CHUNK_BYTES)] or [b'']
+                    for chunk in chunks:
+                        writer.write(struct.pack('<i', len(chunk) + 10) + struct.pack('<ii', request_id, SERVERDATA_RESPONSE_VALUE) + chunk + b'\x00\x00')
+                elif packet_type == SERVERDATA_RESPONSE_VALUE:
+                    # Minecraftは未知の種類のパケットにこう答える(番兵・死活確認に使われる)
+                    writer.write(encode_packet(request_id, SERVERDATA_RESPONSE_VALUE, 'Unknown request 0'))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+
+# --- Discord側 ---
+
+class FakeChannel:
+    """送信内容と時刻を記録するチャンネル。delay秒かけて送信する"""
+
+    def __init__(self, channel_id, delay=0.0, on_send=None):
+        self.id = channel_id
+        self.delay = float(delay)
+        self.on_send = on_send
+        self.sent = []  # (perf_counter, content)
+
+    async def send(self, content=None, **kwargs):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        now = time.perf_counter()
+        self.sent.append((now, content))
+        if self.on_send is not None:
+            self.on_send(now, content)
+
+
+class FakeUser:
+    def __init__(self, user_id, name):
+        self.id = user_id
+        self.bot = False
+        self.name = name
+        self.display_name = name
+        self.avatar = None
+
+
+class FakeMessage:
+    """on_messageに渡すDiscordのメッセージ(返信・添付なし)"""
+
+    def __init__(self, author, channel_id, content):
+        self.author = author
+        self.channel = FakeChannel(channel_id)
+        self.content = content
+        self.clean_content = content
+        self.attachments = []
+        self.reference = None
+
+
+class FakeGuild:
+    """cachedに含まれるメンバーはget_memberで見つかり、それ以外はfetch_member(fetch_delay秒)で引く"""
+
+    def __init__(self, guild_id=1, members=(), cached=(), fetch_delay=0.0):
+        self.id = guild_id
+        self.members = {user.id: user for user in members}
+        self.cached = set(cached)
+        self.fetch_delay = float(fetch_delay)
+        self.fetch_count = 0
+        self.query_count = 0
+
+    def get_member(self, user_id):
+        return self.members.get(user_id) if user_id in self.cached else None
+
+    async def fetch_member(self, user_id):
+        self.fetch_count += 1
+        if self.fetch_delay:
+            await asyncio.sleep(self.fetch_delay)
+        if user_id not in self.members:
+            raise discord.NotFound(_FakeResponse(404), "Unknown Member")
+        return self.members[user_id]
+
+    async def query_members(self, user_ids, limit=100, cache=True):
+        self.query_count += 1
+        if self.fetch_delay:
+            await asyncio.sleep(self.fetch_delay)
+        return [self.members[user_id] for user_id in user_ids if user_id in self.members]
+
+
+class _FakeResponse:
+    """discord.HTTPExceptionが要求するレスポンスの最小限"""
+
+    def __init__(self, status):
+        self.status = status
+        self.reason = 'Not Found'
+
+
+class FakeContext:
+    """スラッシュコマンドのctx。deferからrespondまでの時間を記録する"""
+
+    def __init__(self, author, guild, channel_id=None):
+        self.author = author
+        self.guild = guild
+        self.channel_id = channel_id
+        self.responses = []
+        self.started = time.perf_counter()
+        self.responded_at = None
+
+    async def defer(self, *args, **kwargs):
+        pass
+
+    async def respond(self, content=None, **kwargs):
+        if self.responded_at is None:
+            self.responded_at = time.perf_counter()
+        self.responses.append((content, kwargs))
+        return self
+
+    async def edit(self, **kwargs):
+        pass
+
+    @property
+    def latency(self):
+        return (self.responded_at or time.perf_counter()) - self.started
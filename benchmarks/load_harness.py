@@ -0,0 +1,492 @@
+"""ログ再生・負荷試験ハーネス(偽RCONサーバーと偽Discordチャンネルでmain.pyを端から端まで動かす)
+
+一時ディレクトリにlatest.logを書き出してLogFileHandler(取り込み口はwatchdogまたはpoll)に読ませ、偽チャンネルへの送信時刻から
+ログ→Discordの遅延を測る。続けてスラッシュコマンドのハンドラを偽のctxで呼び、応答時間とRCON呼び出し回数を測る。
+最後にDiscordでの連投をon_messageに流し、サーバーへのチャット中継(tellrawのまとめ送り)を測る。
+
+使い方: python3 benchmarks/load_harness.py [--lines 20000] [--rate 2000] [--rotate-every 5000] [--replay path/to/latest.log(.gz)] [--source poll]
+"""
+import argparse
+import asyncio
+import collections
+import datetime
+import gzip
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, BENCH_DIR)
+
+from bench_log_classifier import NOISE_LINES  # noqa: E402
+from fakes import FakeRconServer, FakeChannel, FakeGuild, FakeUser, FakeContext, FakeMessage  # noqa: E402
+
+CHANNEL_ID = 4242
+GUILD_ID = 1
+
+
+# --- ログ生成 ---
+
+def synthetic_lines(count, event_ratio, players, seed=0):
+    """チャット・参加・退出・ラグ・ノイズが混ざったlatest.logの行を生成する"""
+    rng = random.Random(seed)
+    online = set()
+    for seq in range(count):
+        stamp = time.strftime('%H:%M:%S')
+        if rng.random() >= event_ratio:
+            yield f"[{stamp}]{rng.choice(NOISE_LINES)[10:]}"
+            continue
+        roll = rng.random()
+        if roll < 0.6 and online:
+            # 英語のチャットはローマ字変換されないので、送信内容が決まり遅延を測れる
+            yield f"[{stamp}] [Server thread/INFO] [minecraft/MinecraftServer]: <{rng.choice(sorted(online))}> gg {seq}"
+        elif roll < 0.8 or not online:
+            player = rng.choice(players)
+            online.add(player)
+            yield f"[{stamp}] [Server thread/INFO] [minecraft/MinecraftServer]: {player} joined the game"
+        elif roll < 0.95:
+            player = rng.choice(sorted(online))
+            online.discard(player)
+            yield f"[{stamp}] [Server thread/INFO] [minecraft/MinecraftServer]: {player} left the game"
+        else:
+            yield (f"[{stamp}] [Server thread/WARN] [minecraft/MinecraftServer]: Can't keep up! "
+                   f"Is the server overloaded? Running {rng.randint(2000, 9000)}ms or {rng.randint(40, 180)} ticks behind")
+
+
+def replay_lines(path):
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8', errors='ignore') as f:
+        for line in f:
+            yield line.rstrip('\r\n')
+
+
+class LogWriter(threading.Thread):
+    """サーバーの代わりにlatest.logへ書き込み、Minecraftと同じ名前でgzipローテーションする
+
+    書き込むたびにmodifiedをセットし、監視スレッド(watchdogの代わり)に知らせる。
+    """
+
+    def __init__(self, log_path, lines, rate, rotate_every, expect, modified):
+        super().__init__(daemon=True)
+        self.log_path = log_path
+        self.lines = lines
+        self.rate = float(rate)
+        self.rotate_every = int(rotate_every)
+        self.expect = expect
+        self.modified = modified
+        self.written = 0
+        self.rotations = 0
+        self.started = None
+        self.finished = None
+
+    def _rotate(self, f):
+        f.close()
+        self.rotations += 1
+        date = datetime.date.today().isoformat()
+        rotated = os.path.join(os.path.dirname(self.log_path), f"{date}-{self.rotations}.log.gz")
+        with open(self.log_path, 'rb') as src, gzip.open(rotated, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(self.log_path)
+        return open(self.log_path, 'a', encoding='utf-8')
+
+    def run(self):
+        self.started = time.perf_counter()
+        batch = max(1, int(self.rate / 100)) if self.rate else 500
+        f = open(self.log_path, 'a', encoding='utf-8')
+        try:
+            for line in self.lines:
+                f.write(line + "\n")
+                self.written += 1
+                if self.written % batch == 0:
+                    f.flush()
+                    self.expect(line=None)  # ここまでの行の書き込み時刻を確定する
+                    self.modified.set()
+                    if self.rate:
+                        # 予定より進みすぎていれば待つ
+                        ahead = self.started + self.written / self.rate - time.perf_counter()
+                        if ahead > 0:
+                            time.sleep(ahead)
+                self.expect(line=line)
+                if self.rotate_every and self.written % self.rotate_every == 0:
+                    self.expect(line=None)
+                    f = self._rotate(f)
+                    self.modified.set()
+            f.flush()
+            self.expect(line=None)
+            self.modified.set()
+        finally:
+            f.close()
+            self.finished = time.perf_counter()
+
+
+class Watcher(threading.Thread):
+    """watchdogの監視スレッドの代わりに、変更通知ごとに取り込み口のwakeup()を呼ぶ"""
+
+    def __init__(self, source, modified):
+        super().__init__(daemon=True)
+        self.source = source
+        self.modified = modified
+        self.stopped = False
+
+    def run(self):
+        while not self.stopped:
+            if self.modified.wait(0.1):
+                self.modified.clear()
+                self.source.wakeup()
+
+
+# --- 計測 ---
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def describe(values, unit_scale=1000.0, unit='ms'):
+    return (f"p50 {percentile(values, 50) * unit_scale:8.1f}{unit}  p95 {percentile(values, 95) * unit_scale:8.1f}{unit}  "
+            f"p99 {percentile(values, 99) * unit_scale:8.1f}{unit}  max {max(values, default=0) * unit_scale:8.1f}{unit}")
+
+
+class DeliveryTracker:
+    """送信されるはずの文面ごとに書き込み時刻を覚え、偽チャンネルに届いた時刻との差を遅延とする"""
+
+    def __init__(self, expected_text):
+        self.expected_text = expected_text
+        self.pending = collections.defaultdict(collections.deque)
+        self.unflushed = []
+        self.latencies = []
+        self.expected = 0
+        self.unmatched = 0
+        self.last_delivery = None
+        self._lock = threading.Lock()
+
+    def expect(self, line):
+        """書き込んだ行を登録する。line=Noneでflushした時点の時刻を、それまでの行の書き込み時刻とする"""
+        if line is not None:
+            text = self.expected_text(line)
+            if text is not None:
+                self.unflushed.append(text)
+            return
+        now = time.perf_counter()
+        with self._lock:
+            for text in self.unflushed:
+                self.pending[text].append(now)
+            self.expected += len(self.unflushed)
+        self.unflushed = []
+
+    def on_send(self, now, content):
+        with self._lock:
+            for text in content.split("\n"):
+                queue = self.pending.get(text)
+                if queue:
+                    self.latencies.append(now - queue.popleft())
+                else:
+                    self.unmatched += 1
+        self.last_delivery = now
+
+    @property
+    def outstanding(self):
+        return self.expected - len(self.latencies)
+
+
+async def run_log_phase(main, args, report):
+    mc_server = main.DEFAULT_SERVER
+    mc_server.config = mc_server.config._replace(log_source=dict(mc_server.config.log_source, type=args.source))
+    handler = mc_server.log_handler = main.LogFileHandler(main.bot, mc_server)
+    handler.start(asyncio.get_running_loop())
+
+    def expected_text(line):
+        classified = mc_server.regex.classifier.classify(line)
+        if classified is None:
+            return None
+        kind, groups = classified
+        if kind in ('join', 'leave'):
+            return main.MESSAGES['discord']['player_joined' if kind == 'join' else 'player_left'].format(player_name=groups[0])
+        if kind == 'chat':
+            player_name, message = groups[0], groups[1]
+            # ローマ字変換される行は送信内容が変わる(APIの応答次第)ので追跡しない
+            if main.ROMAJI_ENGINE.analyze(message).kind == 'romaji' and not main.re.search(r'[ぁ-んァ-ン一-龯]', message):
+                return None
+            return main.MESSAGES['discord']['chat_normal'].format(player_name=player_name, message=message)
+        return None
+
+    tracker = DeliveryTracker(expected_text)
+    report['channel'].on_send = tracker.on_send
+
+    if args.replay:
+        lines = replay_lines(args.replay)
+    else:
+        players = [f"Bench{i:04d}" for i in range(args.players)]
+        lines = synthetic_lines(args.lines, args.event_ratio, players)
+
+    modified = threading.Event()
+    writer = LogWriter(mc_server.config.log_file, lines, args.rate, args.rotate_every, tracker.expect, modified)
+    # pollは変更通知を使わないので、Watcherは立てない
+    watcher = Watcher(handler.source, modified) if args.source == 'watchdog' else None
+    if watcher is not None: watcher.start()
+    writer.start()
+
+    # 書き込みが終わり、追跡中の送信がすべて届くか、しばらく何も届かなくなるまで待つ
+    idle_since = time.perf_counter()
+    delivered = 0
+    while True:
+        await asyncio.sleep(0.05)
+        if len(tracker.latencies) != delivered:
+            delivered, idle_since = len(tracker.latencies), time.perf_counter()
+        if writer.finished and tracker.outstanding <= 0:
+            break
+        if writer.finished and time.perf_counter() - idle_since > args.idle_timeout:
+            break
+    if watcher is not None:
+        watcher.stopped = True
+        watcher.join()
+
+    end = tracker.last_delivery or time.perf_counter()
+    elapsed = end - writer.started
+    report['log'] = {
+        'lines': writer.written,
+        'rotations': writer.rotations,
+        'write_seconds': writer.finished - writer.started,
+        'elapsed': elapsed,
+        'lines_per_sec': writer.written / elapsed if elapsed else 0.0,
+        'tracked': tracker.expected,
+        'delivered': len(tracker.latencies),
+        'lost': tracker.outstanding,
+        'unmatched_lines': tracker.unmatched,
+        'discord_messages': len(report['channel'].sent),
+        'latencies': tracker.latencies,
+        'pipeline': handler.pipeline.stats(),
+        'source': handler.source.describe(),
+        'source_stats': handler.source.stats(),
+    }
+    handler.stop()
+
+
+async def run_command_phase(main, args, server, guild, report):
+    """スラッシュコマンドのハンドラを順番に呼び、応答時間とRCON呼び出し回数を記録する"""
+    authors = list(guild.members.values())
+    rng = random.Random(1)
+    results = collections.defaultdict(lambda: {'latencies': [], 'rcon_calls': []})
+
+    async def call(name, command, *call_args, author=None):
+        ctx = FakeContext(author or rng.choice(authors), guild)
+        before = server.exec_count
+        await command.callback(ctx, *call_args)
+        results[name]['latencies'].append(ctx.latency)
+        results[name]['rcon_calls'].append(server.exec_count - before)
+        return ctx
+
+    for i in range(args.commands):
+        # 追加した本人が削除する(他人の追加は権限エラーで即答になり、計測にならない)
+        player, author = f"Cmd{i:04d}", rng.choice(authors)
+        await call('atm add', main.add_player, player, None, author=author)
+        await call('atm ls', main.list_players, False, None, None)
+        await call('ls', main.show_online_players, None, None)
+        await call('atm rm', main.remove_player, player, None, author=author)
+    await call('atm ls (refresh)', main.list_players, True, None, None)
+    report['commands'] = results
+
+
+async def run_rcon_burst_phase(main, args, server, report):
+    """複数パケットの応答を含むコマンドを同時に投げる。本物のサーバーと同じく、まとめて届いたパケットは偽サーバーが拒否する"""
+    commands = ['whitelist list', 'list', 'say burst'] * max(1, args.rcon_burst // 3)
+    rejected_before = server.rejected
+    started = time.perf_counter()
+    results = await asyncio.gather(*(main.DEFAULT_SERVER.rcon_pool.run(command) for command in commands), return_exceptions=True)
+    report['rcon_burst'] = {
+        'commands': len(commands),
+        'elapsed': time.perf_counter() - started,
+        'failed': sum(isinstance(result, Exception) for result in results),
+        'rejected': server.rejected - rejected_before,
+    }
+
+
+async def run_relay_phase(main, args, server, guild, report):
+    """Discordでの連投をon_messageに流し、キューが空になるまでの時間とtellrawの回数を測る"""
+    authors = list(guild.members.values())
+    chat = main.DEFAULT_SERVER.chat
+    before = server.commands['tellraw']
+    started = time.perf_counter()
+    handler_seconds = []
+    for i in range(args.relay):
+        message = FakeMessage(authors[i % len(authors)], CHANNEL_ID, f"raid message {i} " + "w" * (i % 40))
+        handler_started = time.perf_counter()
+        await main.on_message(message)
+        handler_seconds.append(time.perf_counter() - handler_started)
+        if args.relay_rate:
+            await asyncio.sleep(1 / args.relay_rate)
+    while chat.depth:
+        await asyncio.sleep(0.01)
+    report['relay'] = {
+        'messages': args.relay,
+        'elapsed': time.perf_counter() - started,
+        'commands': server.commands['tellraw'] - before,
+        'handler_latencies': handler_seconds,
+        'stats': chat.stats(),
+    }
+
+
+async def run(args):
+    workdir = tempfile.mkdtemp(prefix='mcbot-bench-')
+    log_dir = os.path.join(workdir, 'logs')
+    os.makedirs(log_dir)
+    open(os.path.join(log_dir, 'latest.log'), 'w').close()
+    shutil.copy(os.path.join(ROOT, 'default_settings.yml'), workdir)
+
+    players = [f"Bench{i:04d}" for i in range(args.players)]
+    server = await FakeRconServer(delay=args.rcon_delay, whitelist=players, online=players[:args.online]).start()
+
+    os.environ.update({
+        'DISCORD_BOT_TOKEN': 'bench', 'RCON_HOST': server.host, 'RCON_PORT': str(server.port),
+        'RCON_PASSWORD': server.password, 'YAHOO_APPID': 'bench', 'CHANNEL_ID': str(CHANNEL_ID),
+        'LOG_FILE_PATH': os.path.join(log_dir, 'latest.log'),
+    })
+    os.chdir(workdir)
+    # main.pyのコンソール出力は捨て、ハーネスの結果だけを表示する
+    real_stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        import main
+
+        # Botにはログインしないので、送信先と自分自身のユーザー情報を偽物に差し替える
+        channel = FakeChannel(CHANNEL_ID, delay=args.discord_delay)
+        main.discord_outbox.get_channel = lambda channel_id: channel if channel_id == CHANNEL_ID else None
+        if args.no_rate_limit:
+            main.discord_outbox.options['rate_messages'] = 10 ** 6
+        main.bot._connection.user = FakeUser(999, 'bench-bot')
+
+        async def fake_yahoo_request(text):
+            await asyncio.sleep(args.yahoo_delay)
+            return text.upper()
+        main.yahoo_converter._request = fake_yahoo_request
+
+        # 追加者は数人に偏り、一部はギルドから脱退済み、一部だけGatewayのキャッシュにいる
+        members = [FakeUser(1000 + i, f"member{i}") for i in range(args.adders)]
+        guild = FakeGuild(GUILD_ID, members=members, cached=[m.id for m in members[::2]], fetch_delay=args.fetch_delay)
+        adder_ids = [m.id for m in members] + [9000 + i for i in range(max(1, args.adders // 4))]
+        rng = random.Random(2)
+        for player in players:
+            main.DEFAULT_SERVER.whitelist.apply_added(player, rng.choice(adder_ids), source='bench')
+
+        report = {'channel': channel}
+        loop_monitor = asyncio.get_running_loop().create_task(
+            main.monitor_event_loop(main.LOOP_LAG_SECONDS, main.LOOP_LAG_MAX, interval=0.05))
+        await run_log_phase(main, args, report)
+        await run_command_phase(main, args, server, guild, report)
+        if args.rcon_burst:
+            await run_rcon_burst_phase(main, args, server, report)
+        if args.relay:
+            await run_relay_phase(main, args, server, guild, report)
+        loop_monitor.cancel()
+        report['loop_lag_p99'] = main.LOOP_LAG_SECONDS.quantile(0.99)
+        report['loop_lag_max'] = main.LOOP_LAG_MAX.value()
+        if args.metrics_out:
+            with open(os.path.join(ROOT, args.metrics_out) if not os.path.isabs(args.metrics_out) else args.metrics_out, 'w') as f:
+                f.write(main.METRICS.render())
+        await main.DEFAULT_SERVER.chat.close()
+        await main.DEFAULT_SERVER.rcon_pool.close()
+        await main.yahoo_converter.close()
+        main.DEFAULT_SERVER.store.close()
+        main.DEFAULT_SERVER.sessions.close()
+        main.DEFAULT_SERVER.log_index.close()
+    finally:
+        sys.stdout.close()
+        sys.stdout = real_stdout
+        await server.close()
+        os.chdir(ROOT)
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+    report['rcon_commands'] = dict(server.commands)
+    report['rcon_connections'] = server.connections
+    report['rcon_rejected'] = server.rejected
+    report['member_fetches'] = guild.fetch_count
+    report['member_queries'] = guild.query_count
+    return report
+
+
+def print_report(report, args):
+    log = report['log']
+    print(f"log lines          : {log['lines']} ({log['rotations']} rotations), written in {log['write_seconds']:.2f}s")
+    print(f"log source         : {log['source']} (read {log['source_stats']['lines_read']}, unread {log['source_stats']['lag_bytes']} bytes)")
+    print(f"throughput         : {log['lines_per_sec']:,.0f} lines/s (first write -> last delivery, {log['elapsed']:.2f}s)")
+    print(f"tracked events     : {log['tracked']} (delivered {log['delivered']}, missing {log['lost']}, untracked lines {log['unmatched_lines']})")
+    print(f"discord messages   : {log['discord_messages']}")
+    print(f"log->discord       : {describe(log['latencies'])}")
+    counters = log['pipeline'].get('counters', {})
+    if counters:
+        print(f"pipeline counters  : {counters}")
+    print()
+    print(f"{'command':<18} {'calls':>5} {'rcon/call':>9}   latency")
+    for name, result in report['commands'].items():
+        calls = len(result['latencies'])
+        rcon_per_call = sum(result['rcon_calls']) / calls if calls else 0.0
+        print(f"{name:<18} {calls:>5} {rcon_per_call:>9.2f}   {describe(result['latencies'])}")
+    burst = report.get('rcon_burst')
+    if burst:
+        print(f"{'rcon burst':<18} {burst['commands']:>5} concurrent in {burst['elapsed']:.2f}s (failed {burst['failed']})")
+    relay = report.get('relay')
+    if relay:
+        print()
+        print(f"chat relay         : {relay['messages']} messages -> {relay['commands']} tellraw in {relay['elapsed']:.2f}s "
+              f"(dropped {relay['stats']['dropped']}, failed {relay['stats']['failed']})")
+        print(f"on_message         : {describe(relay['handler_latencies'])}")
+    print()
+    print(f"rcon commands      : {report['rcon_commands']} over {report['rcon_connections']} connection(s), "
+          f"{report['rcon_rejected']} rejected packet(s)")
+    print(f"member lookups     : {report['member_fetches']} fetch_member, {report['member_queries']} bulk queries")
+    print(f"event loop lag     : p99 {(report['loop_lag_p99'] or 0) * 1000:.1f}ms  recent max {report['loop_lag_max'] * 1000:.1f}ms")
+    print(f"peak RSS           : {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MiB")
+    if args.trace_memory:
+        current, peak = tracemalloc.get_traced_memory()
+        print(f"peak traced memory : {peak / 1024 / 1024:.1f} MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--lines', type=int, default=20_000, help="生成するログの行数")
+    parser.add_argument('--rate', type=float, default=0, help="1秒あたりの書き込み行数(0で最速)")
+    parser.add_argument('--event-ratio', type=float, default=0.1, help="チャット・参加・退出・ラグの行の割合")
+    parser.add_argument('--rotate-every', type=int, default=0, help="この行数ごとにlatest.logをgzipローテーションする")
+    parser.add_argument('--replay', help="生成する代わりに実際のlatest.log(.gz可)を再生する")
+    parser.add_argument('--source', choices=('watchdog', 'poll'), default='watchdog', help="ログの取り込み口")
+    parser.add_argument('--players', type=int, default=300, help="ホワイトリストの人数")
+    parser.add_argument('--online', type=int, default=40, help="オンラインの人数")
+    parser.add_argument('--adders', type=int, default=8, help="追加者(Discordメンバー)の人数")
+    parser.add_argument('--commands', type=int, default=10, help="各スラッシュコマンドを呼ぶ回数")
+    parser.add_argument('--rcon-burst', type=int, default=60, help="同時に投げるRCONコマンドの数(0で省略)")
+    parser.add_argument('--relay', type=int, default=200, help="on_messageに流すDiscordの発言数(0で省略)")
+    parser.add_argument('--relay-rate', type=float, default=0, help="1秒あたりの発言数(0で一度に)")
+    parser.add_argument('--rcon-delay', type=float, default=0.002, help="偽RCONサーバーの応答遅延(秒)")
+    parser.add_argument('--discord-delay', type=float, default=0.05, help="偽チャンネルの送信遅延(秒)")
+    parser.add_argument('--fetch-delay', type=float, default=0.1, help="fetch_memberの遅延(秒)")
+    parser.add_argument('--yahoo-delay', type=float, default=0.1, help="かな漢字変換APIの遅延(秒)")
+    parser.add_argument('--no-rate-limit', action='store_true', help="送信の自主レート制限(既定5通/5秒)を外す")
+    parser.add_argument('--idle-timeout', type=float, default=10.0, help="送信が途絶えてから打ち切るまでの秒数")
+    parser.add_argument('--trace-memory', action='store_true', help="tracemallocでPythonのピークメモリも測る(遅くなる)")
+    parser.add_argument('--metrics-out', help="終了時のメトリクス(Prometheus形式)をこのファイルに書き出す")
+    parser.add_argument('--keep', action='store_true', help="一時ディレクトリを残す")
+    args = parser.parse_args()
+
+    if args.trace_memory:
+        tracemalloc.start()
+    report = asyncio.run(run(args))
+    print_report(report, args)
+    # 本物のサーバーなら接続を切られるパケットの送り方をした場合は失敗にする
+    burst = report.get('rcon_burst') or {}
+    if report['rcon_rejected'] or burst.get('failed'):
+        print(f"FAILED: {report['rcon_rejected']} RCON packet(s) rejected, {burst.get('failed', 0)} burst command(s) failed")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
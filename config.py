@@ -0,0 +1,218 @@
+"""settings.ymlの読み込み・検証と、不変の設定スナップショット
+
+default_settings.ymlに利用者のsettings.ymlを重ね、型・メッセージの置換フィールド・正規表現・servers
+を検証してから、読み取り専用のスナップショット(ConfigSnapshot)にする。検証に失敗した場合は
+ConfigErrorに全ての誤りをまとめて返す(稼働中の再読み込みでは、前のスナップショットを使い続ける)。
+"""
+import difflib
+import re
+import string
+import time
+from types import MappingProxyType
+from typing import Mapping, NamedTuple
+
+import ruamel.yaml
+
+from servers import load_server_configs, regex_profile, compile_regex_profile
+
+# メッセージのテンプレートとして置換フィールドを検証するトップレベルのセクション
+TEMPLATE_SECTIONS = ('discord', 'server', 'console')
+
+# 正規表現ごとに、処理側が使うグループの数
+REQUIRED_GROUPS = {
+    'chat': 2, 'lag': 2, 'join': 1, 'leave': 1, 'whitelist_add': 1, 'whitelist_remove': 1,
+    'online_list': 1, 'whitelist_list': 1, 'add_success': 1, 'remove_success': 1,
+}
+
+# 起動時にしか反映されない設定(コマンドの登録や、作成済みの接続・キューの大きさなど)
+RESTART_REQUIRED = (
+    ('commands',),
+    ('settings', 'servers'),
+    ('settings', 'rcon'),
+    ('settings', 'yahoo'),
+    ('settings', 'discord_outbox'),
+    ('settings', 'server_chat'),
+    ('settings', 'lag'),
+    ('settings', 'sessions'),
+    ('settings', 'log_index'),
+    ('settings', 'log_pipeline'),
+    ('settings', 'log_tail'),
+    ('settings', 'log_source'),
+    ('settings', 'metrics'),
+    ('settings', 'member_names'),
+    ('settings', 'whitelist'),
+)
+
+# 空欄(null)にしてよい文字列の設定。それ以外の文字列(特にメッセージのテンプレート)は空欄を誤りにする
+OPTIONAL_STRINGS = (
+    ('settings', 'yahoo', 'cache', 'persistent_file'),
+)
+
+_FORMATTER = string.Formatter()
+
+
+class ConfigError(Exception):
+    """設定の誤り。errorsに全ての誤り、textに読み込んだsettings.ymlの内容"""
+
+    def __init__(self, errors, text=None):
+        self.errors = list(errors)
+        self.text = text
+        super().__init__("; ".join(self.errors))
+
+
+class ConfigSnapshot(NamedTuple):
+    messages: Mapping        # 重ね合わせた設定全体(読み取り専用)
+    servers: tuple           # ServerConfig
+    regex_profiles: Mapping  # プロファイル名 -> RegexProfile(コンパイル済み)
+    user_text: str           # 読み込んだsettings.ymlの内容(差分の表示用)
+    loaded_at: float
+
+
+def _type_error(default, value, optional=False):
+    """defaultと同じ種類の値でなければ、期待する型の名前を返す(optionalな文字列はNoneも可)"""
+    if isinstance(default, dict):
+        return None if isinstance(value, dict) else "mapping"
+    if isinstance(default, list):
+        return None if isinstance(value, list) else "list"
+    if isinstance(default, bool):
+        return None if isinstance(value, bool) else "true/false"
+    if isinstance(default, (int, float)):
+        return None if isinstance(value, (int, float)) and not isinstance(value, bool) else "number"
+    if isinstance(default, str):
+        return None if isinstance(value, str) or (optional and value is None) else "string"
+    return None
+
+
+def merge(default, user, path=(), errors=None):
+    """defaultにuserを重ねた普通のdictを返す。型の合わない値はerrorsに記録し、defaultの値を使う"""
+    merged = {}
+    for key, default_value in default.items():
+        if key not in user:
+            merged[key] = default_value
+            continue
+        value = user[key]
+        expected = _type_error(default_value, value, path + (key,) in OPTIONAL_STRINGS)
+        if expected is not None:
+            if errors is not None:
+                errors.append(f"{'.'.join(map(str, path + (key,)))}: expected {expected}, got {value!r}")
+            merged[key] = default_value
+        elif isinstance(default_value, dict):
+            merged[key] = merge(default_value, value, path + (key,), errors)
+        else:
+            merged[key] = value
+    # defaultにないキー(regex_profilesの中身など)はそのまま使う
+    for key, value in user.items():
+        merged.setdefault(key, value)
+    return merged
+
+
+def template_fields(text):
+    """str.formatの置換フィールド名の集合。書式が壊れていればValueError"""
+    fields = set()
+    for _, field, _, _ in _FORMATTER.parse(text):
+        if field is not None:
+            fields.add(re.split(r'[.\[]', field, 1)[0])
+    return fields
+
+
+def _check_templates(default, merged, path, errors):
+    for key, default_value in default.items():
+        value = merged.get(key)
+        key_path = '.'.join(map(str, path + (key,)))
+        if isinstance(default_value, dict) and isinstance(value, dict):
+            _check_templates(default_value, value, path + (key,), errors)
+        elif isinstance(default_value, str) and isinstance(value, str) and value is not default_value:
+            allowed = template_fields(default_value)
+            try:
+                unknown = template_fields(value) - allowed
+            except ValueError as e:
+                errors.append(f"{key_path}: {e}")
+                continue
+            if unknown:
+                available = ", ".join(f"{{{name}}}" for name in sorted(allowed)) or "none"
+                errors.append(f"{key_path}: unknown placeholder {', '.join(f'{{{name}}}' for name in sorted(unknown))} (available: {available})")
+
+
+def _check_patterns(patterns, path, errors):
+    for key, pattern in patterns.items():
+        try:
+            compiled = re.compile(pattern)
+        except (re.error, TypeError) as e:
+            errors.append(f"{path}.{key}: invalid regular expression: {e}")
+            continue
+        if compiled.groups < REQUIRED_GROUPS.get(key, 0):
+            errors.append(f"{path}.{key}: needs at least {REQUIRED_GROUPS[key]} group(s), has {compiled.groups}")
+
+
+def freeze(value):
+    """dictは読み取り専用のMappingProxyType、listはtupleにする(ruamelの型も普通の型に直す)"""
+    if isinstance(value, dict):
+        return MappingProxyType({str(key): freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    if isinstance(value, str):
+        return str(value)
+    return value
+
+
+def load_config(default_path, user_path):
+    """2つの設定ファイルを読み、検証済みのConfigSnapshotを返す。誤りがあればConfigError"""
+    yaml = ruamel.yaml.YAML()
+    with open(default_path, 'r', encoding='utf-8') as f:
+        default = yaml.load(f)
+    try:
+        with open(user_path, 'r', encoding='utf-8') as f:
+            user_text = f.read()
+    except OSError as e:
+        raise ConfigError([f"{user_path}: {e}"])
+    try:
+        user = yaml.load(user_text) or {}
+    except Exception as e:
+        raise ConfigError([f"{user_path}: {e}"], user_text)
+    if not isinstance(user, dict):
+        raise ConfigError([f"{user_path}: expected a mapping at the top level"], user_text)
+
+    errors = []
+    merged = merge(default, user, errors=errors)
+    for section in TEMPLATE_SECTIONS:
+        _check_templates(default[section], merged[section], (section,), errors)
+    settings = merged['settings']
+    _check_patterns(settings['regex_patterns'], 'settings.regex_patterns', errors)
+    for name, overrides in (settings.get('regex_profiles') or {}).items():
+        if not isinstance(overrides, dict):
+            errors.append(f"settings.regex_profiles.{name}: expected mapping")
+            continue
+        _check_patterns(overrides, f'settings.regex_profiles.{name}', errors)
+    try:
+        servers = tuple(server._replace(log_source=freeze(server.log_source)) for server in load_server_configs(settings))
+    except (ValueError, TypeError, AttributeError) as e:
+        errors.append(f"settings.servers: {e}")
+    if errors:
+        raise ConfigError(errors, user_text)
+
+    # 使われるプロファイルだけをコンパイルし、同じプロファイルのサーバーで共有する
+    profiles = {name: compile_regex_profile(regex_profile(settings, name))
+                for name in {server.regex_profile for server in servers}}
+    return ConfigSnapshot(freeze(merged), servers, MappingProxyType(profiles), user_text, time.time())
+
+
+def describe_diff(old_text, new_text, limit=40):
+    """前回読み込んだ内容との差分(unified diff, 最大limit行)"""
+    lines = list(difflib.unified_diff((old_text or '').splitlines(), (new_text or '').splitlines(),
+                                      'settings.yml (applied)', 'settings.yml (rejected)', lineterm='', n=1))
+    if len(lines) > limit:
+        lines = lines[:limit] + [f"... ({len(lines) - limit} more lines)"]
+    return "\n".join(lines)
+
+
+def restart_required_changes(old, new):
+    """起動時にしか反映されない設定のうち、変更されたもののキー"""
+    changed = []
+    for path in RESTART_REQUIRED:
+        old_value, new_value = old, new
+        for key in path:
+            old_value = old_value.get(key) if old_value is not None else None
+            new_value = new_value.get(key) if new_value is not None else None
+        if old_value != new_value:
+            changed.append('.'.join(path))
+    return changed
@@ -0,0 +1,175 @@
+"""Discordへの送信キュー。連続するイベントを2000文字以内にまとめて、チャンネルごとに順番通り送る"""
+import asyncio
+import collections
+import time
+
+import discord
+
+# Discordのメッセージ本文の上限
+MAX_MESSAGE_LENGTH = 2000
+
+
+def split_message(text, limit=MAX_MESSAGE_LENGTH):
+    """上限を超える1件のメッセージを、なるべく改行位置で分割する"""
+    chunks = []
+    while len(text) > limit:
+        cut = text.rfind('\n', 0, limit)
+        if cut <= 0:
+            cut = limit
+        chunks.append(text[:cut])
+        text = text[cut:].lstrip('\n')
+    if text:
+        chunks.append(text)
+    return chunks
+
+
+class ChannelOutbox:
+    """1チャンネル分の送信キュー
+
+    最初のイベントからflush_window秒だけ待って後続をまとめ、1通にできるだけ詰めて送る。
+    送信はワーカー1つが順番に行うので、到着順は崩れない。
+    py-cordが429を内部で待った場合(送信が遅い)や429が返った場合はまとめる時間を延ばし、
+    速く送れている間は元に戻す。さらにチャンネルのレート制限(既定で5通/5秒)を超えないよう自制する。
+    """
+
+    def __init__(self, channel_id, get_channel, flush_window=0.35, max_flush_window=3.0,
+                 rate_messages=5, rate_per=5.0, log=None, on_sent=None):
+        self.channel_id = channel_id
+        self.get_channel = get_channel
+        self.base_window = float(flush_window)
+        self.max_window = max(float(max_flush_window), self.base_window)
+        self.window = self.base_window
+        self.rate_messages = max(1, int(rate_messages))
+        self.rate_per = float(rate_per)
+        self.log = log or (lambda key, **kwargs: None)
+        # 送信ごとに on_sent(チャンネルID, 送信にかかった秒数, キューで待った秒数, まとめたイベント数) を呼ぶ
+        self.on_sent = on_sent
+
+        self._queue = collections.deque()  # (enqueue時刻, 本文)
+        self._wakeup = asyncio.Event()
+        self._sent_at = collections.deque(maxlen=self.rate_messages)
+        self._worker = None
+
+        # 統計
+        self.events_sent = 0
+        self.messages_sent = 0
+        self.last_flush_latency = 0.0
+        self.avg_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+
+    @property
+    def depth(self):
+        return len(self._queue)
+
+    def post(self, text):
+        """イベントループ上から呼ぶ。送信は非同期にまとめて行われる"""
+        now = time.monotonic()
+        for chunk in split_message(text):
+            self._queue.append((now, chunk))
+        self._wakeup.set()
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def _wait_rate_limit(self):
+        if len(self._sent_at) == self.rate_messages:
+            wait = self._sent_at[0] + self.rate_per - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+    def _pack(self):
+        """キューの先頭から、上限に収まるだけ改行でつなげて取り出す"""
+        parts, length, oldest = [], 0, self._queue[0][0]
+        while self._queue:
+            text = self._queue[0][1]
+            added = len(text) + (1 if parts else 0)
+            if parts and length + added > MAX_MESSAGE_LENGTH:
+                break
+            parts.append(text)
+            length += added
+            self._queue.popleft()
+        return '\n'.join(parts), len(parts), oldest
+
+    async def _run(self):
+        while True:
+            if not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            # 後続のイベントを少し待ってからまとめる(溜まっているなら待たない)
+            if sum(len(text) for _, text in self._queue) < MAX_MESSAGE_LENGTH:
+                await asyncio.sleep(self.window)
+            await self._wait_rate_limit()
+
+            content, count, oldest = self._pack()
+            send_started = time.monotonic()
+            await self._send(content)
+            self._sent_at.append(time.monotonic())
+
+            latency = time.monotonic() - oldest
+            if self.on_sent is not None:
+                self.on_sent(self.channel_id, time.monotonic() - send_started, send_started - oldest, count)
+            self.last_flush_latency = latency
+            self.max_flush_latency = max(self.max_flush_latency, latency)
+            self.avg_flush_latency = latency if not self.messages_sent else self.avg_flush_latency * 0.9 + latency * 0.1
+            self.events_sent += count
+            self.messages_sent += 1
+
+    async def _send(self, content):
+        for _ in range(3):
+            channel = self.get_channel(self.channel_id)
+            if channel is None:
+                return
+            started = time.monotonic()
+            try:
+                await channel.send(content)
+            except discord.HTTPException as e:
+                if e.status != 429:
+                    self.log('discord_send_failed', error=e)
+                    return
+                # レート制限: 指示された時間だけ待ち、同じ内容を再送する(順序を保つ)
+                self._widen_window()
+                await asyncio.sleep(getattr(e, 'retry_after', None) or self.window)
+                continue
+            except Exception as e:
+                self.log('discord_send_failed', error=e)
+                return
+            # 送信に時間がかかった = ライブラリ側でレート制限待ちが発生した
+            if time.monotonic() - started > 1.0:
+                self._widen_window()
+            else:
+                self.window = max(self.base_window, self.window * 0.8)
+            return
+        self.log('discord_send_failed', error="rate limited")
+
+    def _widen_window(self):
+        self.window = min(self.max_window, self.window * 2)
+
+    def stats(self):
+        return {
+            'queue_depth': self.depth,
+            'flush_window': self.window,
+            'events_sent': self.events_sent,
+            'messages_sent': self.messages_sent,
+            'last_flush_latency': self.last_flush_latency,
+            'avg_flush_latency': self.avg_flush_latency,
+            'max_flush_latency': self.max_flush_latency,
+        }
+
+
+class DiscordOutbox:
+    """チャンネルIDごとのChannelOutboxをまとめて管理する"""
+
+    def __init__(self, get_channel, log=None, **options):
+        self.get_channel = get_channel
+        self.log = log
+        self.options = options
+        self.channels = {}
+
+    def post(self, channel_id, text):
+        """イベントループ上から呼ぶ"""
+        outbox = self.channels.get(channel_id)
+        if outbox is None:
+            outbox = self.channels[channel_id] = ChannelOutbox(channel_id, self.get_channel, log=self.log, **self.options)
+        outbox.post(text)
+
+    def stats(self):
+        return {channel_id: outbox.stats() for channel_id, outbox in self.channels.items()}
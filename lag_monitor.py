@@ -0,0 +1,168 @@
+"""サーバーの負荷(Can't keep up!警告)の記録と集計
+
+- LagSeries: (時刻, ms, ticks)を固定長のリングバッファ(array)に保持する。稼働時間によらずメモリは一定
+- LagTracker: 警告の連続を「負荷の山(spike)」にまとめ、始まりと終わりだけを通知する
+- sparkline() / render_png(): /lag用のグラフ(テキストと、標準ライブラリだけで描くPNG)
+"""
+import array
+import collections
+import math
+import struct
+import time
+import zlib
+
+SPARK_BLOCKS = "▁▂▃▄▅▆▇█"
+
+# Minecraftの1秒あたりのtick数
+TICKS_PER_SECOND = 20
+
+
+class LagSeries:
+    """固定長のリングバッファ。容量を超えると古い記録から上書きする"""
+
+    def __init__(self, capacity=4096):
+        self.capacity = max(1, int(capacity))
+        self.times = array.array('d', bytes(8 * self.capacity))
+        self.ms = array.array('d', bytes(8 * self.capacity))
+        self.ticks = array.array('d', bytes(8 * self.capacity))
+        self._next = 0
+        self.count = 0
+
+    def append(self, at, ms, ticks):
+        index = self._next
+        self.times[index] = at
+        self.ms[index] = ms
+        self.ticks[index] = ticks
+        self._next = (index + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def since(self, start):
+        """start以降の記録を古い順に[(時刻, ms, ticks)]で返す"""
+        samples = []
+        index = self._next
+        for _ in range(self.count):
+            index = (index - 1) % self.capacity
+            at = self.times[index]
+            if at < start:
+                break
+            samples.append((at, self.ms[index], self.ticks[index]))
+        samples.reverse()
+        return samples
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    rank = q * (len(sorted_values) - 1)
+    lower = int(rank)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (rank - lower)
+
+
+class LagTracker:
+    """1台分の負荷の記録
+
+    警告が来たら山の始まりとして1回だけ通知し、quiet_period秒警告が来なければ山の終わりとして
+    件数・合計・最大をまとめて通知する。山の記録も直近history_size件だけを保持する。
+    """
+
+    def __init__(self, capacity=4096, quiet_period=60.0, history_size=256, clock=time.time):
+        self.series = LagSeries(capacity)
+        self.quiet_period = float(quiet_period)
+        self.spikes = collections.deque(maxlen=max(1, int(history_size)))  # (開始, 終了, 件数, 合計ms, 最大ms, 合計ticks)
+        self.clock = clock
+        self._spike = None  # 進行中の山 [開始, 最後の警告, 件数, 合計ms, 最大ms, 合計ticks]
+
+    @property
+    def in_spike(self):
+        return self._spike is not None
+
+    def record(self, ms, ticks, at=None):
+        """警告を1件記録する。山の始まりならTrue"""
+        at = self.clock() if at is None else at
+        self.series.append(at, ms, ticks)
+        spike = self._spike
+        if spike is None:
+            self._spike = [at, at, 1, ms, ms, ticks]
+            return True
+        spike[1] = at
+        spike[2] += 1
+        spike[3] += ms
+        spike[4] = max(spike[4], ms)
+        spike[5] += ticks
+        return False
+
+    def poll(self, now=None):
+        """山が終わっていれば(開始, 終了, 件数, 合計ms, 最大ms, 合計ticks)を返す"""
+        now = self.clock() if now is None else now
+        spike = self._spike
+        if spike is None or now - spike[1] < self.quiet_period:
+            return None
+        self._spike = None
+        finished = tuple(spike)
+        self.spikes.append(finished)
+        return finished
+
+    def summary(self, window, now=None):
+        """直近window秒の集計"""
+        now = self.clock() if now is None else now
+        start = now - window
+        samples = self.series.since(start)
+        values = sorted(ms for _, ms, _ in samples)
+        skipped = sum(ticks for _, _, ticks in samples)
+        spikes = sum(1 for spike in self.spikes if spike[1] >= start) + (1 if self._spike is not None else 0)
+        return {
+            'samples': len(samples),
+            'spikes': spikes,
+            'p50': percentile(values, 0.5),
+            'p95': percentile(values, 0.95),
+            'max': values[-1] if values else None,
+            'skipped_ticks': skipped,
+            # 飛んだtickの割合から見た健全度(1.0 = 飛びなし)
+            'health': max(0.0, 1.0 - skipped / (window * TICKS_PER_SECOND)) if window > 0 else 1.0,
+            # 記録が古くて窓の全体をカバーしていない場合
+            'truncated': self.series.count == self.series.capacity and bool(samples) and samples[0][0] > start,
+        }
+
+    def buckets(self, window, count, now=None):
+        """直近window秒をcount区間に分け、区間ごとの最大msを返す(警告のない区間は0)"""
+        now = self.clock() if now is None else now
+        start = now - window
+        values = [0.0] * count
+        for at, ms, _ in self.series.since(start):
+            index = min(count - 1, int((at - start) / window * count))
+            values[index] = max(values[index], ms)
+        return values
+
+
+def sparkline(values):
+    peak = max(values, default=0)
+    if peak <= 0:
+        return SPARK_BLOCKS[0] * len(values)
+    return ''.join(SPARK_BLOCKS[min(len(SPARK_BLOCKS) - 1, int(value / peak * (len(SPARK_BLOCKS) - 1) + 0.5))]
+                   for value in values)
+
+
+# --- PNG ---
+
+def _png_chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+
+def render_png(values, bar_width=6, height=80, color=(0xe0, 0x5a, 0x4f), background=(0x2b, 0x2d, 0x31)):
+    """区間ごとの値を棒グラフにしたPNG(RGB)のバイト列"""
+    width = max(1, len(values) * bar_width)
+    peak = max(values, default=0) or 1
+    heights = [math.ceil(value / peak * (height - 2)) if value > 0 else 0 for value in values]
+    bg, fg = bytes(background), bytes(color)
+    rows = []
+    for y in range(height):
+        level = height - y  # 下から数えた高さ
+        row = bytearray(b'\x00')  # フィルタ: なし
+        for bar in heights:
+            pixel = fg if bar >= level else bg
+            row += pixel * (bar_width - 1) + bg  # 棒の間に1pxの隙間
+        rows.append(bytes(row))
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    return (b'\x89PNG\r\n\x1a\n' + _png_chunk(b'IHDR', header)
+            + _png_chunk(b'IDAT', zlib.compress(b''.join(rows), 9)) + _png_chunk(b'IEND', b''))
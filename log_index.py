@@ -0,0 +1,272 @@
+"""サーバーログ(ローテーション済みの.log.gzとlatest.log)の検索用索引
+
+- ファイルはchunk_sizeずつ読み(.gzは読みながら展開し)、ファイル全体をメモリに載せない。
+- 索引はSQLite(WALモード)。イベント(時刻, 種別, プレイヤー, 内容)を(プレイヤー, 時刻)・(種別, 時刻)・時刻の
+  索引で引けるように保存し、数か月分のログでも検索はミリ秒で終わる。
+- ファイルごとの読み取り位置はイベントと同じトランザクションで保存するので、途中で止まっても続きから再開できる。
+- ファイルは先頭部分の指紋で識別する。latest.logがローテーションされて.gzになっても、読み終えた位置の続きから読む。
+"""
+import datetime
+import gzip
+import os
+import re
+import sqlite3
+import threading
+import time
+import zlib
+
+from log_tailer import FINGERPRINT_BYTES, ROTATED_LOG_PATTERN, rotated_logs, _fingerprint, _read_head
+
+# 種別は数値で保存する(追加はこの末尾に)
+EVENT_KINDS = ('chat', 'join', 'leave', 'lag', 'whitelist_add', 'whitelist_remove')
+_KIND_IDS = {kind: index for index, kind in enumerate(EVENT_KINDS)}
+
+# 行頭の時刻 ([12:34:56] または NeoForgeの [17Oct2026 12:34:56.789])
+LINE_TIME_PATTERN = re.compile(rb'^\[(?:(\d{1,2})([A-Za-z]{3})(\d{4}) )?(\d{2}):(\d{2}):(\d{2})')
+_MONTHS = {name: index for index, name in enumerate(
+    ('jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec'), 1)}
+
+# /logsearchのsince (30m, 12h, 7d, 2w または 2025-01-31 / 2025-01-31 12:00)
+_RELATIVE_PATTERN = re.compile(r'^\s*(\d+)\s*([mhdw])\s*$', re.IGNORECASE)
+_UNITS = {'m': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+
+def parse_since(text, now=None):
+    """sinceの文字列をUNIX時刻にする。解釈できなければValueError"""
+    now = time.time() if now is None else now
+    match = _RELATIVE_PATTERN.match(text)
+    if match:
+        return now - int(match.group(1)) * _UNITS[match.group(2).lower()]
+    for layout in ('%Y-%m-%d %H:%M', '%Y-%m-%d', '%m-%d %H:%M', '%m-%d'):
+        try:
+            parsed = datetime.datetime.strptime(text.strip(), layout)
+        except ValueError:
+            continue
+        if not layout.startswith('%Y'):
+            parsed = parsed.replace(year=datetime.datetime.fromtimestamp(now).year)
+        return parsed.timestamp()
+    raise ValueError(text)
+
+
+class _Clock:
+    """1ファイル分の行頭の時刻を日付付きの時刻にする。日付のない形式では、時刻が戻ったら日付を進める"""
+
+    def __init__(self, day=None, last_seconds=0):
+        self.day = day                # 日付(proleptic Gregorianの序数)
+        self.last_seconds = last_seconds
+
+    def stamp(self, line, base_day):
+        match = LINE_TIME_PATTERN.match(line)
+        if match is None:
+            return None
+        day_of_month, month, year, hour, minute, second = match.groups()
+        seconds = int(hour) * 3600 + int(minute) * 60 + int(second)
+        if year is not None:
+            try:
+                self.day = datetime.date(int(year), _MONTHS[month.decode().lower()], int(day_of_month)).toordinal()
+            except (KeyError, ValueError):
+                return None
+        elif self.day is None:
+            self.day = base_day(seconds)
+        elif seconds < self.last_seconds - 3600:
+            # 日付をまたいだ(多少の前後は同じ日とみなす)
+            self.day += 1
+        self.last_seconds = seconds
+        date = datetime.date.fromordinal(self.day)
+        return int(datetime.datetime(date.year, date.month, date.day).timestamp()) + seconds
+
+
+class LogIndex:
+    """1台分のログの索引
+
+    update()は読み取り用のスレッドから呼び、search()は別のスレッドから同時に呼んでよい
+    (書き込みと検索で接続を分け、WALで読み書きを並行させる)。
+    """
+
+    def __init__(self, path, log_file, chunk_size=65536, batch_size=2000, log=None):
+        self.path = path
+        self.log_file = log_file
+        self.directory = os.path.dirname(os.path.abspath(log_file))
+        self.chunk_size = max(4096, int(chunk_size))
+        self.batch_size = max(1, int(batch_size))
+        self.log = log or (lambda key, **kwargs: None)
+        self._stopping = False
+        self._lock = threading.Lock()  # update()を同時に1つだけ
+
+        self._writer = self._connect()
+        with self._writer:
+            self._writer.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, path TEXT NOT NULL, head_length INTEGER NOT NULL, "
+                "fingerprint TEXT NOT NULL, offset INTEGER NOT NULL, complete INTEGER NOT NULL, "
+                "day INTEGER, last_seconds INTEGER NOT NULL)")
+            self._writer.execute(
+                "CREATE TABLE IF NOT EXISTS events ("
+                "id INTEGER PRIMARY KEY, at INTEGER NOT NULL, kind INTEGER NOT NULL, "
+                "player TEXT COLLATE NOCASE, detail TEXT NOT NULL)")
+            self._writer.execute("CREATE INDEX IF NOT EXISTS events_player ON events (player, at)")
+            self._writer.execute("CREATE INDEX IF NOT EXISTS events_kind ON events (kind, at)")
+            self._writer.execute("CREATE INDEX IF NOT EXISTS events_at ON events (at)")
+        self._reader = self._connect()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    # --- 索引の更新 ---
+    def update(self, classify):
+        """未読の部分を索引に加える。(読み終えたローテーション済みファイル数, 追加したイベント数)を返す"""
+        with self._lock:
+            completed = events = 0
+            if not os.path.isdir(self.directory):
+                # ログをパイプやソケットで受け取っていて、ディレクトリが見えない場合
+                return completed, events
+            try:
+                paths = rotated_logs(self.directory)
+            except OSError as e:
+                self.log('log_index_failed', path=self.directory, error=e)
+                return completed, events
+            for path in paths + [self.log_file]:
+                if self._stopping:
+                    break
+                try:
+                    added, finished = self._update_file(path, classify)
+                except (OSError, EOFError, zlib.error, sqlite3.Error) as e:
+                    self.log('log_index_failed', path=path, error=e)
+                    continue
+                events += added
+                completed += finished
+            return completed, events
+
+    def _update_file(self, path, classify):
+        if self._writer.execute("SELECT 1 FROM files WHERE path = ? AND complete = 1", (path,)).fetchone():
+            return 0, False
+        head = _read_head(path, FINGERPRINT_BYTES)
+        if not head:
+            return 0, False
+        entry = self._match_entry(head)
+        rotated = path != self.log_file
+        if entry is None:
+            cursor = self._writer.execute(
+                "INSERT INTO files (path, head_length, fingerprint, offset, complete, day, last_seconds) "
+                "VALUES (?, ?, ?, 0, 0, NULL, 0)", (path, len(head), _fingerprint(head)))
+            entry = (cursor.lastrowid, 0, None, 0)
+        file_id, offset, day, last_seconds = entry
+        # 書き足されて先頭が伸びていれば指紋を取り直す(ローテーション後の.gzとも一致する)
+        self._writer.execute("UPDATE files SET path = ?, head_length = ?, fingerprint = ? WHERE id = ?",
+                             (path, len(head), _fingerprint(head), file_id))
+        self._writer.commit()
+
+        clock = _Clock(day, last_seconds)
+        base_day = self._base_day(path)
+        batch, added = [], 0
+        opener = gzip.open if path.endswith('.gz') else open
+        try:
+            with opener(path, 'rb') as f:
+                f.seek(offset)
+                for raw, end in self._lines(f, offset, final=rotated):
+                    offset = end
+                    event = self._event(raw, classify, clock, base_day)
+                    if event is not None:
+                        batch.append(event)
+                    if len(batch) >= self.batch_size:
+                        added += self._commit(file_id, batch, offset, clock, False)
+                        batch = []
+                        if self._stopping:
+                            return added, False
+        except (EOFError, gzip.BadGzipFile, zlib.error) as e:
+            if not rotated:
+                raise
+            # 壊れた.gzは読めた所までを索引に入れ、読み終えたことにする(再起動のたびに同じファイルで止まらない)
+            self.log('log_index_failed', path=path, error=e)
+        added += self._commit(file_id, batch, offset, clock, rotated)
+        return added, rotated
+
+    def _match_entry(self, head):
+        """読み終えていないファイルのうち、先頭の指紋が一致するもの(ローテーション前のlatest.logなど)"""
+        for file_id, head_length, fingerprint, offset, day, last_seconds in self._writer.execute(
+                "SELECT id, head_length, fingerprint, offset, day, last_seconds FROM files WHERE complete = 0"):
+            if len(head) >= head_length and _fingerprint(head[:head_length]) == fingerprint:
+                return file_id, offset, day, last_seconds
+        return None
+
+    def _base_day(self, path):
+        """日付のない形式の最初の行の日付を決める関数を返す"""
+        match = ROTATED_LOG_PATTERN.match(os.path.basename(path))
+        if match:
+            day = datetime.date.fromisoformat(match.group(1)).toordinal()
+            return lambda seconds: day
+        # latest.logは更新時刻の日付(最初の行がそれより後の時刻なら前日)。数日分を含む場合は近似になる
+        modified = datetime.datetime.fromtimestamp(os.stat(path).st_mtime)
+        modified_seconds = modified.hour * 3600 + modified.minute * 60 + modified.second
+        day = modified.date().toordinal()
+        return lambda seconds: day - 1 if seconds > modified_seconds else day
+
+    def _lines(self, f, offset, final):
+        """(行, 行末の位置)を順に返す。finalでなければ改行のない最後の断片は次回に回す"""
+        partial = b''
+        while True:
+            data = f.read(self.chunk_size)
+            if not data:
+                break
+            lines = (partial + data).split(b'\n')
+            partial = lines.pop()
+            for raw in lines:
+                offset += len(raw) + 1
+                yield raw, offset
+        if final and partial:
+            yield partial, offset + len(partial)
+
+    def _event(self, raw, classify, clock, base_day):
+        at = clock.stamp(raw, base_day)
+        result = classify(raw.rstrip(b'\r').decode('utf-8', errors='ignore'))
+        if result is None or at is None:
+            return None
+        kind, groups = result
+        if kind not in _KIND_IDS:
+            return None
+        if kind == 'lag':
+            player, detail = None, f"{groups[0]}ms / {groups[1]} ticks"
+        elif kind == 'chat':
+            player, detail = groups[0], groups[1]
+        else:
+            player, detail = groups[0], ''
+        return at, _KIND_IDS[kind], player, detail
+
+    def _commit(self, file_id, batch, offset, clock, complete):
+        with self._writer:
+            self._writer.executemany("INSERT INTO events (at, kind, player, detail) VALUES (?, ?, ?, ?)", batch)
+            self._writer.execute("UPDATE files SET offset = ?, day = ?, last_seconds = ?, complete = ? WHERE id = ?",
+                                 (offset, clock.day, clock.last_seconds, int(complete), file_id))
+        return len(batch)
+
+    # --- 検索 ---
+    def search(self, player=None, kind=None, since=None, limit=500):
+        """新しい順に最大limit件の[(時刻, 種別, プレイヤー, 内容)]"""
+        conditions, params = [], []
+        if player:
+            conditions.append("player = ?")
+            params.append(player)
+        if kind:
+            conditions.append("kind = ?")
+            params.append(_KIND_IDS[kind])
+        if since is not None:
+            conditions.append("at >= ?")
+            params.append(int(since))
+        query = "SELECT at, kind, player, detail FROM events"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        rows = self._reader.execute(query + " ORDER BY at DESC, id DESC LIMIT ?", params + [limit])
+        return [(at, EVENT_KINDS[kind], player, detail) for at, kind, player, detail in rows]
+
+    def stop(self):
+        """進行中のupdate()を次のバッチの区切りで止める"""
+        self._stopping = True
+
+    def close(self):
+        self.stop()
+        with self._lock:
+            self._writer.close()
+            self._reader.close()
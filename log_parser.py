@@ -0,0 +1,128 @@
+"""サーバーログ行の分類器(文字列による事前絞り込み + 単一の結合正規表現)"""
+import re
+
+try:
+    from re import _parser as sre_parse, _constants as sre_constants
+except ImportError:  # Python 3.10以前
+    import sre_parse
+    import sre_constants
+
+# settings.regex_patternsのうち、ログ行の監視に使うキー(この順で優先)
+LOG_EVENT_KINDS = ('chat', 'lag', 'join', 'leave', 'whitelist_add', 'whitelist_remove')
+
+
+def required_literals(pattern):
+    """マッチする行に必ず含まれる固定文字列を正規表現から抜き出す(長い順)
+
+    トップレベルと、その直下のグループ内で連続するリテラルだけを対象にする。
+    分岐や繰り返しの中身、大文字小文字を無視するフラグ付きの部分は対象外。
+    """
+    try:
+        parsed = sre_parse.parse(pattern)
+    except re.error:
+        return []
+    if parsed.state.flags & re.IGNORECASE:
+        return []
+
+    literals = []
+    current = []
+
+    def flush():
+        if current:
+            literals.append(''.join(current))
+            current.clear()
+
+    def walk(items):
+        for op, av in items:
+            if op is sre_constants.LITERAL:
+                current.append(chr(av))
+            elif op is sre_constants.SUBPATTERN and not (av[1] & re.IGNORECASE):
+                walk(av[-1])
+            else:
+                flush()
+
+    walk(parsed)
+    flush()
+    return sorted(set(literals), key=len, reverse=True)
+
+
+class LogLineClassifier:
+    """ログ行をchat/lag/join/leave等に分類する
+
+    1. 各パターンの必須リテラルが行に含まれるかを `in` で調べ、候補を絞る(大半の行はここで終わる)
+    2. 候補が1つならその正規表現、複数なら名前付きグループで束ねた結合正規表現で1回だけ検索する
+    """
+
+    def __init__(self, patterns, kinds=LOG_EVENT_KINDS):
+        self.kinds = tuple(kind for kind in kinds if patterns.get(kind))
+        self.patterns = {kind: re.compile(patterns[kind]) for kind in self.kinds}
+        literals = {kind: required_literals(patterns[kind]) for kind in self.kinds}
+        # 他の種別と共通のリテラル("[Server thread/INFO]"など)は絞り込み効果が薄いので後回しにする
+        shared = {}
+        for kind_literals in literals.values():
+            for literal in kind_literals:
+                shared[literal] = shared.get(literal, 0) + 1
+        self.literals = {kind: sorted(kind_literals, key=lambda literal: (shared[literal], -len(literal)))
+                         for kind, kind_literals in literals.items()}
+        # 必須リテラルを持たないパターンは常に候補になる
+        self._always = tuple(kind for kind in self.kinds if not self.literals[kind])
+        self._filtered = tuple(kind for kind in self.kinds if self.literals[kind])
+        # 各種別で最も絞り込める1語だけの関門。どれも含まない行(大半)はここで捨てる
+        self._gate = () if self._always else tuple({self.literals[kind][0] for kind in self._filtered})
+        self._combined_cache = {}
+
+    def _combined(self, kinds):
+        """候補の組み合わせごとに結合正規表現を作る。(正規表現, グループ番号 -> (種別, 開始, 個数))"""
+        cached = self._combined_cache.get(kinds)
+        if cached is not None:
+            return cached
+        parts, dispatch, index = [], {}, 1
+        for kind in kinds:
+            compiled = self.patterns[kind]
+            parts.append(f'(?P<{kind}>{compiled.pattern})')
+            dispatch[index] = (kind, index + 1, compiled.groups)
+            index += compiled.groups + 1
+        try:
+            combined = re.compile('|'.join(parts))
+        except re.error:
+            # 番号付き後方参照や名前の重複などで結合できない場合は個別検索にする
+            combined = None
+        self._combined_cache[kinds] = (combined, dispatch)
+        return combined, dispatch
+
+    def classify(self, line):
+        """(種別, グループのタプル) を返す。どれにも該当しなければNone"""
+        # any(map(...))でループをC側に任せる(行ごとのPythonループより大幅に速い)
+        if self._gate and not any(map(line.__contains__, self._gate)):
+            return None
+        candidates = [kind for kind in self._filtered
+                      if all(literal in line for literal in self.literals[kind])]
+        if self._always:
+            candidates = [kind for kind in self.kinds if kind in self._always or kind in candidates]
+        if not candidates:
+            return None
+
+        if len(candidates) == 1:
+            kind = candidates[0]
+            match = self.patterns[kind].search(line)
+            return (kind, match.groups()) if match else None
+
+        combined, dispatch = self._combined(tuple(candidates))
+        if combined is None:
+            for kind in candidates:
+                match = self.patterns[kind].search(line)
+                if match:
+                    return kind, match.groups()
+            return None
+
+        match = combined.search(line)
+        if not match:
+            return None
+        # 外側の名前付きグループが最後に閉じるので、lastindexがどの種別かを示す
+        kind, start, count = dispatch[match.lastindex]
+        # 結合正規表現は最左一致なので、優先度の高い種別が別の位置で一致しないかだけ確認する
+        for earlier in candidates[:candidates.index(kind)]:
+            earlier_match = self.patterns[earlier].search(line)
+            if earlier_match:
+                return earlier, earlier_match.groups()
+        return kind, match.groups()[start - 1:start - 1 + count]
@@ -0,0 +1,218 @@
+"""ログ監視スレッドとBotのイベントループをつなぐ、上限付きの多段パイプライン
+
+    監視スレッド --(ingest)--> 解析 --(events)--> 加工(ローマ字変換など) --(delivery)--> 送信
+
+各段の間は上限付きキューで、あふれた場合の扱い(overflow)を段ごとに選べる。
+- block       : 空きができるまで投入側を待たせる(ログ監視スレッドは読み取りを止めるだけで行は失わない)
+- drop_oldest : 一番古いものを捨てる
+- merge_lag   : 末尾の項目と結合できれば結合する(連続するラグ警告など)。できなければblockと同じく待たせる
+"""
+import asyncio
+import collections
+import inspect
+import threading
+
+OVERFLOW_POLICIES = ('block', 'drop_oldest', 'merge_lag')
+
+
+class StageQueue:
+    """上限付きキュー。投入はイベントループ上(put)と別スレッド(put_threadsafe)の両方から、取り出しはループ上で行う"""
+
+    def __init__(self, name, maxsize, overflow='block', merge=None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy for {name}: {overflow}")
+        self.name = name
+        self.maxsize = max(1, int(maxsize))
+        self.overflow = overflow
+        self.merge = merge
+        self._items = collections.deque()
+        self._lock = threading.Lock()
+        self._not_full = threading.Condition(self._lock)
+        self._loop = None
+        self._readable = None
+        self._writable = None
+        # 統計
+        self.put_count = 0
+        self.get_count = 0
+        self.dropped = 0
+        self.merged = 0
+        self.max_depth = 0
+
+    def bind(self, loop):
+        self._loop = loop
+        self._readable = asyncio.Event()
+        self._writable = asyncio.Event()
+
+    @property
+    def depth(self):
+        return len(self._items)
+
+    def _offer(self, item):
+        """ロック取得済みで呼ぶ。追加できたらTrue、block方針で満杯ならFalse"""
+        if len(self._items) >= self.maxsize:
+            if self.overflow == 'merge_lag' and self._items and self.merge:
+                merged = self.merge(self._items[-1], item)
+                if merged is not None:
+                    self._items[-1] = merged
+                    self.merged += 1
+                    return True
+            if self.overflow != 'drop_oldest':
+                return False
+            self._items.popleft()
+            self.dropped += 1
+        self._items.append(item)
+        self.put_count += 1
+        self.max_depth = max(self.max_depth, len(self._items))
+        return True
+
+    def put_threadsafe(self, item):
+        """イベントループ以外のスレッドから呼ぶ。block方針では空きができるまでそのスレッドを待たせる"""
+        with self._not_full:
+            while not self._offer(item):
+                self._not_full.wait(timeout=1.0)
+        self._loop.call_soon_threadsafe(self._readable.set)
+
+    async def put(self, item):
+        while True:
+            with self._lock:
+                if self._offer(item):
+                    break
+                self._writable.clear()
+            await self._writable.wait()
+        self._readable.set()
+
+    async def get(self):
+        while True:
+            with self._lock:
+                if self._items:
+                    item = self._items.popleft()
+                    self.get_count += 1
+                    self._not_full.notify()
+                    break
+                self._readable.clear()
+            await self._readable.wait()
+        self._writable.set()
+        return item
+
+    def stats(self):
+        return {
+            'depth': self.depth,
+            'max_depth': self.max_depth,
+            'in': self.put_count,
+            'out': self.get_count,
+            'dropped': self.dropped,
+            'merged': self.merged,
+        }
+
+
+def merge_lag_events(previous, new):
+    """連続するラグ警告(kind, (ms, ticks))を、大きい方の値を残して1件にまとめる"""
+    if previous[0] != 'lag' or new[0] != 'lag':
+        return None
+    try:
+        ms = max(int(previous[1][0]), int(new[1][0]))
+        ticks = max(int(previous[1][1]), int(new[1][1]))
+    except (ValueError, IndexError):
+        return None
+    return 'lag', (str(ms), str(ticks)) + tuple(new[1][2:])
+
+
+class LogPipeline:
+    """ログ行を 解析 -> 加工 -> 送信 の順に流す
+
+    classify(line)        -> (kind, groups) または None
+    dispatch(kind, groups)-> 送信内容、コルーチン(加工が必要な場合)、または None
+    deliver(result)       -> 送信内容を受け取る非同期関数
+
+    加工(コルーチン)は最大enrich_concurrency個まで並行に走るが、送信は投入順に行う。
+    """
+
+    def __init__(self, classify, dispatch, deliver, ingest_size=10000, ingest_overflow='block',
+                 event_size=5000, event_overflow='merge_lag', enrich_concurrency=4, delivery_size=1000,
+                 log=None):
+        self.classify = classify
+        self.dispatch = dispatch
+        self.deliver = deliver
+        self.log = log or (lambda key, **kwargs: None)
+        self.ingest = StageQueue('ingest', ingest_size, ingest_overflow)
+        self.events = StageQueue('events', event_size, event_overflow, merge=merge_lag_events)
+        # 送信段は順序を保つためfutureを並べるので、あふれても捨てずに待たせる
+        self.delivery = StageQueue('delivery', delivery_size, 'block')
+        self.enrich_concurrency = max(1, int(enrich_concurrency))
+        self._semaphore = None
+        self._tasks = []
+        self.counters = collections.Counter()
+
+    def start(self, loop):
+        if self._tasks:
+            return
+        for queue in (self.ingest, self.events, self.delivery):
+            queue.bind(loop)
+        self._semaphore = asyncio.Semaphore(self.enrich_concurrency)
+        self._tasks = [loop.create_task(worker()) for worker in (self._parse_worker, self._enrich_worker, self._delivery_worker)]
+
+    def submit_threadsafe(self, line):
+        """ログ監視スレッドから1行投入する"""
+        self.ingest.put_threadsafe(line)
+
+    async def _parse_worker(self):
+        while True:
+            line = await self.ingest.get()
+            try:
+                classified = self.classify(line)
+            except Exception as e:
+                self.counters['parse_errors'] += 1
+                self.log('log_processing_error', error=e)
+                continue
+            self.counters['lines_parsed'] += 1
+            if classified:
+                self.counters['lines_matched'] += 1
+                await self.events.put(classified)
+
+    async def _run_enrichment(self, coroutine):
+        async with self._semaphore:
+            return await coroutine
+
+    async def _enrich_worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            kind, groups = await self.events.get()
+            try:
+                result = self.dispatch(kind, groups)
+            except Exception as e:
+                self.counters['enrich_errors'] += 1
+                self.log('log_processing_error', error=e)
+                continue
+            if result is None:
+                continue
+            if inspect.isawaitable(result):
+                self.counters['enrich_started'] += 1
+                future = loop.create_task(self._run_enrichment(result))
+            else:
+                future = loop.create_future()
+                future.set_result(result)
+            # 完了順ではなく投入順に送信段へ並べる
+            await self.delivery.put(future)
+
+    async def _delivery_worker(self):
+        while True:
+            future = await self.delivery.get()
+            try:
+                result = await future
+            except Exception as e:
+                self.counters['enrich_errors'] += 1
+                self.log('log_processing_error', error=e)
+                continue
+            if result is None:
+                continue
+            try:
+                await self.deliver(result)
+                self.counters['delivered'] += 1
+            except Exception as e:
+                self.counters['delivery_errors'] += 1
+                self.log('log_processing_error', error=e)
+
+    def stats(self):
+        stats = {queue.name: queue.stats() for queue in (self.ingest, self.events, self.delivery)}
+        stats['counters'] = dict(self.counters)
+        return stats
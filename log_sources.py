@@ -0,0 +1,360 @@
+"""ログ行の取り込み口(LogSource)
+
+どの取り込み口も自分のスレッドで行を読み、確定した1行ずつをstart(submit)で渡されたsubmit(line)に渡す
+(LogPipeline.submit_threadsafe。パイプラインが満杯ならその場で待たされる)。
+
+- watchdog: ファイルの変更通知ごとに、開いたままのファイルから続きを読む(従来の方式)
+- poll    : 通知を使わず、サイズ・inodeの変化を間隔を変えながら確認する(overlayやネットワークボリューム向け)
+- pipe    : 標準入力または名前付きパイプから読む
+- tcp/udp : ローカルのポートで行を受け取る(サーバーのコンソール出力やログ転送ツールから)
+
+lag_bytes()は、書かれた(届いた)がまだ読んでいないバイト数。ファイルはサイズと読み取り位置の差、
+パイプとソケットはカーネルのバッファに残っている量(FIONREAD)で数える。
+"""
+import abc
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+
+from watchdog.events import FileSystemEventHandler
+
+try:
+    import fcntl
+    import termios
+except ImportError:  # Windows (パイプとソケットの未読量は数えない)
+    fcntl = termios = None
+
+LOG_SOURCE_TYPES = ('watchdog', 'poll', 'pipe', 'tcp', 'udp')
+
+# 停止の確認間隔(ソケットの待ち受けのタイムアウト)
+_STOP_CHECK_SECONDS = 0.5
+_RECV_BYTES = 65536
+
+
+def _pending_bytes(fd):
+    """fd(パイプ・ソケット)のカーネルのバッファに残っているバイト数"""
+    if fcntl is None or fd is None:
+        return 0
+    try:
+        return struct.unpack('i', fcntl.ioctl(fd, termios.FIONREAD, b'\0\0\0\0'))[0]
+    except (OSError, ValueError):
+        return 0
+
+
+class LogSource(abc.ABC):
+    """取り込み口の共通インターフェース"""
+
+    kind = ''
+
+    def __init__(self, name, log=None):
+        self.name = name
+        self.log = log or (lambda key, **kwargs: None)
+        self.lines_read = 0
+        self.last_line_at = None
+        self._submit = None
+        self._stopping = False
+        self._thread = None
+
+    def describe(self):
+        return f"{self.kind} {self.name}"
+
+    def start(self, submit):
+        self._submit = submit
+        self._thread = threading.Thread(target=self._run, name=f"log-source-{self.kind}", daemon=True)
+        self._thread.start()
+
+    @abc.abstractmethod
+    def _run(self):
+        """読み取りスレッドの本体。stop()されるまで行を読んで_emitする"""
+
+    def _emit(self, raw):
+        self._submit(raw.rstrip(b'\r\n').decode('utf-8', errors='ignore'))
+        self.lines_read += 1
+        self.last_line_at = time.monotonic()
+
+    def lag_bytes(self):
+        return 0
+
+    def stop(self):
+        self._stopping = True
+
+    def stats(self):
+        return {'lines_read': self.lines_read, 'lag_bytes': self.lag_bytes()}
+
+
+# --- ファイル ---
+class TailingSource(LogSource):
+    """LogTailerでファイルを読む取り込み口の共通部分。wakeup()で読み取りスレッドに続きを読ませる"""
+
+    def __init__(self, tailer, on_batch=None, log=None):
+        super().__init__(tailer.path, log)
+        self.tailer = tailer
+        # on_batch(秒, 行数): 1回の読み取りごとに呼ぶ(計測用)
+        self.on_batch = on_batch or (lambda seconds, count: None)
+        self._wakeup = threading.Event()
+
+    def start(self, submit):
+        super().start(submit)
+        # 停止中に書かれた行があれば、最初の通知を待たずに追いつく
+        self.wakeup()
+
+    def wakeup(self):
+        self._wakeup.set()
+
+    def read_available(self):
+        """書かれている分を読み切る。行はチャンク単位で読まれるので、バックログが大きくても一度に全部は読み込まない"""
+        started = time.perf_counter()
+        count = 0
+        try:
+            for line in self.tailer.read_lines():
+                self._submit(line)
+                count += 1
+        except Exception as e:
+            self.log('log_processing_error', error=e)
+        if count:
+            self.lines_read += count
+            self.last_line_at = time.monotonic()
+        self.on_batch(time.perf_counter() - started, count)
+        return count
+
+    def _run(self):
+        # 読み取り中に届いた通知はまとめて次の1回で処理する
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            if self._stopping:
+                return
+            self.read_available()
+
+    def lag_bytes(self):
+        try:
+            return max(0, os.path.getsize(self.tailer.path) - self.tailer.offset)
+        except OSError:
+            return 0
+
+    def stop(self):
+        """読み取りスレッドを止め、読み取り位置を保存する"""
+        super().stop()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        self.tailer.close()
+
+
+class WatchdogSource(TailingSource, FileSystemEventHandler):
+    """watchdogの変更通知で読む。監視スレッド(observer)は全サーバーで共有する"""
+
+    kind = 'watchdog'
+
+    def __init__(self, tailer, observer, on_batch=None, log=None):
+        TailingSource.__init__(self, tailer, on_batch=on_batch, log=log)
+        self.observer = observer
+
+    def describe(self):
+        return self.tailer.path
+
+    def start(self, submit):
+        super().start(submit)
+        # ログファイルのあるディレクトリを監視対象にする
+        directory = os.path.dirname(os.path.abspath(self.tailer.path))
+        if not os.path.exists(directory):
+            self.log('log_dir_not_found', directory=directory)
+            return
+        self.observer.schedule(self, directory, recursive=False)
+
+    def on_modified(self, event):
+        # 同じディレクトリを複数のサーバーが監視していても、自分のログファイル以外は無視する
+        if not os.path.abspath(event.src_path) == os.path.abspath(self.tailer.path): return
+        self.wakeup()
+
+    # ローテーションで新しいlatest.logが作られた場合も同じ処理で追いかける
+    on_created = on_modified
+
+
+class PollingSource(TailingSource):
+    """変更通知を使わずに確認する。ファイルは開いたままにし、変化がなければ読まない
+
+    (dev, inode, サイズ, 更新時刻)が変わったときだけ読み、読めた間はmin_interval、
+    変化のない間は確認の間隔をmax_intervalまで倍々に延ばす。
+    """
+
+    kind = 'poll'
+
+    def __init__(self, tailer, min_interval=0.1, max_interval=2.0, on_batch=None, log=None):
+        super().__init__(tailer, on_batch=on_batch, log=log)
+        self.min_interval = max(0.01, float(min_interval))
+        self.max_interval = max(self.min_interval, float(max_interval))
+        self.interval = self.min_interval
+        self._last_stat = None
+
+    def describe(self):
+        return f"{self.tailer.path} (poll {self.min_interval:g}-{self.max_interval:g}s)"
+
+    def _changed(self):
+        try:
+            stat = os.stat(self.tailer.path)
+        except OSError:
+            return False  # ローテーション中で一時的に存在しない
+        key = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        changed = key != self._last_stat
+        self._last_stat = key
+        return changed
+
+    def _run(self):
+        while not self._stopping:
+            count = self.read_available() if self._changed() else 0
+            self.interval = self.min_interval if count else min(self.max_interval, self.interval * 2)
+            # wakeup()(起動時の追いつきなど)があれば待たずに確認する
+            if self._wakeup.wait(self.interval):
+                self._wakeup.clear()
+                self._last_stat = None
+
+
+# --- ストリーム ---
+class PipeSource(LogSource):
+    """標準入力("-")または名前付きパイプから読む。名前付きパイプは書き手が閉じても開き直して次の書き手を待つ"""
+
+    kind = 'pipe'
+
+    def __init__(self, path='-', log=None):
+        super().__init__(path, log)
+        self._file = None
+
+    def describe(self):
+        return "stdin" if self.name == '-' else f"pipe {self.name}"
+
+    def _run(self):
+        while not self._stopping:
+            try:
+                # 名前付きパイプは書き手が開くまでここで待つ
+                self._file = sys.stdin.buffer if self.name == '-' else open(self.name, 'rb')
+            except OSError as e:
+                self.log('log_source_failed', source=self.describe(), error=e)
+                time.sleep(5)
+                continue
+            try:
+                for raw in self._file:
+                    self._emit(raw)
+                    if self._stopping:
+                        return
+            except (OSError, ValueError) as e:
+                self.log('log_source_failed', source=self.describe(), error=e)
+            if self.name == '-':
+                self.log('log_source_closed', source=self.describe())
+                return
+            self._file.close()
+
+    def lag_bytes(self):
+        try:
+            return _pending_bytes(self._file.fileno()) if self._file is not None else 0
+        except (OSError, ValueError):
+            return 0
+
+
+class SocketSource(LogSource):
+    """ローカルのポートで行を受け取る
+
+    tcp: 接続ごとにスレッドを立て、改行までを1行とする(同時に複数の送り手を受け付ける)
+    udp: 1つのデータグラムに1行以上(末尾の改行は省略可)
+    """
+
+    def __init__(self, protocol, host='127.0.0.1', port=25585, log=None):
+        super().__init__(f"{host}:{port}", log)
+        self.kind = protocol
+        self.address = (host, int(port))
+        self._socket = None
+        self._connections = {}  # socket -> 未確定の断片
+        self._lock = threading.Lock()
+
+    def describe(self):
+        return f"{self.kind}://{self.name}"
+
+    def start(self, submit):
+        try:
+            if self.kind == 'tcp':
+                self._socket = socket.create_server(self.address)
+            else:
+                family = socket.getaddrinfo(*self.address, type=socket.SOCK_DGRAM)[0][0]
+                self._socket = socket.socket(family, socket.SOCK_DGRAM)
+                self._socket.bind(self.address)
+        except OSError as e:
+            self.log('log_source_failed', source=self.describe(), error=e)
+            return
+        self._socket.settimeout(_STOP_CHECK_SECONDS)
+        super().start(submit)
+
+    def _run(self):
+        if self.kind == 'tcp':
+            self._accept_loop()
+        else:
+            self._datagram_loop()
+
+    def _accept_loop(self):
+        while not self._stopping:
+            try:
+                connection, _ = self._socket.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            connection.settimeout(_STOP_CHECK_SECONDS)
+            with self._lock:
+                self._connections[connection] = b''
+            threading.Thread(target=self._read_connection, args=(connection,), name="log-source-tcp-conn", daemon=True).start()
+
+    def _read_connection(self, connection):
+        partial = b''
+        try:
+            while not self._stopping:
+                try:
+                    data = connection.recv(_RECV_BYTES)
+                except socket.timeout:
+                    continue
+                if not data:
+                    break
+                lines = (partial + data).split(b'\n')
+                partial = lines.pop()
+                for raw in lines:
+                    self._emit(raw)
+                with self._lock:
+                    self._connections[connection] = partial
+            if partial:
+                self._emit(partial)
+        except OSError:
+            pass
+        finally:
+            with self._lock:
+                self._connections.pop(connection, None)
+            connection.close()
+
+    def _datagram_loop(self):
+        while not self._stopping:
+            try:
+                data = self._socket.recv(_RECV_BYTES)
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            for raw in data.rstrip(b'\n').split(b'\n'):
+                if raw:
+                    self._emit(raw)
+
+    def lag_bytes(self):
+        if self._socket is None:
+            return 0
+        if self.kind == 'udp':
+            # Linuxでは次のデータグラムの大きさ(それ以降の分は含まない)
+            return _pending_bytes(self._socket.fileno())
+        with self._lock:
+            return sum(_pending_bytes(connection.fileno()) + len(partial)
+                       for connection, partial in self._connections.items())
+
+    def stop(self):
+        super().stop()
+        if self._thread is not None:
+            self._thread.join(timeout=_STOP_CHECK_SECONDS * 4)
+        if self._socket is not None:
+            self._socket.close()
@@ -0,0 +1,280 @@
+"""ローテーション・切り詰めに強いログ追跡と、読み取り位置のチェックポイント保存"""
+import gzip
+import hashlib
+import json
+import os
+import re
+import time
+import zlib
+
+# ファイルの同一性確認に使う先頭部分のバイト数
+FINGERPRINT_BYTES = 1024
+# Minecraft(log4j)がlatest.logをローテーションしたときの名前 (例: 2025-01-31-2.log.gz)
+ROTATED_LOG_PATTERN = re.compile(r'^(\d{4}-\d{2}-\d{2})-(\d+)\.log(?:\.gz)?$')
+
+
+def rotated_logs(directory):
+    """ディレクトリ内のローテーション済みログを古い順に返す(debug-N.log.gzなどは含めない)"""
+    found = []
+    for name in os.listdir(directory):
+        match = ROTATED_LOG_PATTERN.match(name)
+        if match:
+            found.append((match.group(1), int(match.group(2)), os.path.join(directory, name)))
+    return [path for _, _, path in sorted(found)]
+
+
+def _fingerprint(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def _read_head(path, length):
+    """ファイル(.gzなら展開後)の先頭lengthバイトを読む"""
+    opener = gzip.open if path.endswith('.gz') else open
+    try:
+        with opener(path, 'rb') as f:
+            return f.read(length)
+    except (OSError, EOFError):
+        return b''
+
+
+class LogTailer:
+    """latest.logを追跡し、確定した行(改行まで書かれた行)だけを返す
+
+    - ファイルハンドルを開いたままにし、inode(dev, ino)の変化でローテーションを検出する。
+      ローテーション時は古いハンドルの残りを読み切ってから新しいファイルへ切り替える。
+    - サイズが読み取り位置より小さくなったら切り詰めとみなし、先頭から読み直す。
+    - (ファイルの先頭指紋, 読み取り位置)をチェックポイントとして保存し、再起動時はそこから追いつく。
+      停止中にローテーションされていた場合は、指紋が一致する圧縮済みログから続きを読む。
+      読みかけのローテーション済みログ(backlog)とその読み取り位置もチェックポイントに含める。
+    - 読み取りはchunk_sizeごとに行い、バックログが大きくてもメモリ使用量は一定に保つ。
+    """
+
+    def __init__(self, path, checkpoint_path=None, chunk_size=65536, checkpoint_interval=5.0, log=None):
+        self.path = path
+        self.checkpoint_path = checkpoint_path
+        self.chunk_size = max(4096, int(chunk_size))
+        self.checkpoint_interval = float(checkpoint_interval)
+        self.log = log or (lambda key, **kwargs: None)
+
+        self._file = None
+        self._file_id = None
+        self.offset = 0          # 確定した行の末尾までのバイト位置
+        self._partial = b''      # 改行がまだ書かれていない行の断片
+        self._head = b''         # 指紋計算用のファイル先頭
+        self._backlog = []       # 停止中にローテーションされたファイル [(path, offset), ...]
+        self._leftover = b''
+        self._last_checkpoint = 0.0
+
+        checkpoint = self._load_checkpoint()
+        if checkpoint:
+            self._resume(checkpoint)
+        else:
+            # チェックポイントがなければ従来通りファイル末尾から開始する
+            self._open(seek_end=True)
+
+    # --- チェックポイント ---
+    def _load_checkpoint(self):
+        if not self.checkpoint_path or not os.path.exists(self.checkpoint_path):
+            return None
+        try:
+            with open(self.checkpoint_path, 'r', encoding='utf-8') as f:
+                checkpoint = json.load(f)
+            return checkpoint if {'offset', 'fingerprint', 'head_length'} <= checkpoint.keys() else None
+        except (OSError, ValueError):
+            return None
+
+    def save_checkpoint(self, force=False):
+        # ローテーションの途中(古いファイルを閉じ、新しいファイルを開く前)は、古いファイルの位置を保存する
+        if not self.checkpoint_path or self._file_id is None:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_checkpoint < self.checkpoint_interval:
+            return
+        self._last_checkpoint = now
+        if self._file is not None and len(self._head) < FINGERPRINT_BYTES:
+            self._refresh_head()
+        checkpoint = {
+            'path': os.path.abspath(self.path),
+            'dev': self._file_id[0],
+            'ino': self._file_id[1],
+            'offset': self.offset,
+            'head_length': len(self._head),
+            'fingerprint': _fingerprint(self._head),
+            'backlog': [[path, offset] for path, offset in self._backlog],
+        }
+        # 書き込み途中で落ちても壊れないよう、一時ファイルに書いてから置き換える
+        tmp_path = f"{self.checkpoint_path}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(checkpoint, f)
+            os.replace(tmp_path, self.checkpoint_path)
+        except OSError as e:
+            self.log('log_checkpoint_failed', error=e)
+
+    def _resume(self, checkpoint):
+        # 前回読みかけだったローテーション済みログ(消されたものは除く)
+        saved_backlog = [(path, offset) for path, offset in checkpoint.get('backlog', ()) if os.path.exists(path)]
+        head_length = checkpoint['head_length']
+        current_head = _read_head(self.path, head_length)
+        if len(current_head) == head_length and _fingerprint(current_head) == checkpoint['fingerprint']:
+            # 同じファイルが続いている。切り詰められていれば先頭から
+            self._backlog = saved_backlog
+            self._open()
+            if self._file is not None:
+                size = os.fstat(self._file.fileno()).st_size
+                self.offset = checkpoint['offset'] if checkpoint['offset'] <= size else 0
+                self._file.seek(self.offset)
+            self.log('log_catchup_started', path=self._backlog[0][0] if self._backlog else self.path,
+                     offset=self._backlog[0][1] if self._backlog else self.offset)
+            return
+
+        # 停止中にローテーションされた: 指紋が一致する過去ログを探し、その続き→以降のログ→latest.logの順に読む
+        directory = os.path.dirname(os.path.abspath(self.path))
+        try:
+            rotated = rotated_logs(directory)
+        except OSError:
+            rotated = []
+        for index, candidate in enumerate(rotated):
+            head = _read_head(candidate, head_length)
+            if len(head) == head_length and _fingerprint(head) == checkpoint['fingerprint']:
+                backlog = dict([(candidate, checkpoint['offset'])] + [(p, 0) for p in rotated[index + 1:]])
+                # 読みかけのものは保存した位置から(古いものも含め、ローテーションされた順に読む)
+                backlog.update(saved_backlog)
+                order = {path: position for position, path in enumerate(rotated)}
+                self._backlog = sorted(backlog.items(), key=lambda entry: order.get(entry[0], -1))
+                self.log('log_catchup_started', path=self._backlog[0][0], offset=self._backlog[0][1])
+                break
+        else:
+            self._backlog = saved_backlog
+            self.log('log_rotated_file_not_found', directory=directory)
+        self._open()
+
+    # --- ファイル操作 ---
+    def _open(self, seek_end=False):
+        try:
+            f = open(self.path, 'rb')
+        except OSError:
+            return
+        stat = os.fstat(f.fileno())
+        self._file, self._file_id = f, (stat.st_dev, stat.st_ino)
+        self._partial = b''
+        self._head = b''
+        self.offset = stat.st_size if seek_end else 0
+        f.seek(self.offset)
+        self._refresh_head()
+
+    def _refresh_head(self):
+        position = self._file.tell()
+        self._file.seek(0)
+        self._head = self._file.read(FINGERPRINT_BYTES)
+        self._file.seek(position)
+
+    def _read_handle(self, f, offset, partial=b''):
+        """fの現在位置から末尾までをchunk_sizeずつ読み、(確定した行, その行末の位置)を返す
+
+        offsetはpartial(前回までの未確定の断片)の先頭位置。読み終えた時点の断片はself._leftoverに残す。
+        """
+        while True:
+            data = f.read(self.chunk_size)
+            if not data:
+                break
+            lines = (partial + data).split(b'\n')
+            partial = lines.pop()
+            for raw in lines:
+                offset += len(raw) + 1
+                yield raw.rstrip(b'\r').decode('utf-8', errors='ignore'), offset
+        self._leftover = partial
+
+    def _queue_missed_rotations(self):
+        """読み終えたファイルの圧縮後(先頭の指紋が一致するもの)より新しいローテーション済みログをbacklogに積む"""
+        if len(self._head) < FINGERPRINT_BYTES:
+            self._refresh_head()
+        if not self._head:
+            return
+        try:
+            rotated = rotated_logs(os.path.dirname(os.path.abspath(self.path)))
+        except OSError:
+            return
+        for index in range(len(rotated) - 1, -1, -1):
+            if _read_head(rotated[index], len(self._head)) == self._head:
+                queued = {path for path, _ in self._backlog}
+                self._backlog.extend((path, 0) for path in rotated[index + 1:] if path not in queued)
+                return
+
+    def _drain_backlog(self):
+        """ローテーション済みログを順に読む。途中で止められた(ジェネレータが閉じられた)ら、次回はその続きから"""
+        while self._backlog:
+            path, offset = self._backlog[0]
+            opener = gzip.open if path.endswith('.gz') else open
+            try:
+                with opener(path, 'rb') as f:
+                    f.seek(offset)
+                    for line, end in self._read_handle(f, offset):
+                        self._backlog[0] = (path, end)
+                        yield line
+                        self.save_checkpoint()
+                    # ローテーション済みファイルの末尾に改行のない行が残っていれば、それも確定とみなす
+                    if self._leftover:
+                        self._backlog[0] = (path, self._backlog[0][1] + len(self._leftover))
+                        yield self._leftover.decode('utf-8', errors='ignore')
+            except (OSError, EOFError, zlib.error) as e:
+                # 壊れた.gzは読める所までで諦め、latest.logの読み取りを止めない
+                self.log('log_processing_error', error=e)
+            # 読み終えた(または読めなかった)ファイルだけを外す
+            self._backlog.pop(0)
+
+    def _drain_current(self):
+        for line, offset in self._read_handle(self._file, self.offset, self._partial):
+            self.offset = offset
+            self._partial = b''
+            yield line
+        self._partial = self._leftover
+
+    def read_lines(self):
+        """新しく確定した行を順に返すジェネレータ"""
+        yield from self._drain_backlog()
+
+        if self._file is None:
+            self._open()
+            if self._file is None:
+                return
+
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            stat = None  # ローテーション中で一時的に存在しない
+
+        if stat is not None and (stat.st_dev, stat.st_ino) != self._file_id:
+            # ローテーション: 古いファイルの残りを読み切ってから切り替える
+            yield from self._drain_current()
+            if self._partial:
+                partial, self._partial = self._partial, b''
+                self.offset += len(partial)
+                yield partial.decode('utf-8', errors='ignore')
+            # 前回の読み取りから複数回ローテーションされていれば、間のファイルも順に読む
+            self._queue_missed_rotations()
+            self._file.close()
+            # 新しいファイルを開くまでは、チェックポイントは古いファイルの読み終えた位置を指す
+            self._file = None
+            self.log('log_rotated', path=self.path)
+            yield from self._drain_backlog()
+            self._open()
+            if self._file is None:
+                return
+        elif stat is not None and stat.st_size < self.offset + len(self._partial):
+            # 切り詰め: 先頭から読み直す
+            self.log('log_truncated', path=self.path)
+            self.offset = 0
+            self._partial = b''
+            self._head = b''
+            self._file.seek(0)
+            self._refresh_head()
+
+        yield from self._drain_current()
+        self.save_checkpoint()
+
+    def close(self):
+        self.save_checkpoint(force=True)
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -1,28 +1,38 @@
 import discord
+import io
 import os
-import json
-import ruamel.yaml
 import shutil
 import copy
 import re
 import asyncio
-import requests
+import time
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 from dotenv import load_dotenv
-from rcon.source import Client
+from rcon_pool import RconPool, RconError
+from log_tailer import LogTailer
+from log_sources import WatchdogSource, PollingSource, PipeSource, SocketSource
+from discord_outbox import DiscordOutbox
+from server_chat import ServerChatOutbox, text_component, link_component
+from log_pipeline import LogPipeline
+from yahoo_converter import YahooConverter
+from romaji import RomajiEngine
+from whitelist_state import WhitelistState
+from whitelist_store import open_store
+from member_names import MemberNameResolver
+from player_pages import PlayerPages, MAX_FIELDS_PER_PAGE
+from lag_monitor import LagTracker, sparkline, render_png
+from player_sessions import PlaytimeStore, SessionIndex
+from log_index import LogIndex, EVENT_KINDS, parse_since
+from metrics import MetricsRegistry, SamplingProfiler, serve_metrics, monitor_event_loop
+from config import load_config, ConfigError, describe_diff, restart_required_changes
 
 # .envを読み込み
 load_dotenv()
 
 DISCORD_BOT_TOKEN = os.getenv("DISCORD_BOT_TOKEN")
-RCON_HOST = os.getenv("RCON_HOST")
-RCON_PORT = int(os.getenv("RCON_PORT"))
-RCON_PASSWORD = os.getenv("RCON_PASSWORD")
-
 YAHOO_APPID = os.getenv("YAHOO_APPID")
-CHANNEL_ID = int(os.getenv('CHANNEL_ID'))
-LOG_FILE_PATH = os.getenv('LOG_FILE_PATH', 'logs/latest.log')
+# RCON_HOST/RCON_PORT/RCON_PASSWORD/CHANNEL_ID/LOG_FILE_PATHは、settings.serversが空の場合(1台構成)に使う
 
 GUILD_IDS = None
 
@@ -38,150 +48,228 @@ if not os.path.exists(USER_CONFIG_FILE):
         print(f"FATAL: Default config file '{DEFAULT_CONFIG_FILE}' not found.")
         exit()
 
-def deep_merge(source, destination):
-    for key, value in source.items():
-        if isinstance(value, dict):
-            node = destination.setdefault(key, {})
-            deep_merge(value, node)
-        else:
-            destination.setdefault(key, value)
-    return destination
-
+# default_settings.ymlにsettings.ymlを重ね、検証してから読み取り専用のスナップショットにする
+# 正規表現はここでコンパイル済み。稼働中にsettings.ymlが変更されたら、検証に通った場合だけ差し替える
 try:
-    yaml = ruamel.yaml.YAML()
-    with open(DEFAULT_CONFIG_FILE, 'r', encoding='utf-8') as f:
-        default_config = yaml.load(f)
-    with open(USER_CONFIG_FILE, 'r', encoding='utf-8') as f:
-        user_config = yaml.load(f)
-    
-    MESSAGES = deep_merge(default_config, user_config)
-    
+    CONFIG = load_config(DEFAULT_CONFIG_FILE, USER_CONFIG_FILE)
     print(f"Message formats loaded and merged from '{DEFAULT_CONFIG_FILE}' and '{USER_CONFIG_FILE}'.")
+except ConfigError as e:
+    print(f"FATAL: Invalid settings in '{USER_CONFIG_FILE}':")
+    for error in e.errors:
+        print(f"  - {error}")
+    exit()
 except Exception as e:
     print(f"Error loading config files: {e}")
     exit()
 
-# --- 正規表現パターン(サーバーログ分析で使用) ---
-try:
-    CHAT_PATTERN = re.compile(MESSAGES['settings']['regex_patterns']['chat'])
-    LAG_WARNING_PATTERN = re.compile(MESSAGES['settings']['regex_patterns']['lag'])
-    JOIN_PATTERN = re.compile(MESSAGES['settings']['regex_patterns']['join'])
-    LEAVE_PATTERN = re.compile(MESSAGES['settings']['regex_patterns']['leave'])
-except KeyError as e:
-    print(f"FATAL: Regex patterns not found or invalid in formats.json. Key not found: {e}")
-    exit()
+MESSAGES = CONFIG.messages
 
-# グローバル変数としてObserverを定義
+# グローバル変数としてObserverを定義(全サーバーのログを1つの監視スレッドで見る)
 log_observer = Observer()
 
-# whitelistログファイル名
-LOG_FILE = "whitelist_log.json"
 ADMIN_USER_ID = 0
 
-# --- whitelistログ読み書き関数 ---
-
-def load_log():
-    """whitelistログを読み込む"""
-    if not os.path.exists(LOG_FILE):
-        return {}
-    try:
-        with open(LOG_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except (json.JSONDecodeError, FileNotFoundError):
-        return {}
-
-def save_log(log_data):
-    """whitelistログに保存する"""
-    with open(LOG_FILE, "w", encoding="utf-8") as f:
-        json.dump(log_data, f, indent=4)
-
-# --- Discordに送信するヘルパー ---
-async def send_message_to_discord(self, message):
-    try:
-        channel = self.bot.get_channel(CHANNEL_ID)
-        if channel: await channel.send(message)
-    except Exception as e: print(MESSAGES['console']['log_processing_error'].format(error=e))
+# --- whitelistログ保存先 ---
+
+def open_whitelist_store(server_config):
+    """設定に応じたwhitelistログの保存先を開く。変更は1件ずつ原子的に書き込まれ、履歴も残る
+
+    sqlite/journalでは、初回起動時に従来のwhitelist_log.json(1台目のサーバーのみ)を取り込む。
+    """
+    storage_config = MESSAGES['settings']['whitelist']['storage']
+    return open_store(storage_config['backend'], server_config.whitelist_file,
+                      legacy_json=server_config.legacy_whitelist_file, log=console_log)
+
+# --- コンソール出力ヘルパー(別モジュールのコンポーネントから使う) ---
+def console_log(key, **kwargs):
+    print(MESSAGES['console'][key].format(**kwargs))
+
+# --- メトリクス ---
+# 処理の途中で直接記録するもの。各コンポーネントが持っている統計は出力の直前にcollect_component_metricsで写す
+metrics_config = MESSAGES['settings']['metrics']
+METRICS = MetricsRegistry(prefix='mcbot_', log=console_log)
+LOG_LINES_READ = METRICS.counter('log_lines_read_total', "Log lines read from the log source", labels=('server',))
+LOG_LINES_MATCHED = METRICS.counter('log_lines_matched_total', "Log lines matched, by pattern", labels=('server', 'pattern'))
+LOG_BATCH_SECONDS = METRICS.histogram('log_batch_seconds', "Time spent reading and queueing new log lines per file event (file sources)")
+LOG_TAIL_LAG = METRICS.gauge('log_tail_lag_bytes', "Bytes written to the log source but not read yet, by source type", labels=('server', 'source'))
+PIPELINE_DEPTH = METRICS.gauge('pipeline_queue_depth', "Log pipeline queue depth, by stage", labels=('server', 'stage'))
+PIPELINE_DROPPED = METRICS.counter('pipeline_dropped_total', "Events dropped or merged by the log pipeline, by stage", labels=('server', 'stage'))
+RCON_SECONDS = METRICS.histogram('rcon_command_seconds', "RCON round-trip time, by command", labels=('server', 'command'))
+RCON_ERRORS = METRICS.counter('rcon_errors_total', "Failed RCON commands, by command", labels=('server', 'command'))
+CONVERSION_SECONDS = METRICS.histogram('conversion_seconds', "Kana-kanji conversion time including cache lookups")
+CONVERSION_EVENTS = METRICS.counter('conversion_events_total', "Kana-kanji conversion cache hits, misses and API calls", labels=('event',))
+CONVERSION_HIT_RATIO = METRICS.gauge('conversion_cache_hit_ratio', "Kana-kanji conversion cache hit ratio")
+DISCORD_SEND_SECONDS = METRICS.histogram('discord_send_seconds', "Time spent sending one message to Discord")
+DISCORD_QUEUE_SECONDS = METRICS.histogram('discord_queue_seconds', "Time a message waited in the outbox before sending")
+DISCORD_QUEUE_DEPTH = METRICS.gauge('discord_queue_depth', "Messages waiting in the outbox, by channel", labels=('channel',))
+DISCORD_EVENTS_SENT = METRICS.counter('discord_events_sent_total', "Log events delivered to Discord")
+ONLINE_PLAYERS = METRICS.gauge('online_players', "Players online according to the session index", labels=('server',))
+SERVER_CHAT_DEPTH = METRICS.gauge('server_chat_queue_depth', "Chat lines waiting to be sent to the server", labels=('server',))
+SERVER_LAG_SECONDS = METRICS.histogram('server_lag_seconds', "Lag reported by Can't keep up warnings", labels=('server',),
+                                       buckets=(0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0))
+SERVER_LAG_SPIKES = METRICS.counter('server_lag_spikes_total', "Lag spikes (runs of Can't keep up warnings)", labels=('server',))
+SERVER_CHAT_LINES = METRICS.counter('server_chat_lines_total', "Chat lines relayed to the server, by result", labels=('server', 'result'))
+LOOP_LAG_SECONDS = METRICS.histogram('event_loop_lag_seconds', "How late the event loop woke up (time it was blocked)")
+LOOP_LAG_MAX = METRICS.gauge('event_loop_lag_max_seconds', "Recent worst event loop lag (slowly decaying)")
+profiler = None
+metrics_runner = None  # /metricsのHTTPサーバー(停止時にcleanup)
+
+def record_discord_send(channel_id, send_seconds, queued_seconds, count):
+    DISCORD_SEND_SECONDS.observe(send_seconds)
+    DISCORD_QUEUE_SECONDS.observe(queued_seconds)
+    DISCORD_EVENTS_SENT.inc(count)
 
 # --- Serverに送信するヘルパー ---
-def send_command_to_server(command, isPost=False, executor=None):
+# サーバーごとに接続・認証済みのRCON接続をプールして使い回す(接続はイベントループ上で遅延確立)
+# 応答の遅いサーバーがあっても、待たされるのはそのサーバー宛てのコマンドだけ
+rcon_config = MESSAGES['settings']['rcon']
+
+def create_rcon_pool(server_config):
+    return RconPool(
+        server_config.rcon_host, server_config.rcon_port, server_config.rcon_password,
+        size=rcon_config['pool_size'],
+        timeout=rcon_config['timeout'],
+        keepalive_interval=rcon_config['keepalive_interval'],
+        log=console_log,
+    )
+
+async def send_command_to_server(command, isPost=False, executor=None, server=None):
+    """serverを省略した場合は1台目のサーバーに送る"""
+    server = server or DEFAULT_SERVER
+    verb = command.split(' ', 1)[0]
     try:
         print(f"{MESSAGES['console']['rcon_command_sent'].format(command=command)}{MESSAGES['console']['rcon_executor'].format(executor=executor) if executor else ''}")
-        with Client(RCON_HOST, RCON_PORT, passwd=RCON_PASSWORD) as client:
-            response = client.run(command)
+        started = time.perf_counter()
+        response = await server.rcon_pool.run(command)
+        RCON_SECONDS.observe(time.perf_counter() - started, server=server.name, command=verb)
         if isPost:
             print(MESSAGES['console']['server_response'].format(command=command, response=response))
             return response
         else:
             return True
-    except Exception as e:
+    except RconError as e:
+        RCON_ERRORS.inc(server=server.name, command=verb)
         print(MESSAGES['console']['rcon_connection_error'].format(error=e))
         return False
 
 # --- ローマ字チャットのかな漢字変換 ---
-def convert_japanese_yahoo(text: str) -> str:
-    """Yahoo JLP APIを使い、ローマ字をかな漢字交じり文に変換する。"""
-    if not YAHOO_APPID:
-        print(MESSAGES['console']['yahoo_appid_missing'])
-        return text
-
-    api_url = "https://jlp.yahooapis.jp/JIMService/V2/conversion"
-    headers = {
-        "Content-Type": "application/json",
-        "User-Agent": f"Yahoo AppID: {YAHOO_APPID}",
-    }
-    payload = {
-        "id": "1234-1",
-        "jsonrpc": "2.0",
-        "method": "jlp.jimservice.conversion",
-        "params": {
-            "q": text,
-            "format": "roman",
-            "mode": "kanakanji",
-            "results": 1 # 最も可能性の高い候補のみ取得
-        }
-    }
-    
-    try:
-        response = requests.post(api_url, data=json.dumps(payload), headers=headers, timeout=5)
-        response.raise_for_status()
-        data = response.json()
-
-        if "result" in data and "segment" in data["result"]:
-            # 各セグメントの最初の候補を結合して文を再構築
-            return "".join([seg["candidate"][0] for seg in data["result"]["segment"]])
-
-    except requests.RequestException as e:
-        print(MESSAGES['console']['yahoo_request_failed'].format(error=e))
-    except (IndexError, KeyError) as e:
-        print(MESSAGES['console']['yahoo_parse_failed'].format(error=e))
-        
-    # 失敗した場合は元のテキストをそのまま返す
-    return text
-
-class LogFileHandler(FileSystemEventHandler):
-    def __init__(self, bot_instance):
+# 変換結果はメモリ(と任意でディスク)にキャッシュし、API障害時はしばらく問い合わせを止める
+yahoo_config = MESSAGES['settings']['yahoo']
+yahoo_converter = YahooConverter(
+    YAHOO_APPID,
+    timeout=yahoo_config['timeout'],
+    cache_size=yahoo_config['cache']['size'],
+    cache_ttl=yahoo_config['cache']['ttl'],
+    persistent_file=yahoo_config['cache']['persistent_file'] or None,
+    persistent_ttl=yahoo_config['cache']['persistent_ttl'],
+    failure_threshold=yahoo_config['circuit_breaker']['failure_threshold'],
+    cooldown=yahoo_config['circuit_breaker']['cooldown'],
+    log=console_log,
+)
+
+# APIより先に使うオフライン変換。英語の行はここで除外し、辞書で確定できる語句はAPIを呼ばない
+romaji_config = MESSAGES['settings']['romaji']
+ROMAJI_ENGINE = RomajiEngine(
+    dictionary=romaji_config['dictionary'],
+    extra_english_words=romaji_config['extra_english_words'],
+)
+
+async def convert_japanese_yahoo(text: str) -> str:
+    """Yahoo JLP APIを使い、ローマ字をかな漢字交じり文に変換する。失敗した場合は元のテキストをそのまま返す"""
+    with CONVERSION_SECONDS.time():
+        return await yahoo_converter.convert(text)
+
+# かな・カナ・漢字を含むか(含まなければローマ字変換の候補)
+JAPANESE_PATTERN = re.compile(r'[ぁ-んァ-ン一-龯]')
+# @a/@e/@r/@s(ターゲットセレクター)として解釈されないようにする
+SELECTOR_PATTERN = re.compile(r'(@)([aers])(?=\S)')
+
+# --- ログの取り込み口 ---
+# settings.log_source.type(サーバーごとに上書き可)で選ぶ。どれも同じパイプラインに1行ずつ投入する
+
+def open_log_source(server_config):
+    source_config = server_config.log_source
+    kind = source_config['type']
+    if kind == 'pipe':
+        return PipeSource(source_config['pipe']['path'], log=console_log)
+    if kind in ('tcp', 'udp'):
+        return SocketSource(kind, source_config[kind]['host'], source_config[kind]['port'], log=console_log)
+    # 前回の読み取り位置(チェックポイント)から再開する。なければファイル末尾から
+    tail_config = MESSAGES['settings']['log_tail']
+    tailer = LogTailer(
+        server_config.log_file,
+        checkpoint_path=server_config.checkpoint_file,
+        chunk_size=tail_config['chunk_size'],
+        checkpoint_interval=tail_config['checkpoint_interval'],
+        log=console_log,
+    )
+    def observe_batch(seconds, count):
+        LOG_BATCH_SECONDS.observe(seconds)
+    if kind == 'poll':
+        return PollingSource(tailer, min_interval=source_config['poll']['min_interval'], max_interval=source_config['poll']['max_interval'],
+                             on_batch=observe_batch, log=console_log)
+    return WatchdogSource(tailer, log_observer, on_batch=observe_batch, log=console_log)
+
+class LogFileHandler:
+    """1台分のログを取り込み口(LogSource)から受け取って処理する。読み取りは取り込み口ごとのスレッドで行い、共有の監視スレッドを待たせない"""
+    def __init__(self, bot_instance, server):
         self.bot = bot_instance
-        self.last_position = 0
-        # 起動時にファイルの末尾にシーク
-        if os.path.exists(LOG_FILE_PATH):
-            try: self.last_position = os.path.getsize(LOG_FILE_PATH)
-            except OSError: pass # ファイルがすぐに消された場合などを考慮
+        self.server = server
+        # 分類結果の種別 -> 処理関数
+        self.handlers = {
+            'chat': self.handle_chat,
+            'lag': self.handle_lag,
+            'join': self.handle_join,
+            'leave': self.handle_leave,
+            'whitelist_add': self.handle_whitelist_add,
+            'whitelist_remove': self.handle_whitelist_remove,
+        }
+        self.source = open_log_source(server.config)
+        # 取り込み口 -> 解析 -> 加工(ローマ字変換) -> 送信 の上限付きパイプライン
+        pipeline_config = MESSAGES['settings']['log_pipeline']
+        self.pipeline = LogPipeline(
+            server.regex.classifier.classify,
+            self.dispatch,
+            self.deliver,
+            ingest_size=pipeline_config['ingest']['queue_size'],
+            ingest_overflow=pipeline_config['ingest']['overflow'],
+            event_size=pipeline_config['events']['queue_size'],
+            event_overflow=pipeline_config['events']['overflow'],
+            enrich_concurrency=pipeline_config['enrich']['concurrency'],
+            delivery_size=pipeline_config['delivery']['queue_size'],
+            log=console_log,
+        )
+
+    def start(self, loop):
+        # パイプラインが満杯なら取り込み口のスレッドが待たされる(他のサーバーの読み取りは止めない)
+        self.pipeline.start(loop)
+        self.source.start(self.pipeline.submit_threadsafe)
+
+    def stop(self):
+        """取り込み口を止める(ファイルなら読み取り位置を保存する)"""
+        self.source.stop()
 
     # --- Discordに送信するヘルパー ---
     async def send_message_to_discord(self, message):
-        try:
-            channel = self.bot.get_channel(CHANNEL_ID)
-            if channel: await channel.send(message)
+        try: discord_outbox.post(self.server.config.channel_id, message)
         except Exception as e: print(MESSAGES['console']['log_processing_error'].format(error=e))
 
     async def process_chat_message(self, player_name, chat_message):
-        """チャットメッセージを処理し、必要なら変換してDiscordに送信する"""
-        is_romaji_only = not re.search(r'[ぁ-んァ-ン一-龯]', chat_message)
+        """チャットメッセージを必要なら変換し、(Discordへの送信内容, サーバーへ返す変換結果)を返す"""
+        chatformat = None
+        is_romaji_only = not JAPANESE_PATTERN.search(chat_message)
+
+        analysis = ROMAJI_ENGINE.analyze(chat_message) if is_romaji_only else None
+
+        if analysis and analysis.kind == 'romaji':
+            if analysis.confident:
+                final_text = analysis.converted
+            else:
+                # Yahoo APIの関数を呼び出す。失敗した(元のまま返ってきた)場合はオフライン変換のかなを使う
+                final_text = await convert_japanese_yahoo(chat_message)
+                if final_text == chat_message and analysis.kana:
+                    final_text = analysis.kana
 
-        if is_romaji_only:
-            # Yahoo APIの関数を呼び出す
-            final_text = await asyncio.to_thread(convert_japanese_yahoo, chat_message)
-            
             # 変換前と変換後が同じでなければ、変換結果を併記
             if final_text != chat_message:
                 replacevars = {
@@ -192,8 +280,6 @@ class LogFileHandler(FileSystemEventHandler):
                 message_to_send = MESSAGES['discord']['chat_romaji_converted'].format(**replacevars)
                 if MESSAGES['server']['to_server_chat_with_kanakanji']['enable']:
                     chatformat = MESSAGES['server']['to_server_chat_with_kanakanji']['format'].format(**replacevars)
-                    if not send_command_to_server(f'say {chatformat}'):
-                        print(MESSAGES['console']['server_send_failed'])
 
             else:
                 message_to_send = (MESSAGES['discord']['chat_normal']
@@ -202,113 +288,418 @@ class LogFileHandler(FileSystemEventHandler):
                     message=chat_message
                 ))
         else:
-            # 日本語が含まれる場合はそのまま送信
+            # 日本語が含まれる場合や英語の場合はそのまま送信
             message_to_send = (MESSAGES['discord']['chat_normal']
             .format(
                 player_name=player_name,
                 message=chat_message
             ))
 
-        await self.send_message_to_discord(message_to_send)
+        return message_to_send, chatformat
 
-    def on_modified(self, event):
-        if not os.path.normpath(event.src_path) == os.path.normpath(LOG_FILE_PATH): return
-        try:
-            with open(LOG_FILE_PATH, 'r', encoding='utf-8', errors='ignore') as f:
-                f.seek(self.last_position)
-                new_lines = f.readlines()
-                self.last_position = f.tell()
-
-            for line in new_lines:
-
-                chat_match = CHAT_PATTERN.search(line)
-                lag_match = LAG_WARNING_PATTERN.search(line)
-                join_match = JOIN_PATTERN.search(line)
-                leave_match = LEAVE_PATTERN.search(line)
-
-                message_to_send = None
-
-                if chat_match:
-                    player_name = chat_match.group(1)
-                    chat_message = chat_match.group(2)
-                    asyncio.run_coroutine_threadsafe(
-                        self.process_chat_message(player_name, chat_message),
-                        self.bot.loop
-                    )
-                    continue
-
-                elif lag_match:
-                    ms = lag_match.group(1)
-                    ticks = lag_match.group(2)
-                    message_to_send = MESSAGES['discord']['server_lag'].format(ms=ms, ticks=ticks)
-                
-                elif join_match:
-                    message_to_send = MESSAGES['discord']['player_joined'].format(player_name=join_match.group(1))
-
-                elif leave_match:
-                    message_to_send = MESSAGES['discord']['player_left'].format(player_name=leave_match.group(1))
-
-                # 送信するメッセージがあればDiscordに送る
-                if message_to_send:
-                    asyncio.run_coroutine_threadsafe(
-                        self.send_message_to_discord(message_to_send),
-                        self.bot.loop
-                    )
+    # --- ログ種別ごとの処理(パイプラインの加工段から呼ばれる) ---
+    # 送信内容を返すか、変換が必要ならコルーチンを返す(パイプラインが並行実行し、順番通りに送信する)
+    def dispatch(self, kind, groups):
+        LOG_LINES_MATCHED.inc(server=self.server.name, pattern=kind)
+        return self.handlers[kind](*groups)
 
-        except Exception as e: print(MESSAGES['console']['log_processing_error'].format(error=e))
+    def handle_chat(self, player_name, chat_message, *_):
+        return self.process_chat_message(player_name, chat_message)
+
+    def handle_lag(self, ms, ticks, *_):
+        # 負荷の山の始まりだけ通知する。続く警告は記録だけして、山の終わりにまとめて通知する
+        try: lag_ms, lag_ticks = float(ms), float(ticks)
+        except ValueError: return MESSAGES['discord']['server_lag'].format(ms=ms, ticks=ticks)
+        SERVER_LAG_SECONDS.observe(lag_ms / 1000, server=self.server.name)
+        if not self.server.lag.record(lag_ms, lag_ticks): return None
+        SERVER_LAG_SPIKES.inc(server=self.server.name)
+        return MESSAGES['discord']['server_lag'].format(ms=ms, ticks=ticks)
+
+    def handle_join(self, player_name, *_):
+        self.server.sessions.joined(player_name)
+        return MESSAGES['discord']['player_joined'].format(player_name=player_name)
+
+    def handle_leave(self, player_name, *_):
+        self.server.sessions.left(player_name)
+        return MESSAGES['discord']['player_left'].format(player_name=player_name)
+
+    # コンソールやゲーム内から変更されたホワイトリストをメモリ上の状態に反映する(送信はしない)
+    def handle_whitelist_add(self, player_name, *_):
+        self.server.whitelist.apply_added(player_name, source='log')
+
+    def handle_whitelist_remove(self, player_name, *_):
+        self.server.whitelist.apply_removed(player_name, source='log')
 
+    async def deliver(self, result):
+        """パイプラインの送信段。Discordへ送り、変換結果があればサーバーのチャット送信キューにも積む"""
+        message_to_send, chatformat = result if isinstance(result, tuple) else (result, None)
+        await self.send_message_to_discord(message_to_send)
+        if chatformat is not None:
+            self.server.chat.post(chatformat)
+
+
+# --- 追加者名の解決 ---
+# 追加者は数人に偏るので、IDを重複除去してからまとめて解決し、結果(脱退済みを含む)は一定時間キャッシュする
+member_names_config = MESSAGES['settings']['member_names']
+member_names = MemberNameResolver(
+    ttl=member_names_config['cache_ttl'],
+    negative_ttl=member_names_config['negative_ttl'],
+    concurrency=member_names_config['concurrency'],
+    bulk_threshold=member_names_config['bulk_threshold'],
+    log=console_log,
+)
+
+async def get_adder_names(guild: discord.Guild, adder_ids):
+    """IDから追加者の名前をまとめて取得する。{ID: 表示名 / "管理者" / "(不明なユーザー)"}"""
+    names = await member_names.resolve_many(guild, [adder_id for adder_id in adder_ids if adder_id != ADMIN_USER_ID])
+    names = {adder_id: name if name is not None else MESSAGES['discord']['adders']['adder_unknown'] for adder_id, name in names.items()}
+    names[ADMIN_USER_ID] = MESSAGES['discord']['adders']['adder_admin']
+    return names
 
 async def get_adder_name(guild: discord.Guild, adder_id: int):
-    """IDから追加者の名前を取得する。キャッシュになければAPIに問い合わせる"""
-    if adder_id == ADMIN_USER_ID: return MESSAGES['discord']['adders']['adder_admin']
-    # まずキャッシュからメンバーを探す
-    member = guild.get_member(adder_id)
-    if not member:
-        # キャッシュにいなければAPIに問い合わせる
-        try: member = await guild.fetch_member(adder_id)
-        # サーバーから既に脱退している場合
-        except discord.NotFound: return MESSAGES['discord']['adders']['adder_unknown']
-    # memberがNoneでない（見つかった）場合、その表示名を返す
-    return member.display_name
+    """IDから追加者の名前を取得する"""
+    return (await get_adder_names(guild, [adder_id]))[adder_id]
+
+
+# --- プレイヤー一覧の表示 ---
+# 一覧はページ単位で描画し、追加者名は表示するページの分だけ解決する
+async def respond_player_list(ctx: discord.ApplicationContext, server, players, header, title, footer_text, compact=None, sessions=None):
+    """並べ替え済みのplayersを(必要ならページ送りボタン付きで)Embedにして返信する。sessions(名前 -> 秒)があれば追加者に添える"""
+    player_list_config = MESSAGES['settings']['player_list']
+    if len(SERVERS) > 1:
+        footer_text = MESSAGES['discord']['server_footer'].format(footer=footer_text, server=server.label)
+    if compact is None:
+        compact = len(players) >= player_list_config['compact_threshold']
+    page_size = player_list_config['compact_page_size'] if compact else min(player_list_config['page_size'], MAX_FIELDS_PER_PAGE)
+    na_names = [MESSAGES['discord']['adders']['adder_admin'], MESSAGES['discord']['adders']['adder_unknown']]
+
+    async def render(page_players, page, pages):
+        adder_ids = {player: server.whitelist.adder_of(player, ADMIN_USER_ID) for player in page_players}
+        adder_names = await get_adder_names(ctx.guild, adder_ids.values())
+        rows = []
+        for player in page_players:
+            adder_name = adder_names[adder_ids[player]]
+            if adder_name in na_names:
+                adder_name = MESSAGES['discord']['adders']['list_adder_na']
+            if sessions is not None:
+                adder_name = MESSAGES['discord']['online_session'].format(adder_name=adder_name, duration=format_duration(sessions[player]))
+            rows.append((player, adder_name))
+
+        embed = discord.Embed(color=0x784dbe, timestamp=discord.utils.utcnow())
+        if compact:
+            lines = [MESSAGES['discord']['list_compact_line'].format(player_name=player, adder_name=adder_name)
+                     for player, adder_name in rows]
+            embed.description = "\n".join([title] + lines)
+        else:
+            embed.description = title
+            for player, adder_name in rows:
+                embed.add_field(name=player, value=adder_name, inline=True)
+        if bot.user.avatar: embed.set_footer(text=footer_text, icon_url=bot.user.avatar.url)
+        else: embed.set_footer(text=footer_text)
+        return embed
+
+    view = PlayerPages(players, render, page_size, MESSAGES['discord']['pagination'],
+                       author_id=ctx.author.id, timeout=player_list_config['view_timeout'])
+    embed = await view.embed_for(0)
+    if view.pages == 1:
+        await ctx.respond(header, embed=embed)
+        return
+    view.message = await ctx.respond(header, embed=embed, view=view)
+
+def format_duration(seconds):
+    durations = MESSAGES['discord']['duration']
+    minutes = int(seconds) // 60
+    if minutes < 60:
+        return durations['minutes'].format(minutes=minutes)
+    return durations['hours'].format(hours=minutes // 60, minutes=minutes % 60)
 
 
 # --- ホワイトリスト同期関数 ---
-async def sync_whitelist_log(log_data):
+# コマンドはメモリ上のserver.whitelistから答え、RCONとの照合は一定間隔ごと(または明示的な要求時)だけ行う
+async def sync_whitelist_log(server=None):
+    server = server or DEFAULT_SERVER
     print(MESSAGES['console']['sync_started'])
 
-    response = send_command_to_server("whitelist list", True)
+    response = await send_command_to_server("whitelist list", True, server=server)
     if response == False:
         print(MESSAGES['console']['sync_error'])
-        return log_data
-        
+        return False
+
     # 結果からプレイヤー名を抜き出し
-    match = re.search(MESSAGES['settings']['regex_patterns']['whitelist_list'], response)
-    server_players = {name.strip() for name in match.group(1).split(',')} if match else set()
-    
-    # ホワイトリストログに記録あるか確認し、なければサーバー側での追加と見なす
-    for player in server_players:
-        if player.lower() not in log_data:
-            log_data[player.lower()] = ADMIN_USER_ID
-            print(MESSAGES['console']['sync_unlogged_player'].format(player=player))
-    
-    # ホワリスの中から、ログに記録があるがリストにないプレイヤー名を探し削除
-    log_players = list(log_data.keys())
-    for log_player_key in log_players:
-        if not any(sp.lower() == log_player_key for sp in server_players):
-            del log_data[log_player_key]
-            print(MESSAGES['console']['sync_stale_player'].format(player=log_player_key))
-
-    # ホワイトリストログを保存
-    save_log(log_data)
-    return log_data
+    match = server.regex.whitelist_list.search(response)
+    server_players = [name.strip() for name in match.group(1).split(',') if name.strip()] if match else []
+
+    # ログにない名前はサーバー側での追加、リストにない名前は削除済みと見なす
+    unlogged, stale = server.whitelist.reconcile(server_players)
+    for player in unlogged:
+        print(MESSAGES['console']['sync_unlogged_player'].format(player=player))
+    for player in stale:
+        print(MESSAGES['console']['sync_stale_player'].format(player=player))
+    return True
+
+
+# --- オンラインプレイヤーの照合 ---
+# /lsはメモリ上のserver.sessionsから答え、listでの照合は一定間隔ごと(と初回)だけ行う
+def parse_online_list(server, response):
+    match = server.regex.online_list.search(response)
+    return [name.strip() for name in match.group(1).split(',') if name.strip()] if match else []
+
+async def sync_online_players(server=None):
+    server = server or DEFAULT_SERVER
+    print(MESSAGES['console']['online_list_fetch_started'])
+    response = await send_command_to_server("list", True, server=server)
+    if not response:
+        return False
+    # ログで見えなかった参加・退出(クラッシュやローテーションでの取りこぼし)を直す
+    missed_joins, missed_leaves = server.sessions.reconcile(parse_online_list(server, response))
+    for player in missed_joins:
+        print(MESSAGES['console']['sessions_missed_join'].format(server=server.label, player=player))
+    for player in missed_leaves:
+        print(MESSAGES['console']['sessions_missed_leave'].format(server=server.label, player=player))
+    return True
+
+
+# --- サーバーごとの状態 ---
+# Bot・送信キュー・変換キャッシュ・追加者名キャッシュ・ログ監視スレッドは全サーバーで共有し、
+# RCON接続・ログの読み取り・whitelistログ・正規表現・チャット送信キューはサーバーごとに持つ
+server_chat_config = MESSAGES['settings']['server_chat']
+lag_config = MESSAGES['settings']['lag']
+sessions_config = MESSAGES['settings']['sessions']
+log_index_config = MESSAGES['settings']['log_index']
+
+class MinecraftServer:
+    def __init__(self, config):
+        self.config = config
+        self.name = config.name
+        self.label = config.label
+        self.regex = CONFIG.regex_profiles[config.regex_profile]
+        self.rcon_pool = create_rcon_pool(config)
+        self.store = open_whitelist_store(config)
+        self.whitelist = WhitelistState(
+            self.store,
+            admin_id=ADMIN_USER_ID,
+            reconcile_interval=MESSAGES['settings']['whitelist']['reconcile_interval'],
+        )
+        # オンラインのプレイヤーと累計のプレイ時間
+        self.sessions = SessionIndex(PlaytimeStore(config.playtime_file), reconcile_interval=sessions_config['reconcile_interval'])
+        # 過去ログ(.log.gzとlatest.log)の検索用索引
+        self.log_index = LogIndex(config.index_file, config.log_file, chunk_size=log_index_config['chunk_size'],
+                                  batch_size=log_index_config['batch_size'], log=console_log) if log_index_config['enable'] else None
+        self.log_handler = None
+        # Can't keep up!警告の記録(固定長)
+        self.lag = LagTracker(capacity=lag_config['history_size'], quiet_period=lag_config['quiet_period'])
+        # Discordからのチャットとかな漢字変換の結果は、まとめてtellrawで送る
+        self.chat = ServerChatOutbox(
+            self.send_chat,
+            name=config.name,
+            target=server_chat_config['target'],
+            flush_window=server_chat_config['flush_window'],
+            rate_commands=server_chat_config['rate_limit']['commands'],
+            rate_per=server_chat_config['rate_limit']['per'],
+            max_queue=server_chat_config['max_queue'],
+            max_command_bytes=server_chat_config['max_command_bytes'],
+            log=console_log,
+        )
+
+    async def send_chat(self, command):
+        if not await send_command_to_server(command, server=self):
+            print(MESSAGES['console']['server_send_failed'])
+            return False
+        return True
+
+    async def sync_whitelist(self):
+        return await sync_whitelist_log(self)
+
+    async def sync_sessions(self):
+        return await sync_online_players(self)
+
+SERVERS = {config.name: MinecraftServer(config) for config in CONFIG.servers}
+SERVERS_BY_CHANNEL = {server.config.channel_id: server for server in SERVERS.values()}
+DEFAULT_SERVER = next(iter(SERVERS.values()))
 
 
 # --- Botの準備 ---
 intents = discord.Intents.default()
 intents.members = True
 intents.message_content = True
-bot = discord.Bot(intents=intents)
 
+class MinecraftBot(discord.Bot):
+    async def close(self):
+        # イベントループが止まる前に、ループ上で開いた接続を閉じる
+        if not self.is_closed(): await close_connections()
+        await super().close()
+
+bot = MinecraftBot(intents=intents)
+
+outbox_config = MESSAGES['settings']['discord_outbox']
+discord_outbox = DiscordOutbox(
+    bot.get_channel,
+    log=console_log,
+    flush_window=outbox_config['flush_window'],
+    max_flush_window=outbox_config['max_flush_window'],
+    rate_messages=outbox_config['rate_limit']['messages'],
+    rate_per=outbox_config['rate_limit']['per'],
+    on_sent=record_discord_send,
+)
+
+
+@METRICS.collect
+def collect_component_metrics():
+    """各コンポーネントが数えている統計をメトリクスに写す(出力の直前に呼ばれる)"""
+    for server in SERVERS.values():
+        handler = server.log_handler
+        if handler is None: continue
+        source_stats = handler.source.stats()
+        LOG_TAIL_LAG.set(source_stats['lag_bytes'], server=server.name, source=handler.source.kind)
+        LOG_LINES_READ.set_total(source_stats['lines_read'], server=server.name)
+        for stage, stats in handler.pipeline.stats().items():
+            if stage == 'counters': continue
+            PIPELINE_DEPTH.set(stats['depth'], server=server.name, stage=stage)
+            PIPELINE_DROPPED.set_total(stats['dropped'] + stats['merged'], server=server.name, stage=stage)
+    for server in SERVERS.values():
+        ONLINE_PLAYERS.set(len(server.sessions.online), server=server.name)
+        stats = server.chat.stats()
+        SERVER_CHAT_DEPTH.set(stats['queue_depth'], server=server.name)
+        for result in ('sent', 'failed', 'dropped'):
+            SERVER_CHAT_LINES.set_total(stats['lines_sent' if result == 'sent' else result], server=server.name, result=result)
+    for event, count in yahoo_converter.counters.items():
+        CONVERSION_EVENTS.set_total(count, event=event)
+    CONVERSION_HIT_RATIO.set(yahoo_converter.hit_ratio)
+    for channel_id, stats in discord_outbox.stats().items():
+        DISCORD_QUEUE_DEPTH.set(stats['queue_depth'], channel=channel_id)
+
+
+def start_metrics():
+    """イベントループの詰まりの計測と、設定で有効にしたHTTPエンドポイント・プロファイラを開始する"""
+    global profiler
+    bot.loop.create_task(monitor_event_loop(LOOP_LAG_SECONDS, LOOP_LAG_MAX, metrics_config['loop_monitor_interval']))
+    http_config = metrics_config['http']
+    if http_config['enable']:
+        async def start_http():
+            global metrics_runner
+            try:
+                metrics_runner = await serve_metrics(METRICS, http_config['host'], http_config['port'])
+                print(MESSAGES['console']['metrics_http_started'].format(host=http_config['host'], port=http_config['port']))
+            except OSError as e:
+                print(MESSAGES['console']['metrics_http_failed'].format(error=e))
+        bot.loop.create_task(start_http())
+    if metrics_config['profiler']['enable'] and profiler is None:
+        # このリポジトリのファイル内で時間を使っている関数を集計する
+        profiler = SamplingProfiler(metrics_config['profiler']['interval'], roots=(os.path.dirname(os.path.abspath(__file__)),))
+        profiler.start()
+        print(MESSAGES['console']['profiler_started'].format(interval=metrics_config['profiler']['interval']))
+
+
+# --- 停止処理 ---
+async def close_connections():
+    """bot.close()から呼ぶ。イベントループ上のHTTPサーバー・RCON接続・HTTPセッションを閉じる(スレッドやファイルは__main__で後始末する)"""
+    global metrics_runner
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+        metrics_runner = None
+    for server in SERVERS.values():
+        await server.chat.close()
+        await server.rcon_pool.close()
+    await yahoo_converter.close()
+
+
+# --- 負荷の山の終わりの通知 ---
+async def watch_lag_spikes():
+    """警告が途絶えた山を、件数・最大・合計をまとめた1通で通知する"""
+    while True:
+        await asyncio.sleep(lag_config['check_interval'])
+        for server in SERVERS.values():
+            spike = server.lag.poll()
+            if spike is None: continue
+            started, ended, count, _, max_ms, ticks = spike
+            duration = int(ended - started)
+            discord_outbox.post(server.config.channel_id, MESSAGES['discord']['lag_spike_ended'].format(
+                minutes=duration // 60, seconds=duration % 60, count=count, max_ms=int(max_ms), ticks=int(ticks)))
+
+
+# --- オンラインプレイヤーの照合とプレイ時間の保存 ---
+async def maintain_sessions():
+    """変わったプレイ時間をまとめて書き込み、照合の間隔が過ぎたサーバーはlistで照合する"""
+    while True:
+        for server in SERVERS.values():
+            # 初回は/lsからの照合と重ならないようにensure_readyを通す
+            if server.sessions.last_reconciled is None: await server.sessions.ensure_ready(server.sync_sessions)
+            elif server.sessions.needs_reconcile(): await server.sync_sessions()
+            try: server.sessions.flush()
+            except Exception as e: print(MESSAGES['console']['playtime_save_failed'].format(server=server.label, error=e))
+        await asyncio.sleep(sessions_config['flush_interval'])
+
+
+# --- 過去ログの索引の更新 ---
+async def maintain_log_index():
+    """ローテーション済みのログとlatest.logの未読部分を、間隔を空けて別スレッドで索引に加える"""
+    while True:
+        for server in SERVERS.values():
+            if server.log_index is None: continue
+            started = time.monotonic()
+            try:
+                completed, events = await asyncio.to_thread(server.log_index.update, server.regex.classifier.classify)
+            except Exception as e:
+                # 1台の失敗で索引の更新全体を止めない(次の間隔でやり直す)
+                print(MESSAGES['console']['log_index_failed'].format(path=server.config.log_file, error=e))
+                continue
+            if completed:
+                print(MESSAGES['console']['log_index_updated'].format(server=server.label, files=completed, events=events,
+                                                                      seconds=time.monotonic() - started))
+        await asyncio.sleep(log_index_config['interval'])
+
+
+# --- 設定の再読み込み ---
+# settings.ymlの保存を検知し、検証に通った新しいスナップショットに差し替える(ログの読み取り位置やキューはそのまま)
+# コマンドの定義や接続・キューの設定など、起動時にしか反映されないものは警告だけ出す
+def apply_config(snapshot):
+    global CONFIG, MESSAGES, ROMAJI_ENGINE
+    romaji_changed = snapshot.messages['settings']['romaji'] != MESSAGES['settings']['romaji']
+    CONFIG, MESSAGES = snapshot, snapshot.messages
+    for server in SERVERS.values():
+        server.regex = snapshot.regex_profiles.get(server.config.regex_profile, server.regex)
+        if server.log_handler is not None:
+            server.log_handler.pipeline.classify = server.regex.classifier.classify
+    if romaji_changed:
+        romaji_config = MESSAGES['settings']['romaji']
+        ROMAJI_ENGINE = RomajiEngine(dictionary=romaji_config['dictionary'], extra_english_words=romaji_config['extra_english_words'])
+
+async def reload_config():
+    try:
+        snapshot = await asyncio.to_thread(load_config, DEFAULT_CONFIG_FILE, USER_CONFIG_FILE)
+    except ConfigError as e:
+        print(MESSAGES['console']['config_rejected'].format(file=USER_CONFIG_FILE, errors="\n".join(f"  - {error}" for error in e.errors)))
+        if e.text is not None:
+            print(describe_diff(CONFIG.user_text, e.text))
+        return
+    except Exception as e:
+        print(MESSAGES['console']['config_rejected'].format(file=USER_CONFIG_FILE, errors=f"  - {e}"))
+        return
+    if snapshot.user_text == CONFIG.user_text: return
+    pending = restart_required_changes(CONFIG.messages, snapshot.messages)
+    apply_config(snapshot)
+    print(MESSAGES['console']['config_reloaded'].format(file=USER_CONFIG_FILE))
+    if pending:
+        print(MESSAGES['console']['config_restart_required'].format(keys=", ".join(pending)))
+
+class ConfigFileHandler(FileSystemEventHandler):
+    """settings.ymlの変更を検知する。保存時に続けて届くイベントはまとめて1回だけ読み込む"""
+    def __init__(self, loop, delay=0.5):
+        self.loop = loop
+        self.delay = delay
+        self._pending = None
+
+    def on_modified(self, event):
+        # エディタによっては一時ファイルからの置き換え(moved)で保存される
+        paths = (event.src_path, getattr(event, 'dest_path', None) or event.src_path)
+        if os.path.abspath(USER_CONFIG_FILE) not in map(os.path.abspath, paths): return
+        self.loop.call_soon_threadsafe(self._schedule)
+
+    on_created = on_moved = on_modified
+
+    def _schedule(self):
+        if self._pending is not None: self._pending.cancel()
+        self._pending = self.loop.call_later(self.delay, lambda: self.loop.create_task(reload_config()))
 
 
 @bot.event
@@ -316,35 +707,83 @@ async def on_ready():
     global log_observer
     print(MESSAGES['console']['bot_login'].format(user=bot.user))
     print("----------------------------------------")
-
-    # ログ監視(watchdog)のセットアップと開始
-    event_handler = LogFileHandler(bot)
-    # ログファイルのあるディレクトリを監視対象にする
-    log_directory = os.path.dirname(os.path.abspath(LOG_FILE_PATH))
-    if not os.path.exists(log_directory):
-        print(MESSAGES['console']['log_dir_not_found'].format(directory=log_directory))
-        return
-    log_observer.schedule(event_handler, log_directory, recursive=False)
+    # 再接続でon_readyが再度呼ばれても、監視は一度だけ開始する
+    if DEFAULT_SERVER.log_handler is not None: return
+
+    start_metrics()
+    bot.loop.create_task(watch_lag_spikes())
+    bot.loop.create_task(maintain_sessions())
+    if log_index_config['enable']: bot.loop.create_task(maintain_log_index())
+
+    # ログの取り込みを開始する。watchdogの取り込み口は1つの監視スレッドを共有する
+    for server in SERVERS.values():
+        server.log_handler = LogFileHandler(bot, server)
+        server.log_handler.start(bot.loop)
+        print(MESSAGES['console']['server_watching'].format(server=server.label, source=server.log_handler.source.describe()))
+    # 同じ監視スレッドでsettings.ymlも見る
+    log_observer.schedule(ConfigFileHandler(bot.loop), os.path.dirname(os.path.abspath(USER_CONFIG_FILE)), recursive=False)
     try:
         log_observer.start()
-        print(MESSAGES['console']['observer_started'].format(directory=log_directory))
+        watched = {os.path.dirname(os.path.abspath(server.config.log_file)) for server in SERVERS.values()
+                   if isinstance(server.log_handler.source, WatchdogSource)}
+        print(MESSAGES['console']['observer_started'].format(directory=", ".join(sorted(watched | {os.path.dirname(os.path.abspath(USER_CONFIG_FILE))}))))
     except Exception as e:
         print(MESSAGES['console']['observer_start_failed'].format(error=e))
 
 # --- on_message イベント ---
+# メンバーの表示名が変わった・参加した・脱退した場合は、キャッシュ済みの追加者名を捨てる
+@bot.event
+async def on_member_update(before: discord.Member, after: discord.Member):
+    member_names.invalidate(after.guild.id, after.id)
+
+@bot.event
+async def on_member_join(member: discord.Member):
+    member_names.invalidate(member.guild.id, member.id)
+
+@bot.event
+async def on_member_remove(member: discord.Member):
+    member_names.invalidate(member.guild.id, member.id)
+
 @bot.event
 async def on_message(message: discord.Message):
     if message.author.bot: return
-    if message.channel.id != CHANNEL_ID: return
+    # チャンネルに紐づいたサーバーへ中継する
+    server = SERVERS_BY_CHANNEL.get(message.channel.id)
+    if server is None: return
     if message.content.startswith("/"): return
-    if not message.content: return
+    if not message.content and not message.attachments: return
 
+    # 送信はサーバーごとのキューに積むだけ(連投はまとめられ、順番通りにtellrawで送られる)
     nickname, content = message.author.display_name, message.clean_content
-    safe_content = re.sub(r'(@)([aers])(?=\S)', r'\1.\2', content)
-    messageformat = MESSAGES['server']['to_server_chat_format'].format(nickname=nickname, content=safe_content)
-
-    if not send_command_to_server(f"say {messageformat}"):
-        print(MESSAGES['console']['server_send_failed'])
+    safe_content = SELECTOR_PATTERN.sub(r'\1.\2', content)
+    server_formats = MESSAGES['server']
+    reference = message.reference.resolved if message.reference else None
+    if isinstance(reference, discord.Message):
+        # 返信先は1行に縮めて添える
+        reply_content = " ".join(reference.clean_content.split())
+        if len(reply_content) > server_formats['reply_excerpt_length']:
+            reply_content = reply_content[:server_formats['reply_excerpt_length']] + "…"
+        server.chat.post(text_component(server_formats['to_server_reply_format'].format(
+            nickname=reference.author.display_name, content=reply_content), color="gray"))
+    messageformat = server_formats['to_server_chat_format'].format(nickname=nickname, content=safe_content)
+    attachments = [link_component(server_formats['to_server_attachment_format'].format(filename=attachment.filename), attachment.url)
+                   for attachment in message.attachments]
+    server.chat.post(messageformat, *attachments)
+
+
+# --- コマンドの対象サーバー ---
+def server_option():
+    return discord.Option(str, name='server', description=MESSAGES['commands']['options']['server'],
+                          autocomplete=discord.utils.basic_autocomplete(list(SERVERS)), default=None)
+
+async def resolve_server(ctx: discord.ApplicationContext, name):
+    """server引数 -> コマンドを実行したチャンネルのサーバー -> 1台目 の順で対象を決める。見つからなければ返信してNone"""
+    if name is None:
+        return SERVERS_BY_CHANNEL.get(ctx.channel_id, DEFAULT_SERVER)
+    server = SERVERS.get(name)
+    if server is None:
+        await ctx.respond(MESSAGES['discord']['unknown_server'].format(server=name, servers=", ".join(SERVERS)))
+    return server
 
 try:
     ws_group_config = MESSAGES['commands']['ws']['group']
@@ -353,25 +792,29 @@ try:
     # --- ホワイトリスト追加コマンド ---
     add_config = MESSAGES['commands']['ws']['subcommands']['add']
     @ws.command(name=add_config['name'], description=add_config['description'])
-    async def add_player(ctx: discord.ApplicationContext, player_name: discord.Option(str, description=MESSAGES['commands']['options']['player_name'])):
+    async def add_player(ctx: discord.ApplicationContext, player_name: discord.Option(str, description=MESSAGES['commands']['options']['player_name']),
+                         server_name: server_option()):
         await ctx.defer()
-        log_data = await sync_whitelist_log(load_log())
+        server = await resolve_server(ctx, server_name)
+        if server is None: return
+        await server.whitelist.ensure_fresh(server.sync_whitelist)
         command = f"whitelist add {player_name}"
 
-        response = send_command_to_server(command, True, ctx.author.name)
+        response = await send_command_to_server(command, True, ctx.author.name, server=server)
         if not response:
             await ctx.respond(MESSAGES['discord']['error_generic'])
             return
-        add_match = re.search(MESSAGES['settings']['regex_patterns']['add_success'], response, re.IGNORECASE)
+        add_match = server.regex.add_success.search(response)
 
         if add_match:
             correct_name = add_match.group(1)
-            log_data[correct_name.lower()] = ctx.author.id
-            save_log(log_data)
+            server.whitelist.apply_added(correct_name, ctx.author.id, actor_id=ctx.author.id)
             await ctx.respond(MESSAGES['discord']['add_success'].format(player_name=correct_name))
 
         elif MESSAGES['settings']['non_regex_patterns']['already_whitelisted'] in response:
-            adder_name = await get_adder_name(ctx.guild, log_data.get(player_name.lower(), ADMIN_USER_ID))
+            # サーバー側にはあるがメモリ上にない(照合前の変更)場合は管理者による追加として記録する
+            if player_name not in server.whitelist: server.whitelist.apply_added(player_name, source='sync')
+            adder_name = await get_adder_name(ctx.guild, server.whitelist.adder_of(player_name, ADMIN_USER_ID))
             await ctx.respond(MESSAGES['discord']['add_already_exists'].format(player_name=player_name, adder_name=adder_name))
         
         elif MESSAGES['settings']['non_regex_patterns']['player_not_exist'] in response:
@@ -385,11 +828,13 @@ try:
     # --- ホワイトリスト削除コマンド ---
     rem_config = MESSAGES['commands']['ws']['subcommands']['rem']
     @ws.command(name=rem_config['name'], description=rem_config['description'])
-    async def remove_player(ctx: discord.ApplicationContext, player_name: discord.Option(str, description=MESSAGES['commands']['options']['player_name'])):
+    async def remove_player(ctx: discord.ApplicationContext, player_name: discord.Option(str, description=MESSAGES['commands']['options']['player_name']),
+                            server_name: server_option()):
         await ctx.defer()
-        log_data = await sync_whitelist_log(load_log())
-        player_key = player_name.lower()
-        adder_id = log_data.get(player_key)
+        server = await resolve_server(ctx, server_name)
+        if server is None: return
+        await server.whitelist.ensure_fresh(server.sync_whitelist)
+        adder_id = server.whitelist.adder_of(player_name)
 
         # Noneならplayer is not whitelistedなのかThat player does not existなのか分岐させたいので一度通す
         if adder_id is not None:
@@ -400,22 +845,20 @@ try:
                 return
 
         command = f"whitelist remove {player_name}"
-        response = send_command_to_server(command, True, executor=ctx.author.name)
+        response = await send_command_to_server(command, True, executor=ctx.author.name, server=server)
         if not response:
             await ctx.respond(MESSAGES['discord']['error_generic'])
             return
 
-        remove_match = re.search(MESSAGES['settings']['regex_patterns']['remove_success'], response, re.IGNORECASE)
+        remove_match = server.regex.remove_success.search(response)
         
         if remove_match:
             correct_name = remove_match.group(1)
-            if correct_name.lower() in log_data: del log_data[correct_name.lower()]
-            save_log(log_data)
+            server.whitelist.apply_removed(correct_name, actor_id=ctx.author.id)
             await ctx.respond(MESSAGES['discord']['remove_success'].format(player_name=correct_name))
 
         elif MESSAGES['settings']['non_regex_patterns']['not_whitelisted'] in response:
-            if player_key in log_data: del log_data[player_key]
-            save_log(log_data)
+            server.whitelist.apply_removed(player_name, actor_id=ctx.author.id, source='sync')
             await ctx.respond(MESSAGES['discord']['remove_not_on_list'].format(player_name=player_name))
 
         elif MESSAGES['settings']['non_regex_patterns']['player_not_exist'] in response:
@@ -429,76 +872,202 @@ try:
     # --- ホワイトリスト表示コマンド ---
     list_config = MESSAGES['commands']['ws']['subcommands']['list']
     @ws.command(name=list_config['name'], description=list_config['description'])
-    async def list_players(ctx: discord.ApplicationContext):
+    async def list_players(ctx: discord.ApplicationContext,
+                           refresh: discord.Option(bool, description=MESSAGES['commands']['options']['refresh'], default=False),
+                           compact: discord.Option(bool, description=MESSAGES['commands']['options']['compact'], default=None),
+                           server_name: server_option()):
         await ctx.defer()
-        log_data = await sync_whitelist_log(load_log())
+        server = await resolve_server(ctx, server_name)
+        if server is None: return
 
+        # メモリ上の状態から答える。照合が必要な場合(または明示的に要求された場合)だけRCONを使う
         print(MESSAGES['console']['list_fetch_started'])
-        response = send_command_to_server("whitelist list", True)
-        if not response:
+        if not await server.whitelist.ensure_fresh(server.sync_whitelist, force=refresh) and server.whitelist.last_reconciled is None:
             await ctx.respond(MESSAGES['discord']['error_white_list_fetch_failed'])
             return
-        
-        embed = discord.Embed(color=0x784dbe, timestamp=discord.utils.utcnow())
-        match = re.search(MESSAGES['settings']['regex_patterns']['whitelist_list'], response)
-
-        if match:
-            players = sorted([name.strip() for name in match.group(1).split(',')], key=str.lower)
-
-            embed.description = MESSAGES['discord']['list_title'].format(count=len(players))
-
-            for player in players:
-                adder_id = log_data.get(player.lower(), ADMIN_USER_ID)
-                adder_name = await get_adder_name(ctx.guild, adder_id)
-                if adder_name in [MESSAGES['discord']['adders']['adder_admin'], MESSAGES['discord']['adders']['adder_unknown']]:
-                    adder_name = MESSAGES['discord']['adders']['list_adder_na']
-                embed.add_field(name=player, value=adder_name, inline=True)
-        else:
-            embed.description = MESSAGES['discord']['list_no_players']
 
-        footer_text = MESSAGES['discord']['embed_footers']['whitelist']
-        if bot.user.avatar: embed.set_footer(text=footer_text, icon_url=bot.user.avatar.url)
-        else: embed.set_footer(text=footer_text)
-        await ctx.respond(MESSAGES['discord']['whitelist_list_header'], embed=embed)
+        # この時点の一覧をスナップショットとして、ページ送りの間も使い回す
+        players = server.whitelist.sorted_players()
+        title = MESSAGES['discord']['list_title'].format(count=len(players)) if players else MESSAGES['discord']['list_no_players']
+        await respond_player_list(ctx, server, players, MESSAGES['discord']['whitelist_list_header'], title,
+                                  MESSAGES['discord']['embed_footers']['whitelist'], compact)
 
 
     # --- オンラインプレイヤー表示コマンド (/ls) ---
     online_config = MESSAGES['commands']['ls']
     @bot.slash_command(name=online_config['name'], description=online_config['description'])
-    async def show_online_players(ctx: discord.ApplicationContext):
+    async def show_online_players(ctx: discord.ApplicationContext,
+                                  compact: discord.Option(bool, description=MESSAGES['commands']['options']['compact'], default=None),
+                                  server_name: server_option()):
         """サーバーにオンラインのプレイヤーと、その追加者の一覧をEmbedで表示する"""
         await ctx.defer()
-        # 追加者情報を参照するために、まずログを読み込む
-        log_data = load_log()
-
-        print("Fetching online player list...")
-        response = send_command_to_server("list", True)
-        if not response:
+        server = await resolve_server(ctx, server_name)
+        if server is None: return
+        # 参加・退出のログから作った索引で答える。RCONのlistは起動後まだ一度も照合していない場合だけ
+        if not await server.sessions.ensure_ready(server.sync_sessions):
             await ctx.respond(MESSAGES['discord']['error_online_list_fetch_failed'])
             return
 
+        sessions = dict(server.sessions.sessions())
+        players = list(sessions)
+        if players: # プレイヤーがいる場合
+            title = MESSAGES['discord']['online_title'].format(count=len(players))
+        else: # 誰もいない場合
+            title = MESSAGES['discord']['online_no_players']
+
+        await respond_player_list(ctx, server, players, MESSAGES['discord']['online_list_header'], title,
+                                  MESSAGES['discord']['embed_footers']['online_players'], compact, sessions=sessions)
+
+
+    # --- プレイ時間ランキング表示コマンド (/playtime) ---
+    playtime_config = MESSAGES['commands']['playtime']
+    @bot.slash_command(name=playtime_config['name'], description=playtime_config['description'])
+    async def show_playtime(ctx: discord.ApplicationContext, server_name: server_option()):
+        """累計のプレイ時間の上位をEmbedで表示する(メモリ上の索引から答える)"""
+        server = await resolve_server(ctx, server_name)
+        if server is None: return
+        labels = MESSAGES['discord']['playtime']
+        ranking = server.sessions.leaderboard(sessions_config['leaderboard_size'])
+        lines = [labels['line'].format(rank=rank, player_name=name, duration=format_duration(seconds),
+                                       online=labels['online_mark'] if online else "")
+                 for rank, (name, seconds, online) in enumerate(ranking, 1)]
         embed = discord.Embed(color=0x784dbe, timestamp=discord.utils.utcnow())
-        match = re.search(MESSAGES['settings']['regex_patterns']['online_list'], response)
-        
-        if match and match.group(1): # プレイヤーがいる場合
-            players = sorted([name.strip() for name in match.group(1).split(',')], key=str.lower)
+        embed.description = "\n".join([labels['title'].format(server=server.label)] + (lines or [labels['no_players']]))
+        await ctx.respond(embed=embed)
+
+
+    # --- 過去ログ検索コマンド (/logsearch) ---
+    logsearch_config = MESSAGES['commands']['logsearch']
+    @bot.slash_command(name=logsearch_config['name'], description=logsearch_config['description'])
+    async def search_logs(ctx: discord.ApplicationContext,
+                          player_name: discord.Option(str, name='player', description=MESSAGES['commands']['options']['player_name'], default=None),
+                          since: discord.Option(str, description=MESSAGES['commands']['options']['since'], default=None),
+                          event_type: discord.Option(str, name='type', description=MESSAGES['commands']['options']['type'],
+                                                     choices=list(EVENT_KINDS), default=None),
+                          server_name: server_option()):
+        """索引から条件に合うイベントを新しい順に検索し、ページ送りのEmbedで表示する"""
+        server = await resolve_server(ctx, server_name)
+        if server is None: return
+        labels = MESSAGES['discord']['logsearch']
+        if server.log_index is None:
+            await ctx.respond(labels['disabled'])
+            return
+        try: since_at = parse_since(since) if since else None
+        except ValueError:
+            await ctx.respond(labels['bad_since'].format(since=since))
+            return
+        max_results = log_index_config['max_results']
+        # 上限+1件を引いて、上限を超えたかどうかだけを知る(件数を数えるための全件走査はしない)
+        rows = await asyncio.to_thread(server.log_index.search, player_name, event_type, since_at, max_results + 1)
+        count = f"{max_results}+" if len(rows) > max_results else str(len(rows))
+        rows = rows[:max_results]
+        title = labels['title'].format(server=server.label, count=count)
+        if not rows:
+            await ctx.respond(embed=discord.Embed(color=0x784dbe, description=f"{title}\n{labels['no_results']}"))
+            return
 
-            embed.description = MESSAGES['discord']['online_title'].format(count=len(players))
+        async def render(page_rows, page, pages):
+            lines = [labels['line'].format(time=time.strftime(labels['time_format'], time.localtime(at)),
+                                           type=labels['types'][kind], player_name=player or "-", detail=detail)
+                     for at, kind, player, detail in page_rows]
+            return discord.Embed(color=0x784dbe, description="\n".join([title] + lines))
+
+        view = PlayerPages(rows, render, log_index_config['page_size'], MESSAGES['discord']['pagination'],
+                           author_id=ctx.author.id, timeout=MESSAGES['settings']['player_list']['view_timeout'])
+        embed = await view.embed_for(0)
+        if view.pages == 1:
+            await ctx.respond(embed=embed)
+            return
+        view.message = await ctx.respond(embed=embed, view=view)
+
+
+    # --- サーバー負荷の推移表示コマンド (/lag) ---
+    lag_command_config = MESSAGES['commands']['lag']
+    @bot.slash_command(name=lag_command_config['name'], description=lag_command_config['description'])
+    async def show_lag(ctx: discord.ApplicationContext,
+                       minutes: discord.Option(int, description=MESSAGES['commands']['options']['minutes'], default=60,
+                                               min_value=1, max_value=lag_config['max_minutes']),
+                       image: discord.Option(bool, description=MESSAGES['commands']['options']['image'], default=False),
+                       server_name: server_option()):
+        """直近minutes分の警告の集計と、推移のスパークライン(任意でPNG)をEmbedで表示する"""
+        server = await resolve_server(ctx, server_name)
+        if server is None: return
+        labels = MESSAGES['discord']['lag']
+        window = minutes * 60
+        summary = server.lag.summary(window)
+        values = server.lag.buckets(window, lag_config['sparkline_width'])
+
+        def ms(value):
+            return "-" if value is None else f"{value:.0f}ms"
 
-            for player in players:
-                adder_id = log_data.get(player.lower(), ADMIN_USER_ID)
-                adder_name = await get_adder_name(ctx.guild, adder_id)
-                if adder_name in [MESSAGES['discord']['adders']['adder_admin'], MESSAGES['discord']['adders']['adder_unknown']]:
-                    adder_name = MESSAGES['discord']['adders']['list_adder_na']
-                embed.add_field(name=player, value=adder_name, inline=True)
+        embed = discord.Embed(color=0x784dbe, timestamp=discord.utils.utcnow())
+        embed.description = labels['title'].format(minutes=minutes, server=server.label)
+        if summary['samples']:
+            embed.description += f"\n`{sparkline(values)}`"
+            embed.add_field(name=labels['health'], value=f"{summary['health']:.1%}", inline=True)
+            embed.add_field(name=labels['warnings'], value=labels['warnings_value'].format(
+                count=summary['samples'], spikes=summary['spikes'], ticks=int(summary['skipped_ticks'])), inline=True)
+            embed.add_field(name=labels['latency'], value=f"p50 {ms(summary['p50'])} / p95 {ms(summary['p95'])} / max {ms(summary['max'])}", inline=False)
+        else:
+            embed.add_field(name=labels['health'], value=labels['no_warnings'], inline=False)
+        if summary['truncated']:
+            embed.set_footer(text=labels['truncated'])
+        if image and summary['samples']:
+            embed.set_image(url="attachment://lag.png")
+            await ctx.respond(embed=embed, file=discord.File(io.BytesIO(render_png(values)), filename="lag.png"))
+            return
+        await ctx.respond(embed=embed)
+
+
+    # --- 稼働状況表示コマンド (/stats, 管理者のみ) ---
+    stats_config = MESSAGES['commands']['stats']
+    @bot.slash_command(name=stats_config['name'], description=stats_config['description'])
+    @discord.default_permissions(administrator=True)
+    @discord.guild_only()
+    async def show_stats(ctx: discord.ApplicationContext):
+        """メトリクスの要約を、実行した管理者にだけ見えるEmbedで表示する"""
+        # DMではctx.authorがUserでguild_permissionsがない
+        if ctx.guild is None or not ctx.author.guild_permissions.administrator:
+            await ctx.respond(MESSAGES['discord']['stats_permission_denied'], ephemeral=True)
+            return
+        METRICS.refresh()
+        labels = MESSAGES['discord']['stats']
 
-        else: # 誰もいない場合
-            embed.description = MESSAGES['discord']['online_no_players']
+        def ms(seconds):
+            return "-" if seconds is None else f"{seconds * 1000:.1f}ms"
 
-        footer_text = MESSAGES['discord']['embed_footers']['online_players']
-        if bot.user.avatar: embed.set_footer(text=footer_text, icon_url=bot.user.avatar.url)
-        else: embed.set_footer(text=footer_text)
-        await ctx.respond(MESSAGES['discord']['online_list_header'], embed=embed)
+        def latency(histogram, **histogram_labels):
+            return (f"{histogram.count(**histogram_labels)} / p50 {ms(histogram.quantile(0.5, **histogram_labels))}"
+                    f" / p95 {ms(histogram.quantile(0.95, **histogram_labels))}")
+
+        def prefix(labelset):
+            # 複数サーバー構成ではサーバー名を添える
+            return f"{labelset['server']} " if len(SERVERS) > 1 else ""
+
+        matched = ", ".join(f"{prefix(labelset)}{labelset['pattern']}: {LOG_LINES_MATCHED.value(**labelset)}" for labelset in LOG_LINES_MATCHED.labelsets())
+        lines_read = sum(LOG_LINES_READ.value(**labelset) for labelset in LOG_LINES_READ.labelsets())
+        tail_lag = sum(LOG_TAIL_LAG.value(**labelset) for labelset in LOG_TAIL_LAG.labelsets())
+        rcon_lines = [f"{prefix(labelset)}{labelset['command']}: {latency(RCON_SECONDS, **labelset)}" for labelset in RCON_SECONDS.labelsets()]
+        rcon_lines += [f"{prefix(labelset)}{labelset['command']} errors: {RCON_ERRORS.value(**labelset)}" for labelset in RCON_ERRORS.labelsets()]
+        queue_depth = sum(DISCORD_QUEUE_DEPTH.value(**labelset) for labelset in DISCORD_QUEUE_DEPTH.labelsets())
+        uptime = int(time.time() - METRICS.started_at)
+
+        embed = discord.Embed(color=0x784dbe, timestamp=discord.utils.utcnow())
+        embed.add_field(name=labels['log'], value=(
+            f"read {lines_read} / matched {matched or 0}\n"
+            f"lag {tail_lag} bytes / batch {latency(LOG_BATCH_SECONDS)}"), inline=False)
+        embed.add_field(name=labels['rcon'], value="\n".join(rcon_lines) or "-", inline=False)
+        embed.add_field(name=labels['conversion'], value=(
+            f"{latency(CONVERSION_SECONDS)}\nhit ratio {CONVERSION_HIT_RATIO.value():.0%} / breaker {yahoo_converter.breaker.state}"), inline=False)
+        embed.add_field(name=labels['discord'], value=(
+            f"send {latency(DISCORD_SEND_SECONDS)}\nqueued p95 {ms(DISCORD_QUEUE_SECONDS.quantile(0.95))} / depth {queue_depth}"), inline=False)
+        embed.add_field(name=labels['event_loop'], value=(
+            f"p99 {ms(LOOP_LAG_SECONDS.quantile(0.99))} / recent max {ms(LOOP_LAG_MAX.value())}"), inline=False)
+        if profiler is not None:
+            hot = "\n".join(f"{share:.0%} {name}" for name, share in profiler.top(5))
+            embed.add_field(name=labels['profiler'], value=hot or "-", inline=False)
+        embed.set_footer(text=labels['uptime'].format(hours=uptime // 3600, minutes=uptime % 3600 // 60))
+        await ctx.respond(embed=embed, ephemeral=True)
 
 except KeyError as e:
     # config_load_errorはMESSAGESがロードされる前に発生する可能性があるためハードコード
@@ -507,7 +1076,10 @@ except KeyError as e:
 
 
 if __name__ == "__main__":
-    required_env = ["DISCORD_BOT_TOKEN", "RCON_HOST", "RCON_PORT", "RCON_PASSWORD", "YAHOO_APPID", "CHANNEL_ID", "LOG_FILE_PATH"]
+    required_env = ["DISCORD_BOT_TOKEN", "YAHOO_APPID"]
+    if not MESSAGES['settings'].get('servers'):
+        # 1台構成では接続先を.envから読む
+        required_env += ["RCON_HOST", "RCON_PORT", "RCON_PASSWORD", "CHANNEL_ID", "LOG_FILE_PATH"]
     if not all(os.getenv(key) for key in required_env):
         print(MESSAGES['console']['env_missing'])
     else:
@@ -519,4 +1091,15 @@ if __name__ == "__main__":
                 print("Stopping log file observer...")
                 log_observer.stop()
                 log_observer.join() # スレッドが完全に終了するのを待つ
-                print("Log file observer stopped.")
\ No newline at end of file
+                print("Log file observer stopped.")
+            # 読み取り位置を保存し、次回起動時にそこから再開できるようにする
+            for server in SERVERS.values():
+                if server.log_handler is not None:
+                    server.log_handler.stop()
+                server.store.close()
+                server.sessions.close()
+                if server.log_index is not None: server.log_index.close()
+            if profiler is not None:
+                profiler.stop()
+                profiler.write_collapsed(metrics_config['profiler']['output_file'])
+                print(MESSAGES['console']['profiler_saved'].format(path=metrics_config['profiler']['output_file']))
\ No newline at end of file
@@ -0,0 +1,126 @@
+"""DiscordメンバーIDから表示名を引くリゾルバ(重複除去・同時問い合わせ数の制限・TTLキャッシュ付き)"""
+import asyncio
+import collections
+
+import discord
+
+from ttl_cache import TTLCache
+
+# Gatewayのメンバー問い合わせ(REQUEST_GUILD_MEMBERS)で一度に指定できるIDの上限
+QUERY_CHUNK_LIMIT = 100
+
+
+class MemberNameResolver:
+    """ギルドのメンバー表示名を解決する
+
+    Gatewayのメンバーキャッシュ -> TTLキャッシュ -> Gatewayの一括問い合わせ -> fetch_member(同時実行数制限)
+    の順に引く。脱退済み(NotFound)も短めのTTLでキャッシュし、メンバー更新・参加・脱退イベントで無効化する。
+    """
+
+    def __init__(self, ttl=600.0, negative_ttl=120.0, concurrency=4, bulk_threshold=5, cache_size=4096, log=None):
+        self.names = TTLCache(cache_size, ttl)
+        self.missing = TTLCache(cache_size, negative_ttl)
+        self.bulk_threshold = int(bulk_threshold)
+        self.log = log or (lambda key, **kwargs: None)
+        self._semaphore = asyncio.Semaphore(max(1, int(concurrency)))
+        self._inflight = {}
+        self.counters = collections.Counter()
+
+    # --- 参照 ---
+    def _cached(self, guild, user_id):
+        """(見つかったか, 表示名またはNone)。Noneは脱退済みとしてキャッシュされている"""
+        member = guild.get_member(user_id)
+        if member is not None:
+            self.counters['gateway_hits'] += 1
+            return True, member.display_name
+        key = (guild.id, user_id)
+        name = self.names.get(key)
+        if name is not None:
+            self.counters['cache_hits'] += 1
+            return True, name
+        if self.missing.get(key):
+            self.counters['negative_hits'] += 1
+            return True, None
+        return False, None
+
+    async def resolve(self, guild, user_id):
+        """表示名を返す。ギルドにいなければNone"""
+        return (await self.resolve_many(guild, [user_id]))[user_id]
+
+    async def resolve_many(self, guild, user_ids):
+        """{ID: 表示名またはNone} を返す。同じIDは1回しか問い合わせない"""
+        result, misses = {}, []
+        for user_id in dict.fromkeys(user_ids):
+            found, name = self._cached(guild, user_id)
+            if found:
+                result[user_id] = name
+            else:
+                misses.append(user_id)
+        if not misses:
+            return result
+
+        # 取りこぼしが多い場合は、まずGatewayでまとめて問い合わせる(HTTPのレート制限を消費しない)
+        if len(misses) >= self.bulk_threshold:
+            for start in range(0, len(misses), QUERY_CHUNK_LIMIT):
+                result.update(await self._query_chunk(guild, misses[start:start + QUERY_CHUNK_LIMIT]))
+            misses = [user_id for user_id in misses if user_id not in result]
+
+        names = await asyncio.gather(*(self._fetch(guild, user_id) for user_id in misses))
+        result.update(zip(misses, names))
+        return result
+
+    async def _query_chunk(self, guild, user_ids):
+        self.counters['bulk_queries'] += 1
+        try:
+            members = await guild.query_members(user_ids=user_ids, limit=len(user_ids), cache=True)
+        except (asyncio.TimeoutError, discord.ClientException, discord.HTTPException) as e:
+            self.log('member_query_failed', error=e)
+            return {}
+        found = {}
+        for member in members:
+            found[member.id] = member.display_name
+            self.names.set((guild.id, member.id), member.display_name)
+        return found
+
+    async def _fetch(self, guild, user_id):
+        """fetch_memberで1件引く。同じIDの同時問い合わせは1回にまとめる"""
+        key = (guild.id, user_id)
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.counters['coalesced'] += 1
+            return await asyncio.shield(inflight)
+
+        task = asyncio.ensure_future(self._fetch_once(guild, user_id))
+        self._inflight[key] = task
+        try:
+            return await asyncio.shield(task)
+        finally:
+            if self._inflight.get(key) is task:
+                del self._inflight[key]
+
+    async def _fetch_once(self, guild, user_id):
+        key = (guild.id, user_id)
+        async with self._semaphore:
+            self.counters['fetches'] += 1
+            try:
+                member = await guild.fetch_member(user_id)
+            except discord.NotFound:
+                # サーバーから既に脱退している
+                self.missing.set(key, True)
+                return None
+            except discord.HTTPException as e:
+                # 一時的な失敗はキャッシュしない
+                self.log('member_fetch_failed', user_id=user_id, error=e)
+                return None
+        self.names.set(key, member.display_name)
+        return member.display_name
+
+    # --- 無効化 ---
+    def invalidate(self, guild_id, user_id):
+        """メンバーの更新・参加・脱退時に呼ぶ"""
+        key = (guild_id, user_id)
+        self.names.pop(key)
+        self.missing.pop(key)
+
+    def stats(self):
+        return {'cached_names': len(self.names), 'cached_missing': len(self.missing), **self.counters}
@@ -0,0 +1,312 @@
+"""メトリクス(カウンター・ゲージ・ヒストグラム)の登録簿と、その公開手段
+
+- MetricsRegistry.render(): Prometheusのテキスト形式
+- serve_metrics(): 任意で有効にするローカルHTTPエンドポイント(/metrics)
+- monitor_event_loop(): イベントループが塞がれていた時間の計測
+- SamplingProfiler: 任意で有効にするサンプリングプロファイラ(スタックを一定間隔で採取)
+"""
+import asyncio
+import bisect
+import collections
+import sys
+import threading
+import time
+
+from aiohttp import web
+
+# 秒単位の既定バケット(1ms〜30s)
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """ラベルの値の組ごとに値を持つ。監視スレッドからも更新されるのでロックで守る"""
+    kind = None
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.label_names) if labels else ()
+
+    def labelsets(self):
+        """記録のあるラベルの組を {ラベル名: 値} のリストで返す"""
+        return [dict(zip(self.label_names, key)) for key in list(self._values)]
+
+    def samples(self):
+        """[(サフィックス, ラベル値の組, 追加ラベル, 値)]"""
+        with self._lock:
+            return [('', key, (), value) for key, value in self._values.items()]
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set_total(self, value, **labels):
+        """他のコンポーネントが数えている累計をそのまま写す(collectorから使う)"""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]  # バケット別件数, 合計, 件数
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def time(self, **labels):
+        """with文で囲んだ処理の所要時間を記録する"""
+        return _Timer(self, labels)
+
+    def count(self, **labels):
+        entry = self._values.get(self._key(labels))
+        return entry[2] if entry else 0
+
+    def quantile(self, q, **labels):
+        """バケットから線形補間した分位点の概算(記録がなければNone)"""
+        entry = self._values.get(self._key(labels))
+        if not entry or not entry[2]:
+            return None
+        target, seen, lower = q * entry[2], 0, 0.0
+        for upper, count in zip(self.buckets, entry[0]):
+            if count and seen + count >= target:
+                return lower + (upper - lower) * (target - seen) / count
+            seen += count
+            lower = upper
+        return lower  # 最大のバケットを超えた分は、そのバケットの上限として扱う
+
+    def samples(self):
+        result = []
+        with self._lock:
+            for key, (counts, total, count) in self._values.items():
+                cumulative = 0
+                for upper, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += bucket_count
+                    result.append(('_bucket', key, (('le', _format_value(upper)),), cumulative))
+                result.append(('_sum', key, (), total))
+                result.append(('_count', key, (), count))
+        return result
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+
+class MetricsRegistry:
+    """メトリクスの登録簿。collect()で登録した関数は出力の直前に呼ばれ、ゲージなどを最新にする"""
+
+    def __init__(self, prefix='', log=None):
+        self.prefix = prefix
+        self.metrics = collections.OrderedDict()
+        self.log = log or (lambda key, **kwargs: None)
+        self._collectors = []
+        self._failing = set()  # 失敗中の関数(続けて失敗しても記録は最初の1回だけ)
+        self.started_at = time.time()
+
+    def _register(self, cls, name, help_text, **kwargs):
+        full_name = self.prefix + name
+        metric = self.metrics.get(full_name)
+        if metric is None:
+            metric = self.metrics[full_name] = cls(full_name, help_text, **kwargs)
+        return metric
+
+    def counter(self, name, help_text, labels=()):
+        return self._register(Counter, name, help_text, labels=labels)
+
+    def gauge(self, name, help_text, labels=()):
+        return self._register(Gauge, name, help_text, labels=labels)
+
+    def histogram(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram, name, help_text, labels=labels, buckets=buckets)
+
+    def collect(self, func):
+        """出力前に呼ぶ関数を登録する(デコレーターとしても使える)"""
+        self._collectors.append(func)
+        return func
+
+    def refresh(self):
+        for func in self._collectors:
+            try:
+                func()
+            except Exception as e:
+                # 計測のための読み取りでBotを止めない
+                if func not in self._failing:
+                    self._failing.add(func)
+                    self.log('metrics_collector_failed', name=getattr(func, '__name__', repr(func)), error=e)
+            else:
+                self._failing.discard(func)
+
+    def render(self):
+        """Prometheusのテキスト形式(version 0.0.4)で出力する"""
+        self.refresh()
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for suffix, key, extra, value in metric.samples():
+                lines.append(f"{metric.name}{suffix}{_format_labels(metric.label_names, key, extra)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+# --- HTTPエンドポイント ---
+
+async def serve_metrics(registry, host='127.0.0.1', port=9464):
+    """/metricsでPrometheus形式を返すHTTPサーバーを起動し、AppRunnerを返す(停止はrunner.cleanup())"""
+    async def handle(request):
+        return web.Response(text=registry.render(), content_type='text/plain', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+# --- イベントループの詰まり ---
+
+async def monitor_event_loop(histogram, gauge=None, interval=0.25):
+    """interval秒ごとに起き、予定より遅れた時間(=ループが他の処理で塞がれていた時間)を記録する"""
+    loop = asyncio.get_running_loop()
+    worst = 0.0
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - expected)
+        histogram.observe(lag)
+        if gauge is not None:
+            worst = max(lag, worst * 0.99)  # ゆっくり減衰させ、直近の最悪値を残す
+            gauge.set(worst)
+
+
+# --- サンプリングプロファイラ ---
+
+# 待機中のスレッドの最も内側のフレーム(ファイル名, 関数名)。これらで止まっているスレッドは採取しない
+_IDLE_FRAMES = frozenset({
+    ('threading.py', 'wait'),                   # Event.wait / Condition.wait
+    ('threading.py', '_wait_for_tstate_lock'),  # Thread.join
+    ('selectors.py', 'select'),                 # asyncioのイベントループの待ち
+    ('thread.py', '_worker'),                   # ThreadPoolExecutor(asyncio.to_thread)の空きワーカー
+    ('queue.py', 'get'),
+    ('socket.py', 'accept'),
+    ('socket.py', 'readinto'),
+    ('ssl.py', 'read'),
+})
+
+
+class SamplingProfiler(threading.Thread):
+    """interval秒ごとに全スレッドのスタックを採取し、関数ごと・スタックごとの出現回数を数える
+
+    関数ごとの集計は、rootsの下にあるファイルのうち最も内側のフレームに数える
+    (ライブラリ内の処理も、それを呼んだ自前の処理の時間として分かる)。
+    select待ちやEvent.waitなどで止まっているスレッドは数えない。
+    スタック全体はcollapsed形式(flamegraph.plで描ける)で書き出せる。
+    """
+
+    def __init__(self, interval=0.005, roots=(), max_depth=48):
+        super().__init__(name='sampling-profiler', daemon=True)
+        self.interval = float(interval)
+        self.roots = tuple(roots)
+        self.max_depth = int(max_depth)
+        self.stacks = collections.Counter()
+        self.functions = collections.Counter()
+        self.samples = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        own = threading.get_ident()
+        names = {}
+        while not self._stop_event.wait(self.interval):
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                code = frame.f_code
+                if (code.co_filename.rsplit('/', 1)[-1], code.co_name) in _IDLE_FRAMES:
+                    continue
+                stack, hot = [], None
+                while frame is not None and len(stack) < self.max_depth:
+                    code = frame.f_code
+                    label = f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{code.co_firstlineno})"
+                    if hot is None and (not self.roots or code.co_filename.startswith(self.roots)):
+                        hot = label
+                    stack.append(label)
+                    frame = frame.f_back
+                if hot is not None:
+                    self.functions[hot] += 1
+                if stack:
+                    self.stacks[(names.get(ident, str(ident)),) + tuple(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self):
+        self._stop_event.set()
+
+    def top(self, count=10):
+        """[(関数, 採取したサンプルに占める割合)]"""
+        total = sum(self.functions.values()) or 1
+        return [(name, hits / total) for name, hits in self.functions.most_common(count)]
+
+    def write_collapsed(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, hits in self.stacks.most_common():
+                f.write(';'.join(stack) + f" {hits}\n")
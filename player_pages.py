@@ -0,0 +1,80 @@
+"""プレイヤー一覧のページ送り表示(ボタン付きEmbed)
+
+一覧は呼び出し時点のスナップショットを使い回し、ページを開いたときにそのページの分だけ描画する。
+描画済みのページはキャッシュし、同じページに戻ったときは再描画しない。
+"""
+import discord
+
+# Embedのフィールド数の上限は25。インライン表示で3列に揃うよう24にしている
+MAX_FIELDS_PER_PAGE = 24
+
+
+def page_count(total, page_size):
+    return max(1, -(-total // page_size))
+
+
+class PlayerPages(discord.ui.View):
+    """players(並べ替え済み)をpage_size件ずつrender(page_players, page, pages)で描画する
+
+    renderはそのページのEmbedを返すコルーチン関数。追加者名の解決などはrenderの中で行う。
+    """
+
+    def __init__(self, players, render, page_size, labels, author_id=None, timeout=300.0):
+        super().__init__(timeout=timeout)
+        self.players = tuple(players)
+        self.render = render
+        self.page_size = max(1, int(page_size))
+        self.pages = page_count(len(self.players), self.page_size)
+        self.page = 0
+        self.author_id = author_id
+        self.message = None
+        self._cache = {}
+
+        self.prev_button = discord.ui.Button(label=labels['prev'], style=discord.ButtonStyle.secondary)
+        self.page_button = discord.ui.Button(style=discord.ButtonStyle.secondary, disabled=True)
+        self.next_button = discord.ui.Button(label=labels['next'], style=discord.ButtonStyle.secondary)
+        self.prev_button.callback = self._on_prev
+        self.next_button.callback = self._on_next
+        self._page_label = labels['page']
+        for button in (self.prev_button, self.page_button, self.next_button):
+            self.add_item(button)
+        self._update_buttons()
+
+    async def embed_for(self, page):
+        embed = self._cache.get(page)
+        if embed is None:
+            start = page * self.page_size
+            embed = await self.render(self.players[start:start + self.page_size], page, self.pages)
+            self._cache[page] = embed
+        return embed
+
+    def _update_buttons(self):
+        self.prev_button.disabled = self.page == 0
+        self.next_button.disabled = self.page >= self.pages - 1
+        self.page_button.label = self._page_label.format(page=self.page + 1, pages=self.pages)
+
+    async def _turn(self, interaction, page):
+        if self.author_id is not None and interaction.user.id != self.author_id:
+            await interaction.response.defer()
+            return
+        self.page = max(0, min(page, self.pages - 1))
+        self._update_buttons()
+        # 未描画のページはmemberの取得で3秒の応答期限を越えうるので、先に応答してから書き換える
+        await interaction.response.defer()
+        embed = await self.embed_for(self.page)
+        try: await interaction.edit_original_response(embed=embed, view=self)
+        except discord.HTTPException: pass
+
+    async def _on_prev(self, interaction):
+        await self._turn(interaction, self.page - 1)
+
+    async def _on_next(self, interaction):
+        await self._turn(interaction, self.page + 1)
+
+    async def on_timeout(self):
+        # 操作できなくなったボタンは無効化して残す
+        for item in self.children:
+            item.disabled = True
+        if self.message is not None:
+            try: await self.message.edit(view=self)
+            except discord.HTTPException: pass
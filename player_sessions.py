@@ -0,0 +1,160 @@
+"""オンラインのプレイヤーとプレイ時間のメモリ上の索引
+
+参加・退出のログから更新し、取りこぼし(サーバーのクラッシュやログのローテーション)はRCONのlistとの
+照合で直す。/lsと/playtimeはこの索引から答えるので、コマンドのたびにRCONを使わない。
+累計のプレイ時間はメモリ上で数え、変わった分だけを間隔を空けてまとめてSQLiteに書き込む。
+"""
+import asyncio
+import sqlite3
+import time
+
+
+class PlaytimeStore:
+    """累計のプレイ時間の保存先(SQLite, WALモード)。書き込みは変わった行だけを1トランザクションで行う"""
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = sqlite3.connect(path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS playtime ("
+                "player TEXT PRIMARY KEY, name TEXT NOT NULL, seconds REAL NOT NULL, "
+                "sessions INTEGER NOT NULL, last_seen REAL NOT NULL)")
+
+    def load(self):
+        """{小文字の名前: [表記, 累計秒, セッション数, 最終確認時刻]} を返す"""
+        return {player: [name, seconds, sessions, last_seen] for player, name, seconds, sessions, last_seen
+                in self._conn.execute("SELECT player, name, seconds, sessions, last_seen FROM playtime")}
+
+    def save(self, rows):
+        """rows: {小文字の名前: [表記, 累計秒, セッション数, 最終確認時刻]}"""
+        if not rows:
+            return
+        with self._conn:
+            self._conn.executemany(
+                "INSERT INTO playtime (player, name, seconds, sessions, last_seen) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(player) DO UPDATE SET name = excluded.name, seconds = excluded.seconds, "
+                "sessions = excluded.sessions, last_seen = excluded.last_seen",
+                [(player, *row) for player, row in rows.items()])
+
+    def close(self):
+        self._conn.close()
+
+
+class SessionIndex:
+    """1台分のオンラインのプレイヤーと累計のプレイ時間
+
+    online: 小文字の名前 -> (表記, 参加時刻)
+    totals: 小文字の名前 -> [表記, 終わったセッションの累計秒, セッション数, 最終確認時刻]
+
+    ログの時刻ではなく、Botが行を処理した時刻で数える。
+    """
+
+    def __init__(self, store, reconcile_interval=60.0, clock=time.time):
+        self.store = store
+        self.totals = store.load()
+        self.online = {}
+        self.reconcile_interval = float(reconcile_interval)
+        self.clock = clock
+        self.last_reconciled = None
+        self._dirty = set()
+        self._lock = None
+
+    # --- 参照 ---
+    def __contains__(self, player_name):
+        return player_name.lower() in self.online
+
+    def sessions(self, now=None):
+        """オンラインのプレイヤーを [(表記, 今回のセッションの秒数)] で返す(名前順)"""
+        now = self.clock() if now is None else now
+        return sorted(((name, max(0.0, now - joined_at)) for name, joined_at in self.online.values()),
+                      key=lambda session: session[0].lower())
+
+    def playtime(self, player_name, now=None):
+        """累計秒(オンラインなら今回のセッションを含む)"""
+        now = self.clock() if now is None else now
+        key = player_name.lower()
+        seconds = self.totals[key][1] if key in self.totals else 0.0
+        if key in self.online:
+            seconds += max(0.0, now - self.online[key][1])
+        return seconds
+
+    def leaderboard(self, limit=10, now=None):
+        """累計のプレイ時間の上位 [(表記, 累計秒, オンラインか)]"""
+        now = self.clock() if now is None else now
+        names = {key: row[0] for key, row in self.totals.items()}
+        names.update({key: name for key, (name, _) in self.online.items()})
+        ranking = sorted(((name, self.playtime(key, now), key in self.online) for key, name in names.items()),
+                         key=lambda entry: (-entry[1], entry[0].lower()))
+        return ranking[:limit]
+
+    # --- 更新 ---
+    def joined(self, player_name, at=None):
+        key = player_name.lower()
+        if key in self.online:
+            # 退出を取りこぼしていた場合は、前のセッションをここで閉じる
+            self._close(key, self.clock() if at is None else at)
+        self.online[key] = (player_name, self.clock() if at is None else at)
+
+    def left(self, player_name, at=None):
+        key = player_name.lower()
+        if key in self.online:
+            self._close(key, self.clock() if at is None else at)
+
+    def _close(self, key, at):
+        name, joined_at = self.online.pop(key)
+        row = self.totals.setdefault(key, [name, 0.0, 0, at])
+        row[0] = name
+        row[1] += max(0.0, at - joined_at)
+        row[2] += 1
+        row[3] = at
+        self._dirty.add(key)
+
+    def reconcile(self, server_names, at=None):
+        """RCONのlistの結果と突き合わせる。(ログになかった参加, ログになかった退出)を返す"""
+        at = self.clock() if at is None else at
+        server = {name.lower(): name for name in server_names}
+        missed_joins = [name for key, name in server.items() if key not in self.online]
+        missed_leaves = [self.online[key][0] for key in self.online if key not in server]
+        for name in missed_leaves:
+            self._close(name.lower(), at)
+        # 参加時刻は分からないので、気付いた時刻から数える
+        for name in missed_joins:
+            self.online[name.lower()] = (name, at)
+        self.last_reconciled = time.monotonic()
+        return missed_joins, missed_leaves
+
+    def needs_reconcile(self):
+        if self.last_reconciled is None:
+            return True
+        return self.reconcile_interval > 0 and time.monotonic() - self.last_reconciled >= self.reconcile_interval
+
+    async def ensure_ready(self, sync):
+        """一度も照合していなければsync()(RCONで照合するコルーチン関数)を呼ぶ。同時に呼ばれても照合は1回"""
+        if self.last_reconciled is not None:
+            return True
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self.last_reconciled is not None:
+                return True
+            return await sync()
+
+    def flush(self, now=None):
+        """終わったセッションで変わった行と、オンラインのプレイヤーの途中経過を書き込む"""
+        now = self.clock() if now is None else now
+        rows = {key: list(self.totals[key]) for key in self._dirty}
+        for key, (name, joined_at) in self.online.items():
+            # 落ちても失うのは前回の書き込みからの分だけ(次に閉じる時の累計はメモリ上の値で数える)
+            row = rows.get(key) or list(self.totals.get(key, [name, 0.0, 0, now]))
+            row[0], row[1], row[3] = name, row[1] + max(0.0, now - joined_at), now
+            rows[key] = row
+        self.store.save(rows)
+        self._dirty.clear()
+        return len(rows)
+
+    def close(self, now=None):
+        self.flush(now)
+        self.store.close()
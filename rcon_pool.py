@@ -0,0 +1,307 @@
+"""asyncioネイティブなSource RCONクライアントとコネクションプール"""
+import asyncio
+import itertools
+import struct
+import time
+
+# --- Source RCONプロトコル定数 ---
+SERVERDATA_AUTH = 3
+SERVERDATA_AUTH_RESPONSE = 2
+SERVERDATA_EXECCOMMAND = 2
+SERVERDATA_RESPONSE_VALUE = 0
+
+# size(4) + id(4) + type(4) を除いた本文の最大長(サーバー側の受信上限)
+MAX_COMMAND_BYTES = 1446
+_HEADER = struct.Struct('<ii')
+
+
+class RconError(Exception):
+    """RCON接続・コマンド実行の失敗"""
+
+
+class RconAuthError(RconError):
+    """RCONパスワードが拒否された"""
+
+
+class RconNotSentError(RconError):
+    """コマンドがサーバーへ送信される前に失敗した(再試行しても安全)"""
+
+
+def encode_packet(request_id, packet_type, body, encoding='utf-8'):
+    payload = _HEADER.pack(request_id, packet_type) + body.encode(encoding) + b'\x00\x00'
+    return struct.pack('<i', len(payload)) + payload
+
+
+async def read_packet(reader):
+    """パケットを1つ読み、(id, type, body bytes)を返す"""
+    size, = struct.unpack('<i', await reader.readexactly(4))
+    if size < 10:
+        raise RconError(f"Malformed RCON packet (size={size})")
+    data = await reader.readexactly(size)
+    request_id, packet_type = _HEADER.unpack(data[:8])
+    return request_id, packet_type, data[8:-2]
+
+
+class RconConnection:
+    """認証済みの1本のRCON接続。コマンドは1本につき同時に1つだけ送る。
+
+    Minecraft(vanilla/NeoForge)のRconClientは1回のread(最大1460バイト)を1パケットとして扱い、
+    長さが合わなければ接続を閉じる。2つのパケットが続けて届くとまとめて読まれてしまうので、
+    パイプライン送信はせず、マルチパケット応答の終わりは次のようにして判断する:
+    コマンドの最初の応答パケットが届いてから(=サーバーがコマンドを読み終えてから)空のRESPONSE_VALUE
+    パケット(番兵)を送り、その応答が届いた時点でコマンド応答が完結したとみなして結合する。
+    """
+
+    def __init__(self, host, port, password, timeout=5.0, encoding='utf-8'):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.timeout = timeout
+        self.encoding = encoding
+        self._reader = None
+        self._writer = None
+        self._reader_task = None
+        self._ids = itertools.count(1)
+        self._busy = asyncio.Lock()  # 送信中のコマンドは1つだけ
+        self._users = 0              # 実行中と順番待ちのコマンド数
+        self._request = None         # [コマンドID, 番兵ID, future, 断片リスト, 番兵を送ったか]
+        self.closed = True
+        self.last_used = 0.0
+
+    @property
+    def inflight(self):
+        return self._users
+
+    def _next_id(self):
+        request_id = next(self._ids)
+        if request_id >= 0x7fffffff:
+            self._ids = itertools.count(1)
+            request_id = next(self._ids)
+        return request_id
+
+    async def connect(self):
+        try:
+            self._reader, self._writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port), self.timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            raise RconNotSentError(f"Could not connect to {self.host}:{self.port}: {e!r}") from e
+        self.closed = False
+        try:
+            await asyncio.wait_for(self._authenticate(), self.timeout)
+        except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+            self.close()
+            raise RconNotSentError(f"RCON authentication did not complete: {e!r}") from e
+        except RconError:
+            self.close()
+            raise
+        self.last_used = time.monotonic()
+        self._reader_task = asyncio.get_running_loop().create_task(self._read_loop())
+
+    async def _authenticate(self):
+        auth_id = self._next_id()
+        self._writer.write(encode_packet(auth_id, SERVERDATA_AUTH, self.password, self.encoding))
+        await self._writer.drain()
+        while True:
+            request_id, packet_type, _ = await read_packet(self._reader)
+            # Source系サーバーは認証応答の前に空のRESPONSE_VALUEを返すので読み飛ばす
+            if packet_type != SERVERDATA_AUTH_RESPONSE:
+                continue
+            if request_id == -1:
+                raise RconAuthError("RCON password was rejected")
+            if request_id == auth_id:
+                return
+
+    async def _read_loop(self):
+        # 待機中の切断もすぐに検知できるよう、応答は常にこのタスクで読む
+        error = None
+        try:
+            while True:
+                request_id, _, body = await read_packet(self._reader)
+                self.last_used = time.monotonic()
+                request = self._request
+                if request is None:
+                    continue  # タイムアウト済みの応答などは捨てる
+                command_id, sentinel_id, future, chunks, sentinel_sent = request
+                if request_id == sentinel_id and sentinel_sent:
+                    self._request = None
+                    if not future.done():
+                        future.set_result(b''.join(chunks).decode(self.encoding, errors='replace'))
+                elif request_id == command_id:
+                    chunks.append(body)
+                    if not sentinel_sent:
+                        # 最初の応答が届いた = サーバーはコマンドを読み終えたので、ここで初めて番兵を送る
+                        request[4] = True
+                        self._writer.write(encode_packet(sentinel_id, SERVERDATA_RESPONSE_VALUE, '', self.encoding))
+        except asyncio.CancelledError:
+            error = RconError("RCON connection closed")
+        except (OSError, asyncio.IncompleteReadError, RconError) as e:
+            error = e if isinstance(e, RconError) else RconError(f"RCON connection lost: {e!r}")
+        finally:
+            self._fail_pending(error or RconError("RCON connection closed"))
+            self.close()
+
+    def _fail_pending(self, error):
+        if self._request is not None and not self._request[2].done():
+            self._request[2].set_exception(error)
+        self._request = None
+
+    async def _exchange(self, packet_id, sentinel_id, packet_type, body):
+        """パケットを1つ送り、番兵の応答までの本文を結合して返す。送信前の失敗はRconNotSentError"""
+        future = asyncio.get_running_loop().create_future()
+        # 番兵を送らない要求(死活確認)は、送ったパケット自体の応答で完結させる
+        self._request = [packet_id, sentinel_id, future, [], sentinel_id == packet_id]
+        try:
+            self._writer.write(encode_packet(packet_id, packet_type, body, self.encoding))
+            await self._writer.drain()
+        except OSError as e:
+            self._request = None
+            self.close()
+            raise RconNotSentError(f"Failed to send RCON packet: {e!r}") from e
+
+        self.last_used = time.monotonic()
+        try:
+            return await asyncio.wait_for(future, self.timeout)
+        except BaseException:
+            # 応答の途中で止めた(タイムアウト・キャンセル)接続は、遅れて届く応答と次のコマンドが混ざらないよう捨てる
+            self.close()
+            raise
+        finally:
+            self._request = None
+
+    async def run(self, command):
+        data = command.encode(self.encoding)
+        if len(data) > MAX_COMMAND_BYTES:
+            raise RconNotSentError(f"RCON command too long ({len(data)} bytes)")
+        self._users += 1
+        try:
+            async with self._busy:
+                if self.closed:
+                    raise RconNotSentError("RCON connection is closed")
+                try:
+                    return await self._exchange(self._next_id(), self._next_id(), SERVERDATA_EXECCOMMAND, command)
+                except asyncio.TimeoutError as e:
+                    raise RconError(f"RCON command timed out after {self.timeout}s") from e
+        finally:
+            self._users -= 1
+
+    async def ping(self):
+        """番兵パケットだけを送り、接続が生きているか確認する(コンソールには何も出ない)"""
+        self._users += 1
+        try:
+            async with self._busy:
+                if self.closed:
+                    raise RconNotSentError("RCON connection is closed")
+                ping_id = self._next_id()
+                try:
+                    await self._exchange(ping_id, ping_id, SERVERDATA_RESPONSE_VALUE, '')
+                except asyncio.TimeoutError as e:
+                    raise RconError(f"RCON keepalive failed: {e!r}") from e
+        finally:
+            self._users -= 1
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self._writer:
+            self._writer.close()
+        if self._reader_task and self._reader_task is not asyncio.current_task():
+            self._reader_task.cancel()
+
+
+class RconPool:
+    """長寿命の認証済みRCON接続を少数プールし、自動再接続とキープアライブを行う
+
+    1本の接続で同時に送るコマンドは1つだけなので、並行して実行できるコマンド数は接続数(size)まで。
+    全ての接続が使用中なら、待ちの少ない接続の順番を待つ(ソケットには積まない)。
+    """
+
+    def __init__(self, host, port, password, size=2, timeout=5.0, keepalive_interval=30.0, log=None):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.size = max(1, int(size))
+        self.timeout = float(timeout)
+        self.keepalive_interval = float(keepalive_interval)
+        self.log = log or (lambda key, **kwargs: None)
+        self._connections = []
+        self._connect_lock = None
+        self._keepalive_task = None
+        self._failures = 0
+        self._retry_at = 0.0
+
+    def _alive(self):
+        self._connections = [c for c in self._connections if not c.closed]
+        return self._connections
+
+    async def _acquire(self):
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+        if self._keepalive_task is None and self.keepalive_interval > 0:
+            self._keepalive_task = asyncio.get_running_loop().create_task(self._keepalive_loop())
+
+        alive = self._alive()
+        idlest = min(alive, key=lambda c: c.inflight, default=None)
+        # 空いている接続があれば、新規接続より既存接続を優先する
+        if idlest and (idlest.inflight == 0 or len(alive) >= self.size):
+            return idlest
+
+        async with self._connect_lock:
+            alive = self._alive()
+            if len(alive) < self.size:
+                now = time.monotonic()
+                if now < self._retry_at:
+                    if alive:
+                        return min(alive, key=lambda c: c.inflight)
+                    raise RconNotSentError(f"RCON reconnect backoff ({self._retry_at - now:.1f}s left)")
+                connection = RconConnection(self.host, self.port, self.password, self.timeout)
+                try:
+                    await connection.connect()
+                except RconError as e:
+                    self._failures += 1
+                    self._retry_at = time.monotonic() + min(2 ** self._failures, 30)
+                    if alive:
+                        return min(alive, key=lambda c: c.inflight)
+                    raise
+                self._failures = 0
+                self._retry_at = 0.0
+                self._connections.append(connection)
+                self.log('rcon_connected', host=self.host, port=self.port, count=len(self._connections))
+                return connection
+            return min(alive, key=lambda c: c.inflight)
+
+    async def run(self, command):
+        """コマンドを実行し、結合済みの応答文字列を返す。失敗時はRconErrorを送出する"""
+        for attempt in range(2):
+            connection = await self._acquire()
+            try:
+                return await connection.run(command)
+            except RconAuthError:
+                raise
+            except RconNotSentError:
+                # 未送信のまま失敗した場合のみ、別の接続で1回だけ再試行する
+                if attempt:
+                    raise
+            except RconError as e:
+                self.log('rcon_connection_lost', error=e)
+                raise
+
+    async def _keepalive_loop(self):
+        while True:
+            await asyncio.sleep(self.keepalive_interval)
+            now = time.monotonic()
+            for connection in list(self._alive()):
+                if connection.inflight or now - connection.last_used < self.keepalive_interval:
+                    continue
+                try:
+                    await connection.ping()
+                except RconError as e:
+                    self.log('rcon_connection_lost', error=e)
+
+    async def close(self):
+        if self._keepalive_task:
+            self._keepalive_task.cancel()
+            self._keepalive_task = None
+        for connection in self._connections:
+            connection.close()
+        self._connections.clear()
@@ -0,0 +1,179 @@
+"""オフラインのローマ字→かな変換エンジン(Yahoo! APIを呼ぶ前の高速経路)
+
+外部への通信は一切行わないので、APIキーがなくてもAPIが落ちていても動く。
+"""
+import re
+from typing import NamedTuple, Optional
+
+VOWELS = 'aiueo'
+# 促音(っ)になる子音の重なり。nは「ん」として別扱い
+SOKUON_CONSONANTS = set('bcdfghjkmpqrstvwxz')
+# 英語のチャットでよく使われ、ローマ字としては読めてしまう語(助詞と紛らわしい語は含めない)
+ENGLISH_WORDS = frozenset("""
+gg lol brb afk ok okay yes yep nope the you your are is was were been am im i'm it's its this that
+what when where who why how can cant can't dont don't does not and or but if then hi hello hey bye
+thanks thx ty np wtf omg idk xd nice good bad game server lag wait come here there we she they
+my mod mods base home time one two three some all any more make take get got give like love
+see say said well just now new old big small fine sure sorry please pls plz lmao rofl haha hehe
+""".split())
+
+# --- ローマ字表 ---
+_BASE = {
+    '': 'あいうえお',
+    'k': 'かきくけこ', 'g': 'がぎぐげご',
+    's': 'さしすせそ', 'z': 'ざじずぜぞ',
+    't': 'たちつてと', 'd': 'だぢづでど',
+    'n': 'なにぬねの', 'h': 'はひふへほ',
+    'b': 'ばびぶべぼ', 'p': 'ぱぴぷぺぽ',
+    'm': 'まみむめも', 'r': 'らりるれろ',
+    'y': ('や', 'い', 'ゆ', 'いぇ', 'よ'),
+    'w': ('わ', 'うぃ', 'う', 'うぇ', 'を'),
+    'v': ('ゔぁ', 'ゔぃ', 'ゔ', 'ゔぇ', 'ゔぉ'),
+    'f': ('ふぁ', 'ふぃ', 'ふ', 'ふぇ', 'ふぉ'),
+    'j': ('じゃ', 'じ', 'じゅ', 'じぇ', 'じょ'),
+    'l': 'ぁぃぅぇぉ', 'x': 'ぁぃぅぇぉ',
+}
+# 拗音(きゃ等): 子音 + y(またはsh/ch) + a/u/o/e
+_YOON = {
+    'ky': 'き', 'gy': 'ぎ', 'sy': 'し', 'zy': 'じ', 'jy': 'じ', 'ty': 'ち', 'cy': 'ち', 'dy': 'ぢ',
+    'ny': 'に', 'hy': 'ひ', 'by': 'び', 'py': 'ぴ', 'my': 'み', 'ry': 'り',
+    'sh': 'し', 'ch': 'ち',
+}
+_SMALL_Y = {'a': 'ゃ', 'u': 'ゅ', 'o': 'ょ', 'e': 'ぇ'}
+_EXTRA = {
+    'shi': 'し', 'chi': 'ち', 'tsu': 'つ', 'tsa': 'つぁ', 'ji': 'じ',
+    'xtu': 'っ', 'ltu': 'っ', 'xtsu': 'っ', 'ltsu': 'っ',
+    'xya': 'ゃ', 'xyu': 'ゅ', 'xyo': 'ょ', 'lya': 'ゃ', 'lyu': 'ゅ', 'lyo': 'ょ', 'xwa': 'ゎ', 'lwa': 'ゎ',
+    'thi': 'てぃ', 'dhi': 'でぃ', 'twu': 'とぅ', 'dwu': 'どぅ', 'wyi': 'ゐ', 'wye': 'ゑ',
+    'ca': 'か', 'cu': 'く', 'co': 'こ', 'qa': 'くぁ', 'qi': 'くぃ', 'qe': 'くぇ', 'qo': 'くぉ',
+    '-': 'ー', ',': '、', '.': '。', '?': '？', '!': '！', '~': '〜', '[': '「', ']': '」',
+}
+_VALUE = None  # トライ木の葉に値を置くキー
+
+
+def _build_table():
+    table = {}
+    for consonant, kana in _BASE.items():
+        for vowel, value in zip(VOWELS, kana):
+            table[consonant + vowel] = value
+    for prefix, head in _YOON.items():
+        for vowel, small in _SMALL_Y.items():
+            table[prefix + vowel] = head + small
+    table.update(_EXTRA)
+    return table
+
+
+ROMAJI_TABLE = _build_table()
+
+
+def _build_trie(table):
+    trie = {}
+    for romaji, kana in table.items():
+        node = trie
+        for char in romaji:
+            node = node.setdefault(char, {})
+        node[_VALUE] = kana
+    return trie
+
+
+_TRIE = _build_trie(ROMAJI_TABLE)
+_LETTER = re.compile(r'[a-z]')
+
+
+def romaji_to_kana(word):
+    """1語をひらがなに変換する。ローマ字として読めない部分があればNone
+
+    最長一致で表を引く。子音の重なりは「っ」、nは後ろの文字を見て「ん」にする
+    (konnichiha -> こんにちは, minna -> みんな, kan'i -> かんい)。
+    """
+    word = word.lower()
+    out = []
+    i, length = 0, len(word)
+    while i < length:
+        char = word[i]
+        following = word[i + 1] if i + 1 < length else ''
+
+        if char == 'n' and not (following and following in VOWELS + 'y'):
+            out.append('ん')
+            if following == "'":
+                i += 2
+            elif following == 'n':
+                # nnの後ろが母音なら「ん」+「な行」、そうでなければnnで「ん」
+                after = word[i + 2] if i + 2 < length else ''
+                i += 1 if (after and after in VOWELS + 'y') else 2
+            else:
+                i += 1
+            continue
+        if char in SOKUON_CONSONANTS and (following == char or (char == 't' and following == 'c')):
+            out.append('っ')
+            i += 1
+            continue
+
+        node, j, last = _TRIE, i, None
+        while j < length and word[j] in node:
+            node = node[word[j]]
+            j += 1
+            if _VALUE in node:
+                last = (j, node[_VALUE])
+        if last:
+            i, kana = last
+            out.append(kana)
+            continue
+        if not _LETTER.match(char):
+            out.append(char)  # 数字や記号はそのまま
+            i += 1
+            continue
+        return None
+    return ''.join(out)
+
+
+class RomajiResult(NamedTuple):
+    kind: str                 # 'romaji' / 'english' / 'other'(変換対象の文字がない)
+    kana: Optional[str]       # 全体がローマ字として読めた場合のかな
+    converted: Optional[str]  # 辞書適用後の結果(confidentな場合のみAPIを使わずにこれを使う)
+    confident: bool
+
+
+class RomajiEngine:
+    """チャット1行を判定・変換する
+
+    - 英語らしい行(読めない語や英単語が半分以上)や、文字を含まない行は変換しない
+    - 全語がかなに変換でき、かつユーザー辞書で確定できた場合はconfident=True(APIを使わない)
+    - それ以外のローマ字行はAPIに任せ、API失敗時にはkanaを代わりに使える
+    """
+
+    def __init__(self, dictionary=None, extra_english_words=()):
+        self.english_words = ENGLISH_WORDS | {word.lower() for word in extra_english_words}
+        self.dictionary = {}
+        for key, value in (dictionary or {}).items():
+            # キーはローマ字でもかなでもよい。かなに正規化して持つ
+            kana_key = romaji_to_kana(str(key).replace(' ', '')) if _LETTER.search(str(key).lower()) else str(key)
+            if kana_key:
+                self.dictionary[kana_key] = str(value)
+
+    def analyze(self, text):
+        words = text.split()
+        if not words or not _LETTER.search(text.lower()):
+            return RomajiResult('other', None, None, False)
+
+        converted_words, english = [], 0
+        for word in words:
+            kana = romaji_to_kana(word)
+            bare = word.lower().strip('.,!?~')
+            if kana is None or bare in self.english_words:
+                english += 1
+            converted_words.append(kana)
+        if english * 2 >= len(words):
+            return RomajiResult('english', None, None, False)
+        if any(kana is None for kana in converted_words):
+            # 一部だけ読めない(固有名詞など)。判断はAPIに任せる
+            return RomajiResult('romaji', None, None, False)
+
+        # 日本語は分かち書きしないので、語の間の空白は詰める
+        kana = ''.join(converted_words)
+        phrase = self.dictionary.get(kana)
+        if phrase is not None:
+            return RomajiResult('romaji', kana, phrase, True)
+        if all(word in self.dictionary for word in converted_words):
+            return RomajiResult('romaji', kana, ''.join(self.dictionary[word] for word in converted_words), True)
+        return RomajiResult('romaji', kana, None, False)
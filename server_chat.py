@@ -0,0 +1,197 @@
+"""Minecraftサーバーへのチャット送信キュー。連続する発言を1つのtellrawにまとめ、サーバーごとに順番通り送る"""
+import asyncio
+import collections
+import json
+import time
+
+# MinecraftのRCONが受け付けるコマンド本文の上限(バイト)
+MAX_COMMAND_BYTES = 1446
+
+# tellrawの行区切り
+_NEWLINE = json.dumps("\n")
+
+
+def _dumps(value):
+    # 日本語を\uXXXXにしない方が短い(UTF-8で3バイト、エスケープでは6バイト)
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+
+
+def text_component(text, **style):
+    return dict(text=text, **style)
+
+
+def link_component(label, url):
+    """クリックでURLを開くテキスト(添付ファイルなど)"""
+    return {"text": label, "color": "aqua", "underlined": True, "clickEvent": {"action": "open_url", "value": url}}
+
+
+def split_text(text, budget):
+    """JSON文字列にしてbudgetバイトに収まるように分割する。後半に空白があればそこで切る"""
+    chunks = []
+    while len(_dumps(text).encode('utf-8')) > budget:
+        chunk = text.encode('utf-8')[:budget].decode('utf-8', 'ignore')
+        while chunk and len(_dumps(chunk).encode('utf-8')) > budget:
+            chunk = chunk[:-max(1, len(chunk) // 10)]  # エスケープで長くなった分を削る
+        if not chunk:
+            break
+        space = chunk.rfind(' ')
+        if space > len(chunk) // 2:
+            chunk = chunk[:space + 1]
+        chunks.append(chunk)
+        text = text[len(chunk):]
+    if text:
+        chunks.append(text)
+    return chunks
+
+
+class ServerChatOutbox:
+    """1台分のチャット送信キュー
+
+    最初の発言からflush_window秒だけ待って後続をまとめ、上限のバイト数に収まるだけ1つのtellrawに詰めて送る。
+    送信はワーカー1つが順番に行うので、到着順は崩れない。コマンドの送信はrate_commands回/rate_per秒に抑え、
+    それを超えて溜まった分は古いものから捨てる(Discordでの連投でサーバーのコンソールを埋めない)。
+    """
+
+    def __init__(self, send, name='', target='@a', flush_window=0.25, rate_commands=4, rate_per=1.0,
+                 max_queue=500, max_command_bytes=MAX_COMMAND_BYTES, log=None):
+        # send(command)はコルーチン関数で、成功したらTrueを返す
+        self.send = send
+        self.name = name
+        self.prefix = f"tellraw {target} "
+        self.flush_window = float(flush_window)
+        self.rate_commands = max(1, int(rate_commands))
+        self.rate_per = float(rate_per)
+        self.max_queue = max(1, int(max_queue))
+        self.max_command_bytes = int(max_command_bytes)
+        self.log = log or (lambda key, **kwargs: None)
+
+        # 1行に使えるバイト数(プレフィックスと '["",' と ']' を除く)
+        self.line_budget = self.max_command_bytes - len(self.prefix.encode('utf-8')) - len('["",]')
+        self._queue = collections.deque()  # (enqueue時刻, 1行分のJSON断片, そのバイト数)
+        self._wakeup = asyncio.Event()
+        self._sent_at = collections.deque(maxlen=self.rate_commands)
+        self._worker = None
+        self._overflowing = False
+
+        # 統計
+        self.lines_sent = 0
+        self.commands_sent = 0
+        self.failed = 0
+        self.dropped = 0
+
+    @property
+    def depth(self):
+        return len(self._queue)
+
+    def post(self, *components):
+        """1行分(テキストやリンクの部品)を積む。イベントループ上から呼ぶ"""
+        now = time.monotonic()
+        for line in self._fit([text_component(c) if isinstance(c, str) else c for c in components]):
+            fragment = ','.join(_dumps(component) for component in line)
+            self._queue.append((now, fragment, len(fragment.encode('utf-8'))))
+        self._trim()
+        self._wakeup.set()
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    def _fit(self, components):
+        """1行が1コマンドに収まらなければ、部品の区切りで、それでも長い部品は文字列を分割して複数行にする"""
+        lines, line, size = [], [], 0
+        for component in components:
+            encoded = len(_dumps(component).encode('utf-8')) + (1 if line else 0)
+            if size + encoded <= self.line_budget:
+                line.append(component)
+                size += encoded
+                continue
+            if line:
+                lines.append(line)
+                line, size = [], 0
+            if encoded <= self.line_budget or 'text' not in component:
+                line, size = [component], encoded
+                continue
+            # 文字列だけを分割し、装飾(色やリンク)は各部分に引き継ぐ
+            overhead = len(_dumps(dict(component, text='')).encode('utf-8')) - 2
+            for chunk in split_text(component['text'], self.line_budget - overhead):
+                lines.append([dict(component, text=chunk)])
+        if line:
+            lines.append(line)
+        return lines
+
+    def _trim(self):
+        overflow = len(self._queue) - self.max_queue
+        if overflow <= 0:
+            self._overflowing = False
+            return
+        for _ in range(overflow):
+            self._queue.popleft()
+        self.dropped += overflow
+        if not self._overflowing:
+            self._overflowing = True
+            self.log('server_chat_overflow', server=self.name, count=overflow)
+
+    async def _wait_rate_limit(self):
+        if len(self._sent_at) == self.rate_commands:
+            wait = self._sent_at[0] + self.rate_per - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+    def _pack(self):
+        """キューの先頭から、上限に収まるだけ改行でつなげてtellrawコマンドにする"""
+        fragments, size = [], 0
+        separator = len(_NEWLINE) + 2  # ',"\n",'
+        while self._queue:
+            _, fragment, length = self._queue[0]
+            added = length + (separator if fragments else 0)
+            if fragments and size + added > self.line_budget:
+                break
+            fragments.append(fragment)
+            size += added
+            self._queue.popleft()
+        return f'{self.prefix}["",{f",{_NEWLINE},".join(fragments)}]', len(fragments)
+
+    async def _run(self):
+        while True:
+            if not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            # 後続の発言を少し待ってからまとめる(1コマンド分以上溜まっているなら待たない)
+            if sum(length for _, _, length in self._queue) < self.line_budget:
+                await asyncio.sleep(self.flush_window)
+            await self._wait_rate_limit()
+
+            command, count = self._pack()
+            self._sent_at.append(time.monotonic())
+            try:
+                ok = await self.send(command)
+            except Exception as e:
+                self.log('server_chat_failed', server=self.name, error=e)
+                ok = False
+            if ok:
+                self.lines_sent += count
+                self.commands_sent += 1
+            else:
+                self.failed += count
+            if not self._queue:
+                self._overflowing = False
+            # 停止と同時に接続が閉じると、RCON側の例外(送信失敗)にキャンセルが隠れることがある
+            task = asyncio.current_task()
+            if getattr(task, 'cancelling', lambda: 0)():
+                raise asyncio.CancelledError
+
+    async def close(self):
+        """送信ワーカーを止める(キューに残った行は捨てる)"""
+        if self._worker is not None and not self._worker.done():
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+
+    def stats(self):
+        return {
+            'queue_depth': self.depth,
+            'lines_sent': self.lines_sent,
+            'commands_sent': self.commands_sent,
+            'failed': self.failed,
+            'dropped': self.dropped,
+        }
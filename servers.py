@@ -0,0 +1,156 @@
+"""複数のMinecraftサーバーの登録簿(settings.ymlのsettings.servers)
+
+serversが空なら、従来どおり.envのRCON_HOST等から1台分を作る。
+"""
+import os
+import re
+from typing import Mapping, NamedTuple, Optional
+
+from log_parser import LogLineClassifier, LOG_EVENT_KINDS
+from log_sources import LOG_SOURCE_TYPES
+
+
+class ServerConfig(NamedTuple):
+    name: str                     # コマンドのserver引数やメトリクスで使う識別子
+    label: str                    # 表示名
+    rcon_host: str
+    rcon_port: int
+    rcon_password: str
+    channel_id: int               # ログの転送先・チャットの中継元
+    log_file: str                 # latest.logのパス
+    log_source: Mapping           # ログの取り込み口の設定(settings.log_sourceに、サーバーごとの指定を重ねたもの)
+    regex_profile: str            # settings.regex_profilesの名前(defaultは共通のregex_patterns)
+    whitelist_file: str           # whitelistログの保存先
+    checkpoint_file: str          # ログ読み取り位置の保存先
+    playtime_file: str            # 累計プレイ時間の保存先
+    index_file: str               # ログ検索の索引の保存先
+    legacy_whitelist_file: Optional[str]  # 初回起動時に取り込む従来のwhitelist_log.json
+
+
+def _suffixed(path, name):
+    """'whitelist_log.sqlite3' -> 'whitelist_log_<name>.sqlite3'"""
+    root, ext = os.path.splitext(path)
+    return f"{root}_{name}{ext}"
+
+
+def _log_source(default, override=None):
+    """settings.log_sourceに、サーバーごとのlog_source(typeや、poll・tcpなどの一部の項目)を重ねる"""
+    merged = {key: dict(value) if isinstance(value, dict) else value for key, value in default.items()}
+    for key, value in (override or {}).items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key].update(value)
+        else:
+            merged[key] = value
+    if merged.get('type') not in LOG_SOURCE_TYPES:
+        raise ValueError(f"unknown log_source.type '{merged.get('type')}' (available: {', '.join(LOG_SOURCE_TYPES)})")
+    return merged
+
+
+def _log_source_endpoint(log_source):
+    """同時に1台しか使えない取り込み口(標準入力・名前付きパイプ・ポート)の識別子"""
+    kind = log_source['type']
+    if kind == 'pipe':
+        return ('pipe', log_source['pipe']['path'])
+    if kind in ('tcp', 'udp'):
+        return (kind, int(log_source[kind]['port']))
+    return None
+
+
+def load_server_configs(settings, env=os.environ, legacy_whitelist_file="whitelist_log.json"):
+    """settingsからServerConfigのリストを作る。設定の誤りはValueError"""
+    storage_file = settings['whitelist']['storage']['file']
+    checkpoint_file = settings['log_tail']['checkpoint_file']
+    playtime_file = settings['sessions']['playtime_file']
+    index_file = settings['log_index']['file']
+    entries = settings.get('servers') or []
+
+    if not entries:
+        # 1台構成(従来どおり.envから)
+        return [ServerConfig(
+            name='default',
+            label='default',
+            rcon_host=env.get('RCON_HOST'),
+            rcon_port=int(env.get('RCON_PORT') or 0),
+            rcon_password=env.get('RCON_PASSWORD'),
+            channel_id=int(env.get('CHANNEL_ID') or 0),
+            log_file=env.get('LOG_FILE_PATH', 'logs/latest.log'),
+            log_source=_log_source(settings['log_source']),
+            regex_profile='default',
+            whitelist_file=storage_file,
+            checkpoint_file=checkpoint_file,
+            playtime_file=playtime_file,
+            index_file=index_file,
+            legacy_whitelist_file=legacy_whitelist_file,
+        )]
+
+    configs, names, channels, endpoints = [], set(), set(), set()
+    profiles = settings.get('regex_profiles') or {}
+    for index, entry in enumerate(entries):
+        try:
+            name = str(entry['name'])
+            rcon = entry['rcon']
+            password = rcon.get('password')
+            if password is None and rcon.get('password_env'):
+                password = env.get(rcon['password_env'])
+            if password is None:
+                raise ValueError(f"server '{name}': rcon.password or rcon.password_env is required")
+            config = ServerConfig(
+                name=name,
+                label=str(entry.get('label') or name),
+                rcon_host=str(rcon['host']),
+                rcon_port=int(rcon['port']),
+                rcon_password=str(password),
+                channel_id=int(entry['channel_id']),
+                log_file=str(entry['log_file']),
+                log_source=_log_source(settings['log_source'], entry.get('log_source')),
+                regex_profile=str(entry.get('regex_profile') or 'default'),
+                whitelist_file=str(entry.get('whitelist_file') or _suffixed(storage_file, name)),
+                checkpoint_file=str(entry.get('checkpoint_file') or _suffixed(checkpoint_file, name)),
+                playtime_file=str(entry.get('playtime_file') or _suffixed(playtime_file, name)),
+                index_file=str(entry.get('index_file') or _suffixed(index_file, name)),
+                # 1台目は従来のwhitelist_log.jsonを引き継ぐ
+                legacy_whitelist_file=entry.get('legacy_whitelist_file') or (legacy_whitelist_file if index == 0 else None),
+            )
+        except KeyError as e:
+            raise ValueError(f"servers[{index}]: missing key {e}")
+        if config.name in names:
+            raise ValueError(f"server '{config.name}' is defined twice")
+        if config.channel_id in channels:
+            raise ValueError(f"server '{config.name}': channel {config.channel_id} is already used by another server")
+        if config.regex_profile != 'default' and config.regex_profile not in profiles:
+            raise ValueError(f"server '{config.name}': unknown regex_profile '{config.regex_profile}'")
+        endpoint = _log_source_endpoint(config.log_source)
+        if endpoint is not None and endpoint in endpoints:
+            raise ValueError(f"server '{config.name}': log_source {endpoint[0]} {endpoint[1]} is already used by another server")
+        endpoints.add(endpoint)
+        names.add(config.name)
+        channels.add(config.channel_id)
+        configs.append(config)
+    return configs
+
+
+def regex_profile(settings, name):
+    """共通のregex_patternsに、プロファイルで上書きしたパターンを重ねたdictを返す"""
+    patterns = dict(settings['regex_patterns'])
+    if name != 'default':
+        patterns.update(settings['regex_profiles'][name] or {})
+    return patterns
+
+
+class RegexProfile(NamedTuple):
+    """1つのプロファイルのコンパイル済みパターン(同じプロファイルのサーバーで共有する)"""
+    classifier: LogLineClassifier
+    whitelist_list: re.Pattern
+    online_list: re.Pattern
+    add_success: re.Pattern
+    remove_success: re.Pattern
+
+
+def compile_regex_profile(patterns):
+    return RegexProfile(
+        classifier=LogLineClassifier({kind: patterns[kind] for kind in LOG_EVENT_KINDS}),
+        whitelist_list=re.compile(patterns['whitelist_list']),
+        online_list=re.compile(patterns['online_list']),
+        add_success=re.compile(patterns['add_success'], re.IGNORECASE),
+        remove_success=re.compile(patterns['remove_success'], re.IGNORECASE),
+    )
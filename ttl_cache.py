@@ -0,0 +1,35 @@
+"""変換結果とメンバー名の解決で共用するメモリ上のキャッシュ"""
+import collections
+import time
+
+
+class TTLCache:
+    """有効期限付きのLRUキャッシュ"""
+
+    def __init__(self, maxsize=2048, ttl=86400.0):
+        self.maxsize = max(1, int(maxsize))
+        self.ttl = float(ttl)
+        self._data = collections.OrderedDict()  # key -> (期限, 値)
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return entry[1]
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key):
+        entry = self._data.pop(key, None)
+        return entry[1] if entry else None
+
+    def __len__(self):
+        return len(self._data)
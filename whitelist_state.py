@@ -0,0 +1,80 @@
+"""ホワイトリストのメモリ上のモデル。Bot自身の追加・削除とサーバーログから更新し、RCONとの照合は間隔を空けて行う"""
+import asyncio
+import time
+
+
+class WhitelistState:
+    """ホワイトリストの現在の状態と、各プレイヤーの追加者
+
+    players: 小文字の名前 -> サーバー上の表記
+    adders : 小文字の名前 -> 追加者のDiscord ID (storeの内容)
+
+    変更は1件ずつstore(whitelist_store.WhitelistStore)に書き込む。
+    """
+
+    def __init__(self, store, admin_id=0, reconcile_interval=300.0):
+        self.store = store
+        self.adders = store.load()
+        self.players = {key: key for key in self.adders}
+        self.admin_id = admin_id
+        self.reconcile_interval = float(reconcile_interval)
+        self.last_reconciled = None
+        self._lock = None
+
+    # --- 参照 ---
+    def __contains__(self, player_name):
+        return player_name.lower() in self.players
+
+    def adder_of(self, player_name, default=None):
+        return self.adders.get(player_name.lower(), default)
+
+    def sorted_players(self):
+        return sorted(self.players.values(), key=str.lower)
+
+    # --- 更新 ---
+    def apply_added(self, player_name, adder_id=None, actor_id=None, source='add'):
+        """追加を反映する。adder_idがNoneなら(コンソール等からの追加)、記録済みの追加者を残す"""
+        key = player_name.lower()
+        self.players[key] = player_name
+        if adder_id is not None or key not in self.adders:
+            self.adders[key] = self.admin_id if adder_id is None else adder_id
+            self.store.upsert(key, self.adders[key], actor_id=actor_id, source=source)
+
+    def apply_removed(self, player_name, actor_id=None, source='remove'):
+        key = player_name.lower()
+        self.players.pop(key, None)
+        if self.adders.pop(key, None) is not None:
+            self.store.delete(key, actor_id=actor_id, source=source)
+
+    def reconcile(self, server_names):
+        """サーバーのホワイトリストと突き合わせる。(ログになかった名前, ログから消した名前)を返す"""
+        server = {name.lower(): name for name in server_names}
+        unlogged = [name for key, name in server.items() if key not in self.adders]
+        stale = [key for key in self.adders if key not in server]
+        for name in unlogged:
+            self.adders[name.lower()] = self.admin_id
+            self.store.upsert(name.lower(), self.admin_id, source='sync')
+        for key in stale:
+            del self.adders[key]
+            self.store.delete(key, source='sync')
+        self.players = server
+        self.last_reconciled = time.monotonic()
+        return unlogged, stale
+
+    def needs_reconcile(self):
+        if self.last_reconciled is None:
+            return True
+        return self.reconcile_interval > 0 and time.monotonic() - self.last_reconciled >= self.reconcile_interval
+
+    async def ensure_fresh(self, sync, force=False):
+        """照合が必要な場合だけsync()(RCONで照合するコルーチン関数)を呼ぶ。同時に呼ばれても照合は1回"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        if not force and not self.needs_reconcile():
+            return True
+        started = time.monotonic()
+        async with self._lock:
+            # 待っている間に他の呼び出しが照合を済ませていれば、それを使う
+            if self.last_reconciled is not None and self.last_reconciled >= started:
+                return True
+            return await sync()
@@ -0,0 +1,299 @@
+"""ホワイトリスト追加者ログの保存先(JSON / SQLite / 追記型ジャーナル)
+
+どのバックエンドも1件単位の追加・削除を原子的に行い、誰がいつ誰を追加・削除したかの履歴を残す。
+SQLiteとジャーナルは初回起動時に従来のwhitelist_log.jsonを取り込む。
+"""
+import abc
+import json
+import os
+import sqlite3
+import time
+
+
+def _atomic_write_json(path, data):
+    """一時ファイルに書き、fsyncしてから置き換える(書き込み途中で落ちても元のファイルは壊れない)"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=4)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+# SQLiteのデータベースファイルの先頭16バイト
+SQLITE_HEADER = b"SQLite format 3\x00"
+
+
+def _is_sqlite_file(path):
+    """既存の空でないファイルがSQLiteのデータベースならTrue、別の形式ならFalse、存在しないか空ならNone"""
+    try:
+        with open(path, "rb") as f:
+            head = f.read(len(SQLITE_HEADER))
+    except FileNotFoundError:
+        return None
+    return head == SQLITE_HEADER if head else None
+
+
+def _read_legacy_json(path):
+    if not path or not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+class WhitelistStore(abc.ABC):
+    """保存先の共通インターフェース。キーは小文字のプレイヤー名"""
+
+    @abc.abstractmethod
+    def load(self):
+        """{プレイヤー名: 追加者ID} を返す"""
+
+    @abc.abstractmethod
+    def upsert(self, player, adder_id, actor_id=None, source='add'):
+        """追加(または追加者の更新)を1件記録する"""
+
+    @abc.abstractmethod
+    def delete(self, player, actor_id=None, source='remove'):
+        """削除を1件記録する"""
+
+    def history(self, player=None, limit=50):
+        """新しい順の履歴 [{'at', 'action', 'source', 'player', 'adder_id', 'actor_id'}, ...]"""
+        return []
+
+    def close(self):
+        pass
+
+
+class JsonStore(WhitelistStore):
+    """従来のwhitelist_log.json。書き込みは原子的になったが、更新のたびに全体を書き直す(履歴なし)"""
+
+    def __init__(self, path, log=None):
+        self.path = path
+        self.log = log or (lambda key, **kwargs: None)
+        self._data = None
+
+    def load(self):
+        try:
+            self._data = _read_legacy_json(self.path) or {}
+        except (ValueError, OSError) as e:
+            # 壊れたファイルは上書きせずに退避し、その旨を出力する
+            backup = f"{self.path}.corrupt-{int(time.time())}"
+            os.replace(self.path, backup)
+            self.log('whitelist_store_corrupt', path=self.path, backup=backup, error=e)
+            self._data = {}
+        return dict(self._data)
+
+    def upsert(self, player, adder_id, actor_id=None, source='add'):
+        if self._data is None:
+            self.load()
+        self._data[player] = adder_id
+        _atomic_write_json(self.path, self._data)
+
+    def delete(self, player, actor_id=None, source='remove'):
+        if self._data is None:
+            self.load()
+        if self._data.pop(player, None) is not None:
+            _atomic_write_json(self.path, self._data)
+
+
+class SqliteStore(WhitelistStore):
+    """SQLite(WALモード)。1件の追加・削除と履歴の記録を1トランザクションで行う"""
+
+    def __init__(self, path, legacy_json=None, log=None):
+        if _is_sqlite_file(path) is False:
+            raise ValueError(f"{path} is not a SQLite database (written by another whitelist storage backend?)")
+        self.path = path
+        self.log = log or (lambda key, **kwargs: None)
+        self._conn = sqlite3.connect(path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS adders ("
+                "player TEXT PRIMARY KEY, adder_id INTEGER NOT NULL, updated_at REAL NOT NULL)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS history ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, at REAL NOT NULL, action TEXT NOT NULL, source TEXT NOT NULL, "
+                "player TEXT NOT NULL, adder_id INTEGER, actor_id INTEGER)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS history_player ON history (player, id)")
+        self._migrate(legacy_json)
+
+    def _migrate(self, legacy_json):
+        if self._conn.execute("SELECT 1 FROM adders LIMIT 1").fetchone():
+            return
+        try:
+            legacy = _read_legacy_json(legacy_json)
+        except (ValueError, OSError) as e:
+            self.log('whitelist_store_migration_failed', path=legacy_json, error=e)
+            return
+        if not legacy:
+            return
+        now = time.time()
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO adders (player, adder_id, updated_at) VALUES (?, ?, ?)",
+                [(player, adder_id, now) for player, adder_id in legacy.items()])
+            self._conn.executemany(
+                "INSERT INTO history (at, action, source, player, adder_id, actor_id) VALUES (?, 'add', 'migrate', ?, ?, NULL)",
+                [(now, player, adder_id) for player, adder_id in legacy.items()])
+        os.replace(legacy_json, f"{legacy_json}.migrated")
+        self.log('whitelist_store_migrated', count=len(legacy), path=legacy_json, store=self.path)
+
+    def load(self):
+        return dict(self._conn.execute("SELECT player, adder_id FROM adders"))
+
+    def upsert(self, player, adder_id, actor_id=None, source='add'):
+        now = time.time()
+        with self._conn:
+            self._conn.execute(
+                "INSERT INTO adders (player, adder_id, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(player) DO UPDATE SET adder_id = excluded.adder_id, updated_at = excluded.updated_at",
+                (player, adder_id, now))
+            self._conn.execute(
+                "INSERT INTO history (at, action, source, player, adder_id, actor_id) VALUES (?, 'add', ?, ?, ?, ?)",
+                (now, source, player, adder_id, actor_id))
+
+    def delete(self, player, actor_id=None, source='remove'):
+        now = time.time()
+        with self._conn:
+            row = self._conn.execute("SELECT adder_id FROM adders WHERE player = ?", (player,)).fetchone()
+            if row is None:
+                return
+            self._conn.execute("DELETE FROM adders WHERE player = ?", (player,))
+            self._conn.execute(
+                "INSERT INTO history (at, action, source, player, adder_id, actor_id) VALUES (?, 'remove', ?, ?, ?, ?)",
+                (now, source, player, row[0], actor_id))
+
+    def history(self, player=None, limit=50):
+        query = "SELECT at, action, source, player, adder_id, actor_id FROM history"
+        params = ()
+        if player is not None:
+            query += " WHERE player = ?"
+            params = (player,)
+        rows = self._conn.execute(query + " ORDER BY id DESC LIMIT ?", params + (limit,))
+        return [dict(zip(('at', 'action', 'source', 'player', 'adder_id', 'actor_id'), row)) for row in rows]
+
+    def close(self):
+        self._conn.close()
+
+
+class JournalStore(WhitelistStore):
+    """追記専用のJSON Lines。1回の変更は1行の追記とfsyncだけで済み、ファイル自体が履歴になる
+
+    起動時に全行を再生して現在の状態を作る。書き込み途中で落ちた最後の1行は読み飛ばす。
+    """
+
+    def __init__(self, path, legacy_json=None, log=None):
+        # SQLiteのファイルをJSON Linesとして読み、そこへ追記してしまわないようにする
+        if _is_sqlite_file(path):
+            raise ValueError(f"{path} is a SQLite database, not a whitelist journal (written by the sqlite backend?)")
+        self.path = path
+        self.log = log or (lambda key, **kwargs: None)
+        self._data = {}
+        self._replay()
+        self._file = open(self.path, "a", encoding="utf-8")
+        if not self._data and not os.path.getsize(self.path):
+            self._migrate(legacy_json)
+
+    def _replay(self):
+        if not os.path.exists(self.path):
+            return
+        valid_end = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # 書き込み途中で切れた最後の行
+                valid_end += len(line)
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if entry.get('action') == 'add':
+                    self._data[entry['player']] = entry['adder_id']
+                elif entry.get('action') == 'remove':
+                    self._data.pop(entry['player'], None)
+        # 切れた行の後ろに次の行が繋がらないよう、切り詰めてから追記を始める
+        if valid_end < os.path.getsize(self.path):
+            os.truncate(self.path, valid_end)
+
+    def _append(self, entries):
+        for entry in entries:
+            self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def _migrate(self, legacy_json):
+        try:
+            legacy = _read_legacy_json(legacy_json)
+        except (ValueError, OSError) as e:
+            self.log('whitelist_store_migration_failed', path=legacy_json, error=e)
+            return
+        if not legacy:
+            return
+        now = time.time()
+        self._append({'at': now, 'action': 'add', 'source': 'migrate', 'player': player,
+                      'adder_id': adder_id, 'actor_id': None} for player, adder_id in legacy.items())
+        self._data.update(legacy)
+        os.replace(legacy_json, f"{legacy_json}.migrated")
+        self.log('whitelist_store_migrated', count=len(legacy), path=legacy_json, store=self.path)
+
+    def load(self):
+        return dict(self._data)
+
+    def upsert(self, player, adder_id, actor_id=None, source='add'):
+        self._append([{'at': time.time(), 'action': 'add', 'source': source, 'player': player,
+                       'adder_id': adder_id, 'actor_id': actor_id}])
+        self._data[player] = adder_id
+
+    def delete(self, player, actor_id=None, source='remove'):
+        if player not in self._data:
+            return
+        self._append([{'at': time.time(), 'action': 'remove', 'source': source, 'player': player,
+                       'adder_id': self._data[player], 'actor_id': actor_id}])
+        del self._data[player]
+
+    def history(self, player=None, limit=50):
+        # 履歴の参照は稀なので、その都度ファイルを読む
+        entries = []
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if player is None or entry.get('player') == player:
+                    entries.append(entry)
+        return entries[::-1][:limit]
+
+    def close(self):
+        self._file.close()
+
+
+STORE_BACKENDS = {
+    'json': JsonStore,
+    'sqlite': SqliteStore,
+    'journal': JournalStore,
+}
+
+# バックエンドごとの拡張子。別のバックエンドの拡張子のファイル名が指定されたら付け替える
+# (既定のwhitelist_log.sqlite3のままjournalに切り替えても、whitelist_log.jsonlを使う)
+STORE_EXTENSIONS = {
+    'sqlite': '.sqlite3',
+    'journal': '.jsonl',
+}
+
+
+def store_path(backend, path):
+    root, extension = os.path.splitext(path)
+    if backend in STORE_EXTENSIONS and extension in STORE_EXTENSIONS.values():
+        return root + STORE_EXTENSIONS[backend]
+    return path
+
+
+def open_store(backend, path, legacy_json=None, log=None):
+    """設定名から保存先を作る。jsonの場合は従来ファイルそのものを使う"""
+    if backend not in STORE_BACKENDS:
+        raise ValueError(f"Unknown whitelist storage backend: {backend}")
+    if backend == 'json':
+        return JsonStore(legacy_json or path, log=log)
+    return STORE_BACKENDS[backend](store_path(backend, path), legacy_json=legacy_json, log=log)
@@ -0,0 +1,252 @@
+"""Yahoo!かな漢字変換APIの非同期クライアント(2段キャッシュ・同一リクエストの集約・サーキットブレーカー付き)"""
+import asyncio
+import collections
+import functools
+import json
+import sqlite3
+import threading
+import time
+
+import aiohttp
+
+from ttl_cache import TTLCache
+
+API_URL = "https://jlp.yahooapis.jp/JIMService/V2/conversion"
+# ディスクキャッシュから期限切れの行を消す間隔(秒)
+DISK_PURGE_INTERVAL = 3600.0
+
+
+class DiskCache:
+    """再起動をまたいで変換結果を残すSQLiteキャッシュ
+
+    呼び出しはasyncio.to_threadのワーカーから同時に行われるので、1つの接続をロックで順番に使う。
+    期限切れの行は開いたときと、その後はDISK_PURGE_INTERVALごとの書き込みのついでに消す。
+    """
+
+    def __init__(self, path, ttl=86400.0 * 30):
+        self.path = path
+        self.ttl = float(ttl)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS conversions (source TEXT PRIMARY KEY, converted TEXT NOT NULL, stored_at REAL NOT NULL)")
+        self._conn.commit()
+        self._purged_at = 0.0
+        with self._lock:
+            self._purge()
+
+    def _purge(self):
+        """期限切れの行を消す(ロックを取ってから呼ぶ)"""
+        self._conn.execute("DELETE FROM conversions WHERE stored_at < ?", (time.time() - self.ttl,))
+        self._conn.commit()
+        self._purged_at = time.monotonic()
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT converted FROM conversions WHERE source = ? AND stored_at >= ?",
+                (key, time.time() - self.ttl)).fetchone()
+        return row[0] if row else None
+
+    def set(self, key, value):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO conversions (source, converted, stored_at) VALUES (?, ?, ?)",
+                (key, value, time.time()))
+            self._conn.commit()
+            if time.monotonic() - self._purged_at >= DISK_PURGE_INTERVAL:
+                self._purge()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class CircuitBreaker:
+    """連続してfailure_threshold回失敗したらcooldown秒だけAPI呼び出しを止める。その後1回だけ試して判断する"""
+
+    def __init__(self, failure_threshold=3, cooldown=60.0):
+        self.failure_threshold = max(1, int(failure_threshold))
+        self.cooldown = float(cooldown)
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            return 'half_open'
+        return 'open'
+
+    def allow(self):
+        state = self.state
+        if state == 'closed':
+            return True
+        if state == 'half_open' and not self._trial:
+            self._trial = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+
+    def record_failure(self):
+        """失敗を記録し、これで回路が開いたらTrueを返す"""
+        self.failures += 1
+        self._trial = False
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+            return True
+        return False
+
+
+class YahooConverter:
+    """ローマ字をかな漢字交じり文に変換する。失敗時は元のテキストをそのまま返す
+
+    メモリ(LRU+TTL) -> ディスク(SQLite, 任意) -> API の順に引き、同じ文の同時問い合わせは1回にまとめる。
+    """
+
+    def __init__(self, appid, timeout=5.0, cache_size=2048, cache_ttl=86400.0, persistent_file=None,
+                 persistent_ttl=86400.0 * 30, failure_threshold=3, cooldown=60.0, log=None):
+        self.appid = appid
+        self.timeout = float(timeout)
+        self.memory = TTLCache(cache_size, cache_ttl)
+        self.disk = DiskCache(persistent_file, persistent_ttl) if persistent_file else None
+        self.breaker = CircuitBreaker(failure_threshold, cooldown)
+        self.log = log or (lambda key, **kwargs: None)
+        self._session = None
+        self._inflight = {}
+        # 統計
+        self.counters = collections.Counter()
+        self.last_api_latency = 0.0
+        self.avg_api_latency = 0.0
+        self.max_api_latency = 0.0
+
+    @property
+    def hit_ratio(self):
+        hits = self.counters['memory_hits'] + self.counters['disk_hits']
+        total = hits + self.counters['misses']
+        return hits / total if total else 0.0
+
+    async def convert(self, text):
+        cached = self.memory.get(text)
+        if cached is not None:
+            self.counters['memory_hits'] += 1
+            return cached
+
+        # 同じ文の問い合わせが進行中なら、その結果を待つ
+        task = self._inflight.get(text)
+        if task is not None:
+            self.counters['coalesced'] += 1
+        else:
+            task = asyncio.ensure_future(self._lookup(text))
+            self._inflight[text] = task
+            task.add_done_callback(functools.partial(self._lookup_done, text))
+        # 最初の呼び出しも含め、キャンセルされた呼び出しが他の呼び出しの問い合わせを止めないようにshieldで待つ
+        return await asyncio.shield(task)
+
+    def _lookup_done(self, text, task):
+        if self._inflight.get(text) is task:
+            del self._inflight[text]
+        # 待っている呼び出しがなくても、例外の取り出し忘れ警告を出さない
+        if not task.cancelled():
+            task.exception()
+
+    async def _lookup(self, text):
+        if self.disk:
+            stored = await asyncio.to_thread(self.disk.get, text)
+            if stored is not None:
+                self.counters['disk_hits'] += 1
+                self.memory.set(text, stored)
+                return stored
+
+        self.counters['misses'] += 1
+        converted = await self._request(text)
+        if converted is None:
+            return text  # 失敗した結果はキャッシュしない
+        self.memory.set(text, converted)
+        if self.disk:
+            await asyncio.to_thread(self.disk.set, text, converted)
+        return converted
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=8, keepalive_timeout=60),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers={"User-Agent": f"Yahoo AppID: {self.appid}"},
+            )
+        return self._session
+
+    async def _request(self, text):
+        """APIに問い合わせる。失敗したらNone"""
+        if not self.appid:
+            self.log('yahoo_appid_missing')
+            return None
+        if not self.breaker.allow():
+            self.counters['breaker_skipped'] += 1
+            return None
+
+        payload = {
+            "id": "1234-1",
+            "jsonrpc": "2.0",
+            "method": "jlp.jimservice.conversion",
+            "params": {
+                "q": text,
+                "format": "roman",
+                "mode": "kanakanji",
+                "results": 1 # 最も可能性の高い候補のみ取得
+            }
+        }
+        started = time.monotonic()
+        self.counters['api_calls'] += 1
+        try:
+            async with self._get_session().post(API_URL, data=json.dumps(payload),
+                                                headers={"Content-Type": "application/json"}) as response:
+                response.raise_for_status()
+                data = await response.json(content_type=None)
+            # 各セグメントの最初の候補を結合して文を再構築
+            converted = "".join([seg["candidate"][0] for seg in data["result"]["segment"]])
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self._record_failure()
+            self.log('yahoo_request_failed', error=e)
+            return None
+        except (IndexError, KeyError, TypeError, ValueError) as e:
+            self._record_failure()
+            self.log('yahoo_parse_failed', error=e)
+            return None
+        finally:
+            latency = time.monotonic() - started
+            self.last_api_latency = latency
+            self.max_api_latency = max(self.max_api_latency, latency)
+            self.avg_api_latency = latency if self.counters['api_calls'] == 1 else self.avg_api_latency * 0.9 + latency * 0.1
+
+        self.breaker.record_success()
+        return converted
+
+    def _record_failure(self):
+        self.counters['api_errors'] += 1
+        if self.breaker.record_failure():
+            self.log('yahoo_circuit_open', seconds=self.breaker.cooldown)
+
+    def stats(self):
+        return {
+            'hit_ratio': self.hit_ratio,
+            'memory_entries': len(self.memory),
+            'breaker_state': self.breaker.state,
+            'last_api_latency': self.last_api_latency,
+            'avg_api_latency': self.avg_api_latency,
+            'max_api_latency': self.max_api_latency,
+            **self.counters,
+        }
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+        if self.disk:
+            self.disk.close()